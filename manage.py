@@ -5,7 +5,10 @@ import sys
 
 
 def main():
-    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'thermostats.settings')
+    settings_module = 'thermostats.settings'
+    if sys.argv[1:2] == ['sync_thermostats']:
+        settings_module = 'thermostats.settings_sync'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'thermostats.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Needs the Django setup done by get_asgi_application() above.
+from thermostats.thermostats.sse import events_application  # noqa: E402
+
+EVENTS_PATH = "/events"
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == EVENTS_PATH:
+        return await events_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -38,7 +38,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
-    "thermostats.thermostats",
+    "thermostats.thermostats.apps.ThermostatsConfig",
 ]
 
 MIDDLEWARE = [
@@ -77,11 +77,42 @@ WSGI_APPLICATION = "thermostats.wsgi.application"
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+        "ENGINE": config("DB_ENGINE", default="django.db.backends.sqlite3", cast=str),
+        "NAME": config("DB_NAME", default=os.path.join(BASE_DIR, "db.sqlite3")),
+        "USER": config("DB_USER", default="", cast=str),
+        "PASSWORD": config("DB_PASSWORD", default="", cast=str),
+        "HOST": config("DB_HOST", default="", cast=str),
+        "PORT": config("DB_PORT", default="", cast=str),
+        "CONN_MAX_AGE": config("DB_CONN_MAX_AGE", default=60, cast=int),
     }
 }
 
+# Seconds to wait for a lock held by another process (sync, admin, ...).
+DB_TIMEOUT = config("DB_TIMEOUT", default=20, cast=int)
+if DATABASES["default"]["ENGINE"] == "django.db.backends.sqlite3":
+    DATABASES["default"]["OPTIONS"] = {"timeout": DB_TIMEOUT}
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# Must be shared between the sync command and the web server processes.
+
+CACHES = {
+    "default": {
+        "BACKEND": config(
+            "CACHE_BACKEND",
+            default="django.core.cache.backends.filebased.FileBasedCache",
+            cast=str,
+        ),
+        "LOCATION": config(
+            "CACHE_LOCATION", default=os.path.join(BASE_DIR, ".cache"), cast=str
+        ),
+    }
+}
+
+# How often the ASGI server checks for new events to stream, in seconds.
+EVENTS_POLL_INTERVAL = config("EVENTS_POLL_INTERVAL", default=1.0, cast=float)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -155,6 +186,78 @@ LOGGING = {
 TEMPERATURE_OFF = config("TEMPERATURE_OFF", default=126.5, cast=float)
 TEMPERATURE_FALLBACK = config("TEMPERATURE_FALLBACK", default=0, cast=float)
 
+# Start heating ahead of a Rule based on the learned heat-up rate, but never
+# earlier than this many minutes. Set to 0 to disable pre-starting.
+PRESTART_MAX_MINUTES = config("PRESTART_MAX_MINUTES", default=120, cast=int)
+
+# Don't write setpoints that are superseded within this many seconds anyway,
+# and leave at least this many seconds between writes to the same thermostat.
+WRITE_COALESCE_SECONDS = config("WRITE_COALESCE_SECONDS", default=300, cast=int)
+WRITE_MIN_INTERVAL_SECONDS = config("WRITE_MIN_INTERVAL_SECONDS", default=600, cast=int)
+
+# Failed writes and ones the device didn't report back within
+# COMMAND_CONFIRM_SECONDS are retried with an exponential backoff. While
+# writes are unconfirmed, run_scheduler syncs every COMMAND_VERIFY_SECONDS.
+COMMAND_MAX_ATTEMPTS = config("COMMAND_MAX_ATTEMPTS", default=5, cast=int)
+COMMAND_RETRY_SECONDS = config("COMMAND_RETRY_SECONDS", default=60, cast=int)
+COMMAND_RETRY_MAX_SECONDS = config("COMMAND_RETRY_MAX_SECONDS", default=3600, cast=int)
+COMMAND_CONFIRM_SECONDS = config("COMMAND_CONFIRM_SECONDS", default=900, cast=int)
+COMMAND_VERIFY_SECONDS = config("COMMAND_VERIFY_SECONDS", default=120, cast=int)
+
+# The winning Rule per thermostat and minute of the week is cached in-process
+# (at most RULE_CACHE_SIZE entries) and, if set, in the RULE_CACHE_ALIAS of
+# CACHES, e.g. a memcached or Redis cache shared by all processes.
+RULE_CACHE_SIZE = config("RULE_CACHE_SIZE", default=4096, cast=int)
+RULE_CACHE_ALIAS = config("RULE_CACHE_ALIAS", default="", cast=str)
+RULE_CACHE_TIMEOUT = config("RULE_CACHE_TIMEOUT", default=86400, cast=int)
+
+# Thermostats are split into SYNC_SHARDS shards by their AIN. Every
+# run_scheduler --worker syncs the shards it holds a lease on, leases not
+# renewed within SHARD_LEASE_SECONDS are taken over by the other workers.
+SYNC_SHARDS = config("SYNC_SHARDS", default=1, cast=int)
+SHARD_LEASE_SECONDS = config("SHARD_LEASE_SECONDS", default=300, cast=int)
+
+# The setpoints of the next SCHEDULE_DAYS are precomputed into the
+# ScheduledSetpoint table, see schedule.py.
+SCHEDULE_DAYS = config("SCHEDULE_DAYS", default=7, cast=int)
+
+# Structured events of every sync decision, see eventlog.py. EVENT_LOG_FILE
+# gets one JSON object per line, the last EVENT_LOG_RING_SIZE events are
+# served as decisions.json. EVENT_LOG_SINKS adds sink classes by dotted path.
+EVENT_LOG_FILE = config("EVENT_LOG_FILE", default="", cast=str)
+EVENT_LOG_BUFFERED = config("EVENT_LOG_BUFFERED", default=True, cast=bool)
+EVENT_LOG_RING_SIZE = config("EVENT_LOG_RING_SIZE", default=500, cast=int)
+EVENT_LOG_SINKS = config("EVENT_LOG_SINKS", default="", cast=Csv())
+
+# Latencies and errors of Fritz!Box calls within the last HEALTH_WINDOW_SECONDS
+# are checked against these limits after every sync, a single notification
+# is sent when they are exceeded and another one when things are back to normal.
+# Latencies and error rates are only judged with HEALTH_MIN_CALLS calls, and
+# only count as back to normal below HEALTH_RECOVERY_FACTOR times the limits.
+HEALTH_WINDOW_SECONDS = config("HEALTH_WINDOW_SECONDS", default=3600, cast=int)
+HEALTH_LATENCY_BUDGET_MS = config("HEALTH_LATENCY_BUDGET_MS", default=5000, cast=int)
+HEALTH_MAX_ERROR_RATE = config("HEALTH_MAX_ERROR_RATE", default=0.2, cast=float)
+HEALTH_MAX_SID_INVALIDATIONS = config(
+    "HEALTH_MAX_SID_INVALIDATIONS", default=3, cast=int
+)
+HEALTH_MIN_CALLS = config("HEALTH_MIN_CALLS", default=10, cast=int)
+HEALTH_RECOVERY_FACTOR = config("HEALTH_RECOVERY_FACTOR", default=0.8, cast=float)
+
+# Adaptive polling of the run_scheduler command: sync right after Rule
+# boundaries, every POLL_PRESTART_SECONDS ahead of them and more often in
+# hours with manual changes during the last POLL_ACTIVITY_WEEKS, but never
+# less often than POLL_MAX_SECONDS.
+POLL_MIN_SECONDS = config("POLL_MIN_SECONDS", default=60, cast=int)
+POLL_MAX_SECONDS = config("POLL_MAX_SECONDS", default=1800, cast=int)
+POLL_PRESTART_SECONDS = config("POLL_PRESTART_SECONDS", default=600, cast=int)
+POLL_BOUNDARY_DELAY_SECONDS = config("POLL_BOUNDARY_DELAY_SECONDS", default=5, cast=int)
+POLL_ACTIVITY_WEEKS = config("POLL_ACTIVITY_WEEKS", default=4, cast=int)
+
+# status.json, status/, health.json, decisions.json, reports/heating.json and
+# /events are served to logged in staff users and, if set, to requests with
+# this token, see access.py.
+API_TOKEN = config("API_TOKEN", default="", cast=str)
+
 FRITZBOX_HOST = config("FRITZBOX_HOST", default="", cast=str)
 FRITZBOX_USER = config("FRITZBOX_USER", default="", cast=str)
 FRITZBOX_PASSWORD = config("FRITZBOX_PASSWORD", default="", cast=str)
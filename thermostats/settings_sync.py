@@ -0,0 +1,21 @@
+"""
+Trimmed settings for running the sync_thermostats command.
+
+The sync needs neither the admin nor sessions, messages or static files, so
+these are not loaded to keep the startup of (cron) runs short. Without the
+admin its URLs can't be resolved, so thermostats/urls_sync.py has none.
+manage.py uses these settings for the sync_thermostats command unless
+DJANGO_SETTINGS_MODULE is set explicitly.
+"""
+
+from thermostats.settings import *  # noqa: F401, F403
+
+INSTALLED_APPS = [
+    "thermostats.thermostats.apps.ThermostatsConfig",
+]
+
+MIDDLEWARE = []
+
+TEMPLATES = []
+
+ROOT_URLCONF = "thermostats.urls_sync"
@@ -0,0 +1,61 @@
+"""Who may read the status, reports, decisions and event stream.
+
+They expose device names, temperatures and sync decisions, so they are only
+served to logged in staff users (e.g. after logging into the admin) or to
+requests carrying the API_TOKEN, either as "Authorization: Bearer <token>"
+or as a ?token= query parameter for clients that can't send headers, like
+a browser's EventSource. Without an API_TOKEN, only staff users get access.
+
+"""
+from functools import wraps
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.crypto import constant_time_compare
+
+BEARER = "Bearer "
+
+
+def is_valid_token(token):
+    return bool(settings.API_TOKEN and token) and constant_time_compare(
+        token, settings.API_TOKEN
+    )
+
+
+def get_token(authorization, query_string):
+    """Return the token of the Authorization header or query string, or None."""
+    if authorization and authorization.startswith(BEARER):
+        return authorization[len(BEARER) :].strip()
+    tokens = parse_qs(query_string).get("token")
+    return tokens[0] if tokens else None
+
+
+def get_request_token(request):
+    return get_token(
+        request.META.get("HTTP_AUTHORIZATION", ""),
+        request.META.get("QUERY_STRING", ""),
+    )
+
+
+def get_scope_token(scope):
+    """Like get_request_token(), for an ASGI scope."""
+    authorization = ""
+    for name, value in scope.get("headers", []):
+        if name == b"authorization":
+            authorization = value.decode("latin-1")
+    return get_token(authorization, scope.get("query_string", b"").decode("latin-1"))
+
+
+def require_access(view):
+    """Decorate a view to answer 401 unless the request has access."""
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if is_valid_token(get_request_token(request)) or request.user.is_staff:
+            return view(request, *args, **kwargs)
+        response = JsonResponse({"error": "Authentication required"}, status=401)
+        response["WWW-Authenticate"] = "Bearer"
+        return response
+
+    return wrapper
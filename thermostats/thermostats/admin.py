@@ -1,7 +1,19 @@
 from django.contrib import admin
+from django.utils.html import format_html_join
 from django.utils.safestring import mark_safe
 
-from .models import Rule, Thermostat, ThermostatLog, WeekDay
+from .analysis import analyze_thermostat
+from .models import (
+    RULE_PRECEDENCE,
+    CalendarException,
+    DeviceCommand,
+    ManualOverride,
+    Rule,
+    ScheduledSetpoint,
+    Thermostat,
+    ThermostatLog,
+    WeekDay,
+)
 
 
 class WeekDayAdmin(admin.ModelAdmin):
@@ -42,6 +54,7 @@ class ThermostatLogAdmin(admin.ModelAdmin):
     list_display = (
         "thermostat",
         "rule",
+        "exception",
         "start_time",
         "end_time",
         "temperature",
@@ -51,19 +64,85 @@ class ThermostatLogAdmin(admin.ModelAdmin):
     ordering = ("-created_at",)
 
 
+class CalendarExceptionAdmin(admin.ModelAdmin):
+    list_display = (
+        "name",
+        "enabled",
+        "start",
+        "end",
+        "temperature",
+        "thermostat_names",
+        "created_at",
+        "id",
+    )
+    ordering = ("-start",)
+    filter_horizontal = ("thermostats",)
+
+    def thermostat_names(self, exception):
+        names = [thermostat.name for thermostat in exception.thermostats.all()]
+        return ", ".join(names) or "All"
+
+
+class ManualOverrideAdmin(admin.ModelAdmin):
+    list_display = (
+        "thermostat",
+        "rule",
+        "temperature",
+        "created_at",
+        "expires_at",
+        "id",
+    )
+    ordering = ("-created_at",)
+
+
+class DeviceCommandAdmin(admin.ModelAdmin):
+    list_display = (
+        "thermostat",
+        "temperature",
+        "state",
+        "attempts",
+        "next_attempt_at",
+        "sent_at",
+        "confirmed_at",
+        "last_error",
+        "created_at",
+        "id",
+    )
+    list_filter = ("state",)
+    ordering = ("-created_at",)
+
+
+class ScheduledSetpointAdmin(admin.ModelAdmin):
+    list_display = (
+        "thermostat",
+        "at",
+        "until",
+        "temperature",
+        "next_temperature",
+        "rule",
+        "exception",
+        "id",
+    )
+    list_filter = ("thermostat",)
+    ordering = ("at", "thermostat")
+
+
 class ThermostatAdmin(admin.ModelAdmin):
     list_display = (
         "name",
         "ain",
         "rule_descriptions",
+        "warmup_rate",
         "created_at",
         "id",
     )
     ordering = ("id",)
+    # Analyzing the Rules is too costly for every row of the list.
+    readonly_fields = ("rule_warnings",)
 
     @mark_safe
     def rule_descriptions(self, thermostat):
-        rules = thermostat.rules.all().order_by("start_time", "end_time")
+        rules = thermostat.rules.all().order_by(*RULE_PRECEDENCE)
         list_tags = []
         for rule in rules:
             tag = "<li"
@@ -74,9 +153,22 @@ class ThermostatAdmin(admin.ModelAdmin):
         html = f"<ul>{''.join(list_tags)}</ul>"
         return html
 
+    def rule_warnings(self, thermostat):
+        if thermostat.pk is None:
+            return ""
+        warnings = analyze_thermostat(thermostat).warnings
+        items = format_html_join(
+            "", '<li style="color: darkorange">{}</li>', ((w,) for w in warnings)
+        )
+        return mark_safe(f"<ul>{items}</ul>") if warnings else ""
+
 
 admin.site.site_header = "Thermostats"
+admin.site.register(CalendarException, CalendarExceptionAdmin)
+admin.site.register(DeviceCommand, DeviceCommandAdmin)
+admin.site.register(ManualOverride, ManualOverrideAdmin)
 admin.site.register(Rule, RuleAdmin)
+admin.site.register(ScheduledSetpoint, ScheduledSetpointAdmin)
 admin.site.register(Thermostat, ThermostatAdmin)
 admin.site.register(ThermostatLog, ThermostatLogAdmin)
 admin.site.register(WeekDay, WeekDayAdmin)
@@ -0,0 +1,122 @@
+"""Find overlapping, shadowed and missing Rules of a thermostat.
+
+The week is modelled in minutes (0 is Monday 00:00). Every enabled Rule is
+turned into its weekly segments, following the semantics of
+Rule.is_valid_now(): the part of a wrapping timeframe after midnight
+applies on the same weekday, and without end_time a Rule lasts until the
+end of the day. A single sweep over the segment boundaries then yields the
+effective schedule, with the last Rule by RULE_PRECEDENCE winning.
+
+"""
+from collections import defaultdict
+
+from thermostats.thermostats.models import RULE_PRECEDENCE
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+WEEKDAY_ABBREVIATIONS = ("Mo", "Tu", "We", "Th", "Fr", "Sa", "Su")
+
+
+def time_to_minutes(value):
+    return value.hour * 60 + value.minute
+
+
+def format_minute_of_week(minute):
+    day, minute = divmod(minute, MINUTES_PER_DAY)
+    if day == 7:
+        day, minute = 6, MINUTES_PER_DAY
+    return f"{WEEKDAY_ABBREVIATIONS[day]} {minute // 60:02d}:{minute % 60:02d}"
+
+
+def get_weekly_segments(start_time, end_time, weekday_orders):
+    """Yield the [start, end) minutes of the week a Rule applies to."""
+    start = time_to_minutes(start_time)
+    end = time_to_minutes(end_time) if end_time is not None else MINUTES_PER_DAY
+    for order in weekday_orders:
+        offset = order * MINUTES_PER_DAY
+        if end >= start:
+            yield offset + start, offset + max(end, start + 1)
+        else:
+            yield offset + start, offset + MINUTES_PER_DAY
+            yield offset, offset + end
+
+
+class RuleAnalysis:
+    def __init__(self, thermostat, rules, schedule, overlaps):
+        self.thermostat = thermostat
+        self.rules = rules
+        # (start, end, rule or None) in minutes of the week, covering it all.
+        self.schedule = schedule
+        # Pairs of Rules that are in effect at the same time.
+        self.overlaps = overlaps
+
+    @property
+    def gaps(self):
+        """Segments in which no Rule applies, so the fallback is used."""
+        return [(start, end) for start, end, rule in self.schedule if rule is None]
+
+    @property
+    def shadowed_rules(self):
+        """Rules that never win, because other Rules always take precedence."""
+        winners = {rule.id for _, _, rule in self.schedule if rule is not None}
+        return [rule for rule in self.rules if rule.id not in winners]
+
+    @property
+    def warnings(self):
+        warnings = [f"never in effect: {rule}" for rule in self.shadowed_rules]
+        warnings += [f"overlap: {first} / {second}" for first, second in self.overlaps]
+        return warnings
+
+
+def analyze_thermostat(thermostat):
+    """Build the weekly timeline of the thermostat's enabled Rules.
+
+    Runs in time linear to the number of Rules: boundaries are bucketed by
+    minute of the week instead of sorted.
+
+    """
+    rules = list(
+        thermostat.enabled_rules.order_by(*RULE_PRECEDENCE).prefetch_related("weekdays")
+    )
+
+    starts = defaultdict(list)
+    ends = defaultdict(list)
+    for priority, rule in enumerate(rules):
+        orders = [weekday.order for weekday in rule.weekdays.all()]
+        for start, end in get_weekly_segments(rule.start_time, rule.end_time, orders):
+            starts[start].append(priority)
+            ends[end].append(priority)
+
+    schedule = []
+    overlaps = set()
+    active = set()
+    winner = None
+    segment_start = 0
+    for minute in range(MINUTES_PER_WEEK + 1):
+        if minute not in starts and minute not in ends:
+            continue
+        active.difference_update(ends.get(minute, ()))
+        active.update(starts.get(minute, ()))
+        for first in active:
+            for second in active:
+                if first < second:
+                    overlaps.add((first, second))
+
+        new_winner = max(active) if active else None
+        if new_winner != winner:
+            if minute > segment_start:
+                schedule.append((segment_start, minute, winner))
+            segment_start = minute
+            winner = new_winner
+    if segment_start < MINUTES_PER_WEEK:
+        schedule.append((segment_start, MINUTES_PER_WEEK, winner))
+
+    return RuleAnalysis(
+        thermostat,
+        rules,
+        schedule=[
+            (start, end, rules[priority] if priority is not None else None)
+            for start, end, priority in schedule
+        ],
+        overlaps=[(rules[first], rules[second]) for first, second in sorted(overlaps)],
+    )
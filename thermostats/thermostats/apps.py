@@ -1,5 +1,25 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
 
 
 class ThermostatsConfig(AppConfig):
-    name = 'thermostats'
+    name = "thermostats.thermostats"
+
+    def ready(self):
+        from .db import configure_sqlite
+        from .models import Rule, Thermostat
+        from .reports import aggregate_new_log
+        from .rulecache import bump_rules_version
+
+        connection_created.connect(configure_sqlite)
+        post_save.connect(aggregate_new_log, sender="thermostats.ThermostatLog")
+
+        # Thermostats are saved on every sync (names, heat-up rates), which
+        # doesn't affect the Rules in effect, so only deleting one counts.
+        for sender in (Rule, "thermostats.WeekDay"):
+            post_save.connect(bump_rules_version, sender=sender)
+            post_delete.connect(bump_rules_version, sender=sender)
+        post_delete.connect(bump_rules_version, sender=Thermostat)
+        m2m_changed.connect(bump_rules_version, sender=Rule.weekdays.through)
+        m2m_changed.connect(bump_rules_version, sender=Thermostat.rules.through)
@@ -0,0 +1,222 @@
+"""Record the HTTP traffic of sync runs and replay it without any hardware.
+
+Both pyfritzhome and pushover talk HTTP via requests, so everything goes
+through requests.Session.send(), which is what gets patched here. A
+cassette is a gzipped JSON document holding the exchanges (with their
+timing) plus a snapshot of what the sync reads from the database, taken
+when recording. Older history, like the ThermostatLogs of past days, is
+left out.
+
+"""
+import gzip
+import itertools
+import json
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from django.core import serializers
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from requests.structures import CaseInsensitiveDict
+
+from thermostats.thermostats.models import (
+    CalendarException,
+    DeviceCommand,
+    ManualOverride,
+    Rule,
+    Thermostat,
+    ThermostatLog,
+    WeekDay,
+)
+
+CASSETTE_VERSION = 1
+
+# Query parameters that must not end up in a cassette.
+REDACTED_PARAMS = {"password", "response", "sid", "token", "user", "username"}
+
+# Query parameters telling apart requests to the same path, e.g. the
+# target temperatures set on different thermostats.
+MATCHED_PARAMS = ("switchcmd", "ain")
+
+# Rules look back at most to yesterday for the logs of their timeframe.
+SNAPSHOT_LOG_AGE = timedelta(days=2)
+
+
+def redact_url(url):
+    parts = urlsplit(url)
+    query = [
+        (key, "REDACTED" if key.lower() in REDACTED_PARAMS else value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+    ]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def interaction_key(method, url):
+    """Exchanges are matched on method, path and MATCHED_PARAMS.
+
+    Within the same key, they are answered in the order recorded.
+
+    """
+    parts = urlsplit(url)
+    params = dict(parse_qsl(parts.query, keep_blank_values=True))
+    matched = urlencode([(key, params[key]) for key in MATCHED_PARAMS if key in params])
+    return f"{method} {parts.path}?{matched}" if matched else f"{method} {parts.path}"
+
+
+class Recorder:
+    """Context manager recording all requests made within it."""
+
+    def __init__(self):
+        self.interactions = []
+        self.recorded_at = None
+        self.started_at = None
+        self.patcher = None
+
+    def __enter__(self):
+        self.recorded_at = timezone.now()
+        self.started_at = time.perf_counter()
+        original_send = requests.Session.send
+        recorder = self
+
+        def send(session, request, **kwargs):
+            offset = time.perf_counter() - recorder.started_at
+            response = original_send(session, request, **kwargs)
+            duration = time.perf_counter() - recorder.started_at - offset
+            recorder.record(request, response, offset, duration)
+            return response
+
+        self.patcher = mock.patch.object(requests.Session, "send", send)
+        self.patcher.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.patcher.stop()
+
+    def record(self, request, response, offset, duration):
+        self.interactions.append(
+            {
+                "method": request.method,
+                "url": redact_url(request.url),
+                "offset": round(offset, 6),
+                "duration": round(duration, 6),
+                "status": response.status_code,
+                "headers": {"Content-Type": response.headers.get("Content-Type", "")},
+                # latin-1 maps every byte to a character, so this is lossless.
+                "content": response.content.decode("latin-1"),
+            }
+        )
+
+
+class Player:
+    """Context manager answering requests from recorded interactions.
+
+    speed scales the recorded latencies: 1 replays at the original timing,
+    10 runs ten times faster and 0 doesn't wait at all.
+
+    """
+
+    def __init__(self, interactions, speed=1.0):
+        self.speed = speed
+        self.queues = defaultdict(deque)
+        for interaction in interactions:
+            key = interaction_key(interaction["method"], interaction["url"])
+            self.queues[key].append(interaction)
+        self.played = 0
+        self.patcher = None
+
+    def __enter__(self):
+        player = self
+
+        def send(session, request, **kwargs):
+            return player.play(request)
+
+        self.patcher = mock.patch.object(requests.Session, "send", send)
+        self.patcher.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.patcher.stop()
+
+    @property
+    def remaining(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def play(self, request):
+        queue = self.queues[interaction_key(request.method, request.url)]
+        if not queue:
+            raise requests.ConnectionError(
+                f"No recorded response left for {request.method} {request.url}"
+            )
+        interaction = queue.popleft()
+        if self.speed:
+            time.sleep(interaction["duration"] / self.speed)
+
+        response = requests.Response()
+        response.status_code = interaction["status"]
+        response.headers = CaseInsensitiveDict(interaction["headers"])
+        response._content = interaction["content"].encode("latin-1")
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        self.played += 1
+        return response
+
+
+def get_snapshot_querysets(now):
+    """Return the querysets of everything a sync at now reads, in load order."""
+    logs = ThermostatLog.objects.filter(
+        Q(created_at__gte=now - SNAPSHOT_LOG_AGE)
+        | Q(exception__end__gt=now)
+        | Q(command__state__in=DeviceCommand.OPEN_STATES)
+    )
+    return (
+        WeekDay.objects.all(),
+        Rule.objects.all(),
+        Thermostat.objects.all(),
+        CalendarException.objects.all(),
+        ManualOverride.objects.active(now),
+        logs,
+        DeviceCommand.objects.filter(
+            Q(state__in=DeviceCommand.OPEN_STATES) | Q(log__in=logs)
+        ),
+    )
+
+
+def take_snapshot(now=None):
+    """Return the data a sync reads as serialized JSON."""
+    now = now or timezone.now()
+    objects = itertools.chain.from_iterable(get_snapshot_querysets(now))
+    return serializers.serialize("json", objects)
+
+
+@transaction.atomic
+def load_snapshot(snapshot):
+    """Replace all thermostats app data with the given snapshot."""
+    for model in (CalendarException, Thermostat, Rule, WeekDay):
+        model.objects.all().delete()
+    for obj in serializers.deserialize("json", snapshot):
+        obj.save()
+
+
+def save_cassette(path, recorder, snapshot):
+    cassette = {
+        "version": CASSETTE_VERSION,
+        "recorded_at": recorder.recorded_at.isoformat(),
+        "snapshot": snapshot,
+        "interactions": recorder.interactions,
+    }
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(cassette, f, separators=(",", ":"))
+
+
+def load_cassette(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        cassette = json.load(f)
+    if cassette.get("version") != CASSETTE_VERSION:
+        raise ValueError(f"Unsupported cassette version: {cassette.get('version')}")
+    return cassette
@@ -0,0 +1,39 @@
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection, transaction
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """Let readers and writers of the SQLite database not block each other.
+
+    Connected to the connection_created signal. Without WAL mode a running
+    sync would lock out the admin and the status views (and vice versa).
+
+    """
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={settings.DB_TIMEOUT * 1000}")
+
+
+@contextmanager
+def lock_thermostat(thermostat):
+    """Run the block in a transaction holding an exclusive lock for thermostat.
+
+    Concurrent sync workers use this around deciding and logging a change,
+    so that a Rule can't be applied twice. On SQLite, which can't lock
+    rows, a no-op update takes the database write lock up front instead.
+
+    """
+    from thermostats.thermostats.models import Thermostat
+
+    with transaction.atomic():
+        queryset = Thermostat.objects.filter(pk=thermostat.pk)
+        if connection.vendor == "sqlite":
+            queryset.update(ain=thermostat.ain)
+        else:
+            list(queryset.select_for_update().values_list("pk", flat=True))
+        yield
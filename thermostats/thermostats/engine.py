@@ -0,0 +1,168 @@
+"""Evaluate all enabled Rules of all thermostats at once using NumPy arrays.
+
+This is meant for large fleets, where calling Rule.is_valid_now() for every
+Rule of every Thermostat costs a few queries each. The RuleEngine loads
+everything with a handful of queries and then finds the winning Rule for
+every Thermostat with array operations, following the same semantics:
+
+- A Rule applies on its assigned weekdays (of the current day, also for the
+  part of a wrapping timeframe that lies after midnight).
+- Start and end are inclusive, a missing end_time means end of day.
+- If several Rules apply, the last by RULE_PRECEDENCE wins.
+
+These are the semantics of Thermostat.get_matching_rule() as well, which
+the tests check the engine against.
+
+"""
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from thermostats.thermostats.models import (
+    END_OF_DAY,
+    RULE_PRECEDENCE,
+    Rule,
+    Thermostat,
+)
+
+NO_RULE = -1
+
+
+def time_to_microseconds(value):
+    """Return the microseconds since midnight for the given time."""
+    return (
+        (value.hour * 60 + value.minute) * 60 + value.second
+    ) * 1_000_000 + value.microsecond
+
+
+def lookup(values, winners, default):
+    """Return values[winners], with default wherever there is no winner."""
+    if not len(values):
+        return np.full(len(winners), default)
+    return np.where(winners == NO_RULE, default, values[winners])
+
+
+class RuleEngine:
+    """Arrays describing every (Thermostat, enabled Rule) assignment.
+
+    Times are stored as microseconds since midnight, so that comparisons
+    behave exactly like the ones on datetime.time objects.
+
+    """
+
+    def __init__(
+        self,
+        thermostat_ids,
+        rule_ids,
+        rule_temperatures,
+        thermostat_index,
+        priority,
+        start,
+        end,
+        weekday_mask,
+    ):
+        # One entry per Thermostat.
+        self.thermostat_ids = np.asarray(thermostat_ids, dtype=np.int64)
+        # One entry per Rule, in precedence order (rule_ids[priority]).
+        self.rule_ids = np.asarray(rule_ids, dtype=np.int64)
+        self.rule_temperatures = np.asarray(rule_temperatures, dtype=np.float64)
+        # One entry per assignment.
+        self.thermostat_index = np.asarray(thermostat_index, dtype=np.int64)
+        self.priority = np.asarray(priority, dtype=np.int64)
+        self.start = np.asarray(start, dtype=np.int64)
+        self.end = np.asarray(end, dtype=np.int64)
+        self.weekday_mask = np.asarray(weekday_mask, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.priority)
+
+    @classmethod
+    def from_db(cls):
+        rules = list(
+            Rule.objects.filter(enabled=True)
+            .order_by(*RULE_PRECEDENCE)
+            .values_list("id", "start_time", "end_time", "temperature")
+        )
+        rule_priority = {rule_id: index for index, (rule_id, *_) in enumerate(rules)}
+
+        masks = dict.fromkeys(rule_priority, 0)
+        for rule_id, order in Rule.weekdays.through.objects.filter(
+            rule_id__in=rule_priority
+        ).values_list("rule_id", "weekday__order"):
+            masks[rule_id] |= 1 << order
+
+        thermostat_ids = list(
+            Thermostat.objects.order_by("id").values_list("id", flat=True)
+        )
+        thermostat_position = {pk: index for index, pk in enumerate(thermostat_ids)}
+
+        end_of_day = time_to_microseconds(END_OF_DAY)
+        times = {
+            rule_id: (
+                time_to_microseconds(start_time),
+                time_to_microseconds(end_time) if end_time else end_of_day,
+            )
+            for rule_id, start_time, end_time, _ in rules
+        }
+
+        thermostat_index, priority, start, end, weekday_mask = [], [], [], [], []
+        for thermostat_id, rule_id in Thermostat.rules.through.objects.filter(
+            rule_id__in=rule_priority
+        ).values_list("thermostat_id", "rule_id"):
+            thermostat_index.append(thermostat_position[thermostat_id])
+            priority.append(rule_priority[rule_id])
+            start.append(times[rule_id][0])
+            end.append(times[rule_id][1])
+            weekday_mask.append(masks[rule_id])
+
+        return cls(
+            thermostat_ids=thermostat_ids,
+            rule_ids=[rule[0] for rule in rules],
+            rule_temperatures=[rule[3] for rule in rules],
+            thermostat_index=thermostat_index,
+            priority=priority,
+            start=start,
+            end=end,
+            weekday_mask=weekday_mask,
+        )
+
+    def get_winning_priorities(self, now=None):
+        """Return the priority of the winning Rule per Thermostat, or NO_RULE."""
+        now = timezone.localtime(now)
+        now_time = time_to_microseconds(now.time())
+
+        on_weekday = (self.weekday_mask >> now.weekday()) & 1 == 1
+        after_start = self.start <= now_time
+        before_end = self.end >= now_time
+        wrapping = self.end < self.start
+        in_timeframe = np.where(
+            wrapping, after_start | before_end, after_start & before_end
+        )
+        matches = on_weekday & in_timeframe
+
+        winners = np.full(len(self.thermostat_ids), NO_RULE, dtype=np.int64)
+        np.maximum.at(winners, self.thermostat_index[matches], self.priority[matches])
+        return winners
+
+    def get_winning_rule_ids(self, now=None):
+        """Return a dict of Thermostat id to winning Rule id (or None)."""
+        winners = self.get_winning_priorities(now)
+        rule_ids = lookup(self.rule_ids, winners, NO_RULE)
+        return {
+            thermostat_id: (rule_id if rule_id != NO_RULE else None)
+            for thermostat_id, rule_id in zip(
+                self.thermostat_ids.tolist(), rule_ids.tolist()
+            )
+        }
+
+    def get_target_temperatures(self, now=None):
+        """Return a dict of Thermostat id to target temperature.
+
+        Thermostats without a matching Rule get the TEMPERATURE_FALLBACK.
+
+        """
+        winners = self.get_winning_priorities(now)
+        temperatures = lookup(
+            self.rule_temperatures, winners, settings.TEMPERATURE_FALLBACK
+        )
+        return dict(zip(self.thermostat_ids.tolist(), temperatures.tolist()))
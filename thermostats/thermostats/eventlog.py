@@ -0,0 +1,241 @@
+"""Emit every decision of the sync as a structured event to pluggable sinks.
+
+The colored log is meant to be read by humans. Next to it, the sync emits
+one flat dict per decision (device seen, rule matched or skipped, change
+applied, override detected, notification sent), tagged with the id of the
+sync run and the milliseconds since it started, so the history can be
+loaded into any tool that reads JSON lines.
+
+A sink is any object with write(event), flush() and close(). The sinks are
+built from the EVENT_LOG_* settings on first use:
+
+- JSONLinesSink appends one JSON object per line to EVENT_LOG_FILE,
+  wrapped in a BufferedSink (unless EVENT_LOG_BUFFERED is off), which
+  encodes and writes in a background thread.
+- RingBufferSink keeps the last EVENT_LOG_RING_SIZE events in memory and
+  on flush() merges the new ones into the buffer in Django's cache, shared
+  by all sync runs and shard workers, for the decisions.json view.
+- EVENT_LOG_SINKS names further sink classes, instantiated without
+  arguments.
+
+Without any sinks, emitting an event returns right away.
+
+"""
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger("thermostats.eventlog")
+
+RECENT_EVENTS_CACHE_KEY = "thermostats:recent_events"
+
+SYNC_STARTED = "sync_started"
+SYNC_FINISHED = "sync_finished"
+DEVICE_SEEN = "device_seen"
+DEVICE_SKIPPED = "device_skipped"
+RULE_MATCHED = "rule_matched"
+RULE_SKIPPED = "rule_skipped"
+DECISION = "decision"
+CHANGE_APPLIED = "change_applied"
+CHANGE_FAILED = "change_failed"
+OVERRIDE_DETECTED = "override_detected"
+NOTIFICATION_SENT = "notification_sent"
+
+
+def encode(event):
+    return json.dumps(event, default=str, separators=(",", ":"))
+
+
+class JSONLinesSink:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def write(self, event):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write(encode(event) + "\n")
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class BufferedSink:
+    """Hand events to a background thread writing them to the wrapped sink.
+
+    Events are dropped (and counted) rather than blocking the sync if the
+    sink can't keep up with maxsize events.
+
+    """
+
+    STOP = object()
+
+    def __init__(self, sink, maxsize=10000):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.thread = None
+
+    def write(self, event):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            event = self.queue.get()
+            try:
+                if event is self.STOP:
+                    return
+                self.sink.write(event)
+                if self.queue.empty():
+                    self.sink.flush()
+            except Exception:
+                logger.exception("Writing an event failed")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until all events written so far have been handed on."""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+        self.sink.flush()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(self.STOP)
+            self.thread.join()
+        self.sink.close()
+
+
+class RingBufferSink:
+    def __init__(self, size):
+        self.size = size
+        self.events = deque(maxlen=size)
+        self.unpublished = deque(maxlen=size)
+
+    def write(self, event):
+        self.events.append(event)
+        self.unpublished.append(event)
+
+    def get_events(self):
+        return list(self.events)
+
+    def flush(self):
+        if not self.unpublished:
+            return
+        # Other processes publish to the same buffer, keep their events.
+        events = sorted(
+            get_recent_events() + list(self.unpublished),
+            key=lambda event: event["at"],
+        )
+        cache.set(RECENT_EVENTS_CACHE_KEY, events[-self.size :], timeout=None)
+        self.unpublished.clear()
+
+    def close(self):
+        pass
+
+
+def get_recent_events():
+    """Return the events last published by a RingBufferSink, oldest first."""
+    return cache.get(RECENT_EVENTS_CACHE_KEY, [])
+
+
+def build_sinks():
+    sinks = []
+    if settings.EVENT_LOG_FILE:
+        sink = JSONLinesSink(settings.EVENT_LOG_FILE)
+        sinks.append(BufferedSink(sink) if settings.EVENT_LOG_BUFFERED else sink)
+    if settings.EVENT_LOG_RING_SIZE > 0:
+        sinks.append(RingBufferSink(settings.EVENT_LOG_RING_SIZE))
+    for path in settings.EVENT_LOG_SINKS:
+        sinks.append(import_string(path)())
+    return sinks
+
+
+class EventLog:
+    def __init__(self, sinks=None):
+        self.sinks = sinks
+        self.run_id = None
+        self.run_started_at = None
+
+    def get_sinks(self):
+        if self.sinks is None:
+            self.sinks = build_sinks()
+        return self.sinks
+
+    def start_run(self, **fields):
+        """Tag all following events with a new run id and elapsed time."""
+        self.run_id = uuid.uuid4().hex[:12]
+        self.run_started_at = time.perf_counter()
+        self.emit(SYNC_STARTED, **fields)
+        return self.run_id
+
+    def finish_run(self, **fields):
+        self.emit(SYNC_FINISHED, **fields)
+        self.run_id = None
+        self.run_started_at = None
+
+    def emit(self, kind, **fields):
+        sinks = self.get_sinks()
+        if not sinks:
+            return
+        event = {"event": kind, "at": timezone.now().isoformat()}
+        if self.run_id is not None:
+            event["run"] = self.run_id
+            event["elapsed_ms"] = round(
+                (time.perf_counter() - self.run_started_at) * 1000, 1
+            )
+        event.update(fields)
+        for sink in sinks:
+            sink.write(event)
+
+    @contextmanager
+    def timed(self, kind, **fields):
+        """Emit the event after the block with its duration_ms.
+
+        The block may add fields to the yielded dict, or set its "event" to
+        emit another kind instead, e.g. on failure.
+
+        """
+        started_at = time.perf_counter()
+        yield fields
+        fields["duration_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+        self.emit(fields.pop("event", kind), **fields)
+
+    def flush(self):
+        for sink in self.sinks or ():
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks or ():
+            sink.close()
+        self.sinks = None
+
+
+log = EventLog()
+emit = log.emit
+timed = log.timed
+start_run = log.start_run
+finish_run = log.finish_run
+flush = log.flush
@@ -0,0 +1,99 @@
+"""Publish thermostat events from the sync and fan them out to subscribers.
+
+The sync usually runs in a different process than the ASGI server, so the
+last EVENTS_BACKLOG events are kept as StreamEvents in the database. Their
+ids come from the database as well, which hands out each of them exactly
+once, even to concurrent sync workers, and independent of the cache
+backend (the default file based cache can't increment atomically).
+Within the ASGI process a single relay task polls for new events and hands
+them to all subscribers, so the number of clients doesn't add any load.
+
+"""
+import asyncio
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from thermostats.thermostats.models import StreamEvent
+
+logger = logging.getLogger("thermostats.events")
+
+EVENTS_BACKLOG = 100
+
+CHANGE_APPLIED = "change_applied"
+MANUAL_OVERRIDE = "manual_override"
+READINGS = "readings"
+
+
+def to_dict(stream_event):
+    return {
+        "id": stream_event.id,
+        "kind": stream_event.kind,
+        "at": stream_event.at.isoformat(),
+        "data": json.loads(stream_event.data),
+    }
+
+
+def publish(kind, data):
+    """Store an event under the next id and return it."""
+    stream_event = StreamEvent.objects.create(
+        kind=kind, at=timezone.now(), data=json.dumps(data, default=str)
+    )
+    StreamEvent.objects.filter(id__lte=stream_event.id - EVENTS_BACKLOG).delete()
+    return to_dict(stream_event)
+
+
+def get_last_event_id():
+    return StreamEvent.objects.order_by("-id").values_list("id", flat=True).first() or 0
+
+
+def get_events_since(last_id):
+    """Return all backlog events with an id greater than last_id."""
+    return [
+        to_dict(stream_event)
+        for stream_event in StreamEvent.objects.filter(id__gt=last_id).order_by("id")
+    ]
+
+
+class EventBroker:
+    """In-process pub/sub, fed by a relay task polling the backlog."""
+
+    def __init__(self, poll_interval=None, queue_size=100):
+        if poll_interval is None:
+            poll_interval = settings.EVENTS_POLL_INTERVAL
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.relay_task = None
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.add(queue)
+        if self.relay_task is None or self.relay_task.done():
+            self.relay_task = asyncio.ensure_future(self.relay())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def dispatch(self, event):
+        for queue in list(self.subscribers):
+            if queue.full():
+                # A slow client must not block everybody else.
+                logger.warning("Dropping event for a slow subscriber")
+                continue
+            queue.put_nowait(event)
+
+    async def relay(self):
+        last_id = await sync_to_async(get_last_event_id)()
+        while self.subscribers:
+            await asyncio.sleep(self.poll_interval)
+            for event in await sync_to_async(get_events_since)(last_id):
+                self.dispatch(event)
+                last_id = event["id"]
+
+
+broker = EventBroker()
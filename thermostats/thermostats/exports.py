@@ -0,0 +1,197 @@
+"""Stream ThermostatLogs out to CSV or Parquet files and bulk load them back.
+
+Rows are read with a server-side cursor in chunks and written as they come,
+so exporting years of history needs constant memory. Importing matches
+thermostats by AIN, creating missing ones, and inserts logs in batches.
+Rules and CalendarExceptions are instance specific and not linked on
+import, the logs keep their own copy of times and temperature though.
+
+"""
+import csv
+from datetime import datetime, time
+from itertools import islice
+
+from django.db import transaction
+
+from thermostats.thermostats.models import Thermostat, ThermostatLog
+from thermostats.thermostats.reports import rebuild_daily_setpoints
+
+# (column, ORM lookup) of an exported log.
+LOG_COLUMNS = (
+    ("created_at", "created_at"),
+    ("thermostat_ain", "thermostat__ain"),
+    ("thermostat_name", "thermostat__name"),
+    ("rule_id", "rule_id"),
+    ("rule_name", "rule__name"),
+    ("exception_name", "exception__name"),
+    ("start_time", "start_time"),
+    ("end_time", "end_time"),
+    ("temperature", "temperature"),
+    ("actual_temperature", "actual_temperature"),
+    ("warmup_reached_at", "warmup_reached_at"),
+    ("applied", "applied"),
+)
+COLUMN_NAMES = [column for column, _ in LOG_COLUMNS]
+
+DATETIME_COLUMNS = {"created_at", "warmup_reached_at"}
+TIME_COLUMNS = {"start_time", "end_time"}
+FLOAT_COLUMNS = {"temperature", "actual_temperature"}
+
+
+def iter_log_rows(start=None, end=None, chunk_size=2000):
+    """Yield logs created within [start, end) as dicts, oldest first."""
+    logs = ThermostatLog.objects.order_by("created_at", "id")
+    if start is not None:
+        logs = logs.filter(created_at__gte=start)
+    if end is not None:
+        logs = logs.filter(created_at__lt=end)
+    values = logs.values_list(*(lookup for _, lookup in LOG_COLUMNS))
+    for row in values.iterator(chunk_size=chunk_size):
+        yield dict(zip(COLUMN_NAMES, row))
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (datetime, time)):
+        return value.isoformat()
+    return value
+
+
+def write_csv(rows, f):
+    """Write the rows to the open text file, return the number written."""
+    writer = csv.DictWriter(f, fieldnames=COLUMN_NAMES)
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow({column: format_value(value) for column, value in row.items()})
+        count += 1
+    return count
+
+
+def get_parquet_schema(pa):
+    types = {
+        "created_at": pa.timestamp("us", tz="UTC"),
+        "warmup_reached_at": pa.timestamp("us", tz="UTC"),
+        "start_time": pa.time64("us"),
+        "end_time": pa.time64("us"),
+        "rule_id": pa.int64(),
+        "temperature": pa.float64(),
+        "actual_temperature": pa.float64(),
+        "applied": pa.bool_(),
+    }
+    return pa.schema(
+        [(column, types.get(column, pa.string())) for column in COLUMN_NAMES]
+    )
+
+
+def write_parquet(rows, path, chunk_size=2000):
+    """Write the rows to a Parquet file, one row group per chunk.
+
+    Needs pyarrow, an optional requirement (see requirements-parquet.in).
+
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = get_parquet_schema(pa)
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunked(rows, chunk_size):
+            columns = {
+                column: [row[column] for row in chunk] for column in COLUMN_NAMES
+            }
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            count += len(chunk)
+    return count
+
+
+def parse_value(column, value):
+    if value == "" or value is None:
+        return None
+    if not isinstance(value, str):
+        return value
+    if column in DATETIME_COLUMNS:
+        return datetime.fromisoformat(value)
+    if column in TIME_COLUMNS:
+        return time.fromisoformat(value)
+    if column in FLOAT_COLUMNS:
+        return float(value)
+    if column == "applied":
+        return value in ("True", "true", "1")
+    return value
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield {column: parse_value(column, row.get(column)) for column in COLUMN_NAMES}
+
+
+def read_parquet(path, chunk_size=2000):
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        yield from batch.to_pylist()
+
+
+def import_log_rows(rows, batch_size=1000):
+    """Insert the rows as ThermostatLogs with bulk_create, return the count.
+
+    Logs that already exist (same thermostat and created_at) are skipped, so
+    importing a file twice is harmless. The DailySetpoints are rebuilt
+    afterwards, as bulk_create bypasses the signal maintaining them.
+
+    """
+    thermostats = {
+        thermostat.ain: thermostat for thermostat in Thermostat.objects.all()
+    }
+    imported = 0
+    with transaction.atomic():
+        for chunk in chunked(rows, batch_size):
+            for row in chunk:
+                ain = row["thermostat_ain"]
+                if ain not in thermostats:
+                    thermostats[ain] = Thermostat.objects.create(
+                        ain=ain, name=row["thermostat_name"] or ain
+                    )
+
+            existing = set(
+                ThermostatLog.objects.filter(
+                    thermostat__in={
+                        thermostats[row["thermostat_ain"]] for row in chunk
+                    },
+                    created_at__in={row["created_at"] for row in chunk},
+                ).values_list("thermostat_id", "created_at")
+            )
+            logs = []
+            for row in chunk:
+                thermostat = thermostats[row["thermostat_ain"]]
+                if (thermostat.id, row["created_at"]) in existing:
+                    continue
+                logs.append(
+                    ThermostatLog(
+                        thermostat=thermostat,
+                        created_at=row["created_at"],
+                        start_time=row["start_time"],
+                        end_time=row["end_time"],
+                        temperature=row["temperature"],
+                        actual_temperature=row["actual_temperature"],
+                        warmup_reached_at=row["warmup_reached_at"],
+                        applied=True if row["applied"] is None else row["applied"],
+                    )
+                )
+            ThermostatLog.objects.bulk_create(logs, batch_size=batch_size)
+            imported += len(logs)
+
+        if imported:
+            rebuild_daily_setpoints()
+    return imported
@@ -0,0 +1,161 @@
+"""Track how well the Fritz!Box responds and alert once when that changes.
+
+Every login, device list and set call is timed and recorded as
+a sample in Django's cache, so the sync, the thermostat_health command and
+the health.json view all see the same numbers. Samples older than
+HEALTH_WINDOW_SECONDS are dropped. Concurrent runs may occasionally lose a
+sample, which doesn't matter for these statistics.
+
+check_health() compares the window against the budgets and sends a push
+notification only when the box turns unhealthy and when it recovers. To
+not alert on a handful of calls, latencies and error rates are ignored
+below HEALTH_MIN_CALLS calls of an operation. And once unhealthy, the
+limits are lowered by HEALTH_RECOVERY_FACTOR, so values hovering around a
+limit don't flap between the two.
+
+"""
+import math
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+HEALTH_CACHE_KEY = "thermostats:health"
+HEALTH_ALERT_CACHE_KEY = "thermostats:health:alerted"
+
+LOGIN = "login"
+DEVICES = "devices"
+SET = "set"
+OPERATIONS = (LOGIN, DEVICES, SET)
+
+# Consecutive failures after which the box is considered down.
+DOWN_AFTER_FAILURES = 3
+
+
+def is_sid_invalidation(error):
+    """Whether the box rejected the session, i.e. the SID has been invalidated."""
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) == 403
+
+
+def record_call(operation, duration, error=None, now=None):
+    now = now or timezone.now()
+    cutoff = now.timestamp() - settings.HEALTH_WINDOW_SECONDS
+    samples = [
+        sample for sample in cache.get(HEALTH_CACHE_KEY, []) if sample[1] >= cutoff
+    ]
+    samples.append(
+        (
+            operation,
+            now.timestamp(),
+            round(duration * 1000, 1),
+            error is None,
+            error is not None and is_sid_invalidation(error),
+        )
+    )
+    cache.set(HEALTH_CACHE_KEY, samples, timeout=None)
+
+
+@contextmanager
+def measure(operation):
+    """Record the duration and outcome of the call(s) within."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_call(operation, time.perf_counter() - started_at, error=e)
+        raise
+    record_call(operation, time.perf_counter() - started_at)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of the sorted values."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def is_alerted():
+    """Whether the box has last been alerted as unhealthy."""
+    return not cache.get(HEALTH_ALERT_CACHE_KEY, True)
+
+
+def get_health_report(now=None):
+    now = now or timezone.now()
+    factor = settings.HEALTH_RECOVERY_FACTOR if is_alerted() else 1
+    latency_budget = settings.HEALTH_LATENCY_BUDGET_MS * factor
+    max_error_rate = settings.HEALTH_MAX_ERROR_RATE * factor
+    max_sid_invalidations = settings.HEALTH_MAX_SID_INVALIDATIONS * factor
+    cutoff = now.timestamp() - settings.HEALTH_WINDOW_SECONDS
+    samples = [
+        sample for sample in cache.get(HEALTH_CACHE_KEY, []) if sample[1] >= cutoff
+    ]
+
+    operations = {}
+    problems = []
+    for operation in OPERATIONS:
+        selected = [sample for sample in samples if sample[0] == operation]
+        latencies = sorted(sample[2] for sample in selected)
+        errors = sum(1 for sample in selected if not sample[3])
+        stats = {
+            "calls": len(selected),
+            "errors": errors,
+            "error_rate": round(errors / len(selected), 3) if selected else None,
+            "p50_ms": percentile(latencies, 0.5),
+            "p95_ms": percentile(latencies, 0.95),
+        }
+        operations[operation] = stats
+
+        if len(selected) < settings.HEALTH_MIN_CALLS:
+            continue
+        if stats["p95_ms"] > latency_budget:
+            problems.append(
+                f"p95 {operation} latency {stats['p95_ms']:.0f} ms "
+                f"over budget of {latency_budget:.0f} ms"
+            )
+        if stats["error_rate"] > max_error_rate:
+            problems.append(f"{operation} failed {errors} of {len(selected)} time(s)")
+
+    sid_invalidations = sum(1 for sample in samples if sample[4])
+    if sid_invalidations > max_sid_invalidations:
+        problems.append(f"session invalidated {sid_invalidations} time(s)")
+
+    recent = [sample[3] for sample in samples[-DOWN_AFTER_FAILURES:]]
+    down = len(recent) == DOWN_AFTER_FAILURES and not any(recent)
+    if down:
+        problems.insert(0, f"last {DOWN_AFTER_FAILURES} calls failed")
+
+    return {
+        "generated_at": now.isoformat(),
+        "window_seconds": settings.HEALTH_WINDOW_SECONDS,
+        "healthy": not problems,
+        "down": down,
+        "problems": problems,
+        "sid_invalidations": sid_invalidations,
+        "operations": operations,
+    }
+
+
+def check_health(notify, now=None):
+    """Alert through notify(message, title=...) when the health changes.
+
+    Returns the report. Only transitions are alerted, so an outage results
+    in one notification when it starts and one when it is over.
+
+    """
+    report = get_health_report(now)
+    was_healthy = not is_alerted()
+    if report["healthy"] != was_healthy:
+        if report["healthy"]:
+            notify(
+                "All Fritz!Box calls are back to normal", title="Fritz!Box recovered"
+            )
+        else:
+            notify(
+                "\n".join(report["problems"]),
+                title="Fritz!Box down" if report["down"] else "Fritz!Box degraded",
+            )
+        cache.set(HEALTH_ALERT_CACHE_KEY, report["healthy"], timeout=None)
+    return report
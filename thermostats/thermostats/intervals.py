@@ -0,0 +1,86 @@
+"""Logarithmic lookups of dated periods, used for CalendarExceptions."""
+from bisect import bisect_left, bisect_right
+
+from django.utils import timezone
+
+
+class IntervalIndex:
+    """Half-open [start, end) intervals sorted by start.
+
+    Alongside the sorted starts we keep the running maximum of the ends,
+    which answers "does any interval contain t / overlap [a, b)" with a
+    single binary search.
+
+    """
+
+    def __init__(self, intervals):
+        """intervals is an iterable of (start, end, value) tuples."""
+        self.intervals = sorted(intervals, key=lambda interval: interval[0])
+        self.starts = [start for start, _, _ in self.intervals]
+        self.max_ends = []
+        max_end = None
+        for _, end, _ in self.intervals:
+            max_end = end if max_end is None else max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def any_overlapping(self, start, end):
+        """Whether any interval overlaps [start, end)."""
+        index = bisect_left(self.starts, end)
+        return index > 0 and self.max_ends[index - 1] > start
+
+    def any_at(self, moment):
+        """Whether any interval contains the given moment."""
+        index = bisect_right(self.starts, moment)
+        return index > 0 and self.max_ends[index - 1] > moment
+
+    def at(self, moment):
+        """Return the values of all intervals containing moment, latest start first.
+
+        Only the candidates that can still contain the moment are visited.
+
+        """
+        values = []
+        index = bisect_right(self.starts, moment) - 1
+        while index >= 0 and self.max_ends[index] > moment:
+            _, end, value = self.intervals[index]
+            if end > moment:
+                values.append(value)
+            index -= 1
+        return values
+
+
+class ExceptionCalendar:
+    """The enabled CalendarExceptions that have not ended yet, indexed."""
+
+    def __init__(self, exceptions):
+        self.index = IntervalIndex(
+            (exception.start, exception.end, exception) for exception in exceptions
+        )
+
+    @classmethod
+    def load(cls, now=None):
+        from thermostats.thermostats.models import CalendarException
+
+        now = now or timezone.now()
+        exceptions = CalendarException.objects.filter(
+            enabled=True, end__gt=now
+        ).prefetch_related("thermostats")
+        return cls(exceptions)
+
+    def get_active_exception(self, thermostat, now=None):
+        """Return the CalendarException in effect for thermostat, or None.
+
+        If several apply, the one that started last wins.
+
+        """
+        now = now or timezone.now()
+        if not self.index.any_at(now):
+            return None
+        for exception in self.index.at(now):
+            thermostat_ids = {t.id for t in exception.thermostats.all()}
+            if not thermostat_ids or thermostat.id in thermostat_ids:
+                return exception
+        return None
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from thermostats.thermostats.analysis import analyze_thermostat, format_minute_of_week
+from thermostats.thermostats.models import Thermostat
+from thermostats.thermostats.temperatures import describe_temperature
+
+
+class Command(BaseCommand):
+    help = "Report overlapping, shadowed and missing rules per thermostat"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--schedule",
+            action="store_true",
+            help="Also print the effective weekly schedule",
+        )
+        parser.add_argument(
+            "--strict",
+            action="store_true",
+            help="Exit with an error if any rule is shadowed or overlapping",
+        )
+
+    def handle(self, *args, **options):
+        warning_count = 0
+        for thermostat in Thermostat.objects.order_by("name"):
+            analysis = analyze_thermostat(thermostat)
+            self.stdout.write(self.style.MIGRATE_HEADING(str(thermostat)))
+
+            for warning in analysis.warnings:
+                self.stdout.write(self.style.WARNING(f"  {warning}"))
+            warning_count += len(analysis.warnings)
+
+            fallback = describe_temperature(settings.TEMPERATURE_FALLBACK)
+            for start, end in analysis.gaps:
+                self.stdout.write(
+                    f"  fallback ({fallback}): {format_minute_of_week(start)} - "
+                    f"{format_minute_of_week(end)}"
+                )
+
+            if options["schedule"]:
+                for start, end, rule in analysis.schedule:
+                    self.stdout.write(
+                        f"  {format_minute_of_week(start)} - "
+                        f"{format_minute_of_week(end)}: {rule or 'fallback'}"
+                    )
+
+        if options["strict"] and warning_count:
+            raise CommandError(f"{warning_count} rule warning(s)")
@@ -0,0 +1,49 @@
+import sys
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from thermostats.thermostats.exports import iter_log_rows, write_csv, write_parquet
+from thermostats.thermostats.management.commands.heating_report import parse_date
+
+
+def get_start_of_day(value):
+    return timezone.make_aware(datetime.combine(value, time(0, 0)))
+
+
+class Command(BaseCommand):
+    help = "Export thermostat logs as CSV or Parquet, see import_logs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", help="YYYY-MM-DD, first day to export")
+        parser.add_argument("--end", help="YYYY-MM-DD, last day to export")
+        parser.add_argument("--format", choices=("csv", "parquet"), default="csv")
+        parser.add_argument(
+            "--output", help="File to write to, CSV defaults to standard output"
+        )
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        start = end = None
+        if options["start"]:
+            start = get_start_of_day(parse_date(options["start"]))
+        if options["end"]:
+            end = get_start_of_day(parse_date(options["end"]) + timedelta(days=1))
+        rows = iter_log_rows(start, end, chunk_size=options["chunk_size"])
+
+        if options["format"] == "parquet":
+            if not options["output"]:
+                raise CommandError("Parquet needs an --output file")
+            try:
+                count = write_parquet(rows, options["output"], options["chunk_size"])
+            except ImportError:
+                raise CommandError("Parquet export needs pyarrow to be installed")
+        elif options["output"]:
+            with open(options["output"], "w", newline="", encoding="utf-8") as f:
+                count = write_csv(rows, f)
+        else:
+            count = write_csv(rows, self.stdout)
+
+        if options["output"]:
+            self.stdout.write(f"Exported {count} log(s) to {options['output']}")
@@ -0,0 +1,57 @@
+import calendar
+from datetime import date, datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from thermostats.thermostats.reports import get_heating_report, rebuild_daily_setpoints
+from thermostats.thermostats.temperatures import describe_temperature
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise CommandError(f"Invalid date {value!r}, expected YYYY-MM-DD")
+
+
+def get_month_range(value):
+    try:
+        month = datetime.strptime(value, "%Y-%m").date()
+    except ValueError:
+        raise CommandError(f"Invalid month {value!r}, expected YYYY-MM")
+    last_day = calendar.monthrange(month.year, month.month)[1]
+    return month, date(month.year, month.month, last_day)
+
+
+class Command(BaseCommand):
+    help = "Show the hours each thermostat spent at each setpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--month", help="YYYY-MM, defaults to the current month")
+        parser.add_argument("--start", help="YYYY-MM-DD, instead of --month")
+        parser.add_argument("--end", help="YYYY-MM-DD, instead of --month")
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Recompute the aggregates from all logs first",
+        )
+
+    def handle(self, *args, **options):
+        if options["rebuild"]:
+            rebuild_daily_setpoints()
+
+        if options["start"] or options["end"]:
+            today = timezone.localdate()
+            start = parse_date(options["start"]) if options["start"] else today
+            end = parse_date(options["end"]) if options["end"] else today
+        else:
+            month = options["month"] or timezone.localdate().strftime("%Y-%m")
+            start, end = get_month_range(month)
+
+        self.stdout.write(f"{start} - {end}")
+        for row in get_heating_report(start, end):
+            self.stdout.write(
+                f"{row['name']:<24} {describe_temperature(row['temperature']):>10} "
+                f"{row['hours']:>8.2f} h"
+            )
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from thermostats.thermostats.exports import import_log_rows, read_csv, read_parquet
+
+
+class Command(BaseCommand):
+    help = "Import thermostat logs written by export_logs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or Parquet (.parquet) file")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if path.endswith(".parquet"):
+            try:
+                count = import_log_rows(read_parquet(path), options["batch_size"])
+            except ImportError:
+                raise CommandError("Parquet import needs pyarrow to be installed")
+        else:
+            with open(path, newline="", encoding="utf-8") as f:
+                count = import_log_rows(read_csv(f), options["batch_size"])
+        self.stdout.write(f"Imported {count} log(s) from {path}")
@@ -0,0 +1,65 @@
+import logging
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from thermostats.thermostats.cassettes import Player, load_cassette, load_snapshot
+
+logger = logging.getLogger("thermostats.replay")
+
+
+class Command(BaseCommand):
+    help = "Run sync_thermostats against traffic recorded with --record"
+
+    def add_arguments(self, parser):
+        parser.add_argument("cassette")
+        parser.add_argument(
+            "--speed",
+            type=float,
+            default=1.0,
+            help="Replay latencies this many times faster, 0 means no waiting",
+        )
+        parser.add_argument(
+            "--load-snapshot",
+            action="store_true",
+            help="Replace all rules and thermostats with the recorded snapshot",
+        )
+        parser.add_argument(
+            "--at-recorded-time",
+            action="store_true",
+            help="Pretend it is the time of recording (requires freezegun)",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            cassette = load_cassette(options["cassette"])
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Can't load cassette: {e}")
+
+        if options["load_snapshot"]:
+            load_snapshot(cassette["snapshot"])
+            logger.info("Loaded rules snapshot from cassette")
+
+        clock = None
+        if options["at_recorded_time"]:
+            try:
+                from freezegun import freeze_time
+            except ImportError:
+                raise CommandError("--at-recorded-time requires freezegun")
+            clock = freeze_time(cassette["recorded_at"], tick=True)
+            clock.start()
+
+        started_at = time.perf_counter()
+        try:
+            with Player(cassette["interactions"], speed=options["speed"]) as player:
+                call_command("sync_thermostats")
+        finally:
+            if clock is not None:
+                clock.stop()
+        elapsed = time.perf_counter() - started_at
+
+        logger.info(
+            f"Replayed {player.played} exchange(s) in {elapsed:.3f}s, "
+            f"{player.remaining} left unused"
+        )
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from thermostats.thermostats.polling import Scheduler
+from thermostats.thermostats.shards import ShardWorker, release_shards
+
+
+class Command(BaseCommand):
+    help = "Keep syncing thermostats, polling more often when it matters"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--cycles", type=int, help="Stop after this many syncs (default: never)"
+        )
+        parser.add_argument(
+            "--worker",
+            action="store_true",
+            help=(
+                "Only sync the shards of thermostats this process holds a lease "
+                "on, so several workers can share the load (see SYNC_SHARDS)"
+            ),
+        )
+        parser.add_argument(
+            "--name", help="Name of the worker (default: hostname and process id)"
+        )
+
+    def handle(self, *args, **options):
+        if not options["worker"]:
+            Scheduler().run(cycles=options["cycles"])
+            return
+
+        worker = ShardWorker(name=options["name"])
+        try:
+            Scheduler(sync=worker, max_interval=worker.max_interval).run(
+                cycles=options["cycles"]
+            )
+        finally:
+            release_shards(worker.name)
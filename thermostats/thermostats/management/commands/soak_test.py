@@ -0,0 +1,276 @@
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from thermostats.thermostats.polling import Scheduler
+from thermostats.thermostats.soak import (
+    FakeFritzbox,
+    count_open_sockets,
+    count_rows,
+    create_rooms,
+    get_database_size,
+    get_growth,
+    get_growth_rate,
+    get_rss_bytes,
+)
+
+SYNC_MODULE = "thermostats.thermostats.management.commands.sync_thermostats"
+
+MB = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the scheduler against a simulated Fritz!Box at an accelerated "
+        "clock and fail if memory, sync latency or storage keep growing"
+    )
+
+    # Passed on to the process running the simulation.
+    FORWARDED_OPTIONS = (
+        "days",
+        "rooms",
+        "seed",
+        "manual_change_rate",
+        "failure_rate",
+        "wakeup_minutes",
+        "max_memory_growth",
+        "max_latency_growth",
+        "max_storage_growth",
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=30, help="Simulated days")
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--manual-change-rate",
+            type=float,
+            default=0.002,
+            help="Probability of a manual change per device and sync",
+        )
+        parser.add_argument(
+            "--failure-rate",
+            type=float,
+            default=0.01,
+            help="Probability of a failing write",
+        )
+        parser.add_argument(
+            "--wakeup-minutes",
+            type=float,
+            default=3,
+            help="Maximum delay until a device takes over a new setpoint",
+        )
+        parser.add_argument(
+            "--max-memory-growth",
+            type=float,
+            default=20,
+            help="Maximum growth of the resident memory in MB",
+        )
+        parser.add_argument(
+            "--max-latency-growth",
+            type=float,
+            default=1.5,
+            help="Maximum factor by which the median sync latency may grow",
+        )
+        parser.add_argument(
+            "--max-storage-growth",
+            type=float,
+            default=1.5,
+            help=(
+                "Maximum factor by which the rows and database bytes added per "
+                "simulated day may grow"
+            ),
+        )
+        parser.add_argument(
+            "--database",
+            help="SQLite file to simulate in and keep, defaults to a temporary one",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the temporary simulation database instead of deleting it",
+        )
+        parser.add_argument("--simulate", action="store_true", help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options["simulate"]:
+            self.simulate(options)
+        else:
+            self.run_isolated(options)
+
+    def run_isolated(self, options):
+        """Run the simulation in a process of its own with a separate database.
+
+        The simulation writes for minutes, which must neither block nor
+        touch the real database.
+
+        """
+        path = options["database"]
+        if path is None:
+            path = os.path.join(tempfile.mkdtemp(prefix="soak-"), "soak.sqlite3")
+        env = dict(os.environ, DB_ENGINE="django.db.backends.sqlite3", DB_NAME=path)
+        manage_py = os.path.join(settings.BASE_DIR, "manage.py")
+        arguments = [
+            f"--{name.replace('_', '-')}={options[name]}"
+            for name in self.FORWARDED_OPTIONS
+        ]
+        arguments.append(f"--verbosity={options['verbosity']}")
+        try:
+            subprocess.run(
+                [sys.executable, manage_py, "migrate", "--verbosity=0"],
+                env=env,
+                check=True,
+            )
+            process = subprocess.Popen(
+                [sys.executable, manage_py, "soak_test", "--simulate", *arguments],
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+            )
+            for line in process.stdout:
+                self.stdout.write(line, ending="")
+            if process.wait() != 0:
+                raise CommandError("The soak test failed, see above")
+        finally:
+            if options["keep"] or options["database"]:
+                self.stdout.write(f"Kept the simulation database {path}")
+            else:
+                shutil.rmtree(os.path.dirname(path))
+
+    def simulate(self, options):
+        try:
+            from freezegun import freeze_time
+        except ImportError:
+            raise CommandError("The soak test needs freezegun to be installed")
+        from django.test import override_settings
+
+        # Status, events and health of the simulation must not leak into
+        # the real cache, neither must notifications be sent.
+        isolated_cache = override_settings(
+            CACHES={
+                "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+            }
+        )
+        if options["verbosity"] < 2:
+            # The sync logs every decision, thousands of them.
+            logging.disable(logging.WARNING)
+        started_at = timezone.now()
+        try:
+            with isolated_cache, freeze_time(started_at, ignore=[__name__]) as clock:
+                samples = self.run_simulation(options, clock)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.check_trends(samples, options)
+
+    def run_simulation(self, options, clock):
+        devices = create_rooms(options["rooms"])
+        fritzbox = FakeFritzbox(
+            devices,
+            seed=options["seed"],
+            manual_change_rate=options["manual_change_rate"],
+            failure_rate=options["failure_rate"],
+            wakeup_minutes=options["wakeup_minutes"],
+        )
+        end = timezone.now() + timedelta(days=options["days"])
+        samples = []
+
+        def sync():
+            started_at = time.perf_counter()
+            call_command("sync_thermostats")
+            samples.append(
+                {
+                    "at": timezone.now(),
+                    "latency": time.perf_counter() - started_at,
+                    "rss": get_rss_bytes(),
+                    "sockets": count_open_sockets(),
+                    "database": get_database_size(),
+                    "rows": count_rows(),
+                }
+            )
+            if len(samples) % 500 == 0:
+                self.report(samples[-500:])
+
+        def sleep(seconds):
+            clock.tick(timedelta(seconds=seconds))
+
+        with mock.patch(
+            f"{SYNC_MODULE}.get_fritzbox_connection", lambda: fritzbox
+        ), mock.patch(
+            f"{SYNC_MODULE}.get_fritzbox_thermostat_devices", fritzbox.get_devices
+        ), mock.patch(
+            f"{SYNC_MODULE}.send_push_notification", lambda *a, **k: None
+        ):
+            scheduler = Scheduler(sync=sync, sleep=sleep)
+            while timezone.now() < end:
+                scheduler.run(cycles=scheduler.cycles + 1)
+        return samples
+
+    def report(self, samples):
+        last = samples[-1]
+        latencies = sorted(sample["latency"] for sample in samples)
+        rss = last["rss"] / MB if last["rss"] is not None else float("nan")
+        database = (
+            f"{last['database'] / MB:.1f} MB" if last["database"] is not None else "-"
+        )
+        self.stdout.write(
+            f"{timezone.localtime(last['at']):%Y-%m-%d %H:%M}  "
+            f"p50 {latencies[len(latencies) // 2] * 1000:6.1f} ms  "
+            f"rss {rss:6.1f} MB  sockets {last['sockets']}  "
+            f"db {database}  rows {last['rows']}"
+        )
+
+    def check_trends(self, samples, options):
+        self.stdout.write(f"{len(samples)} sync(s) run")
+        problems = []
+
+        memory = get_growth([sample["rss"] for sample in samples])
+        if memory is not None:
+            growth = (memory[1] - memory[0]) / MB
+            self.stdout.write(f"Memory grew by {growth:.1f} MB")
+            if growth > options["max_memory_growth"]:
+                problems.append(f"memory grew by {growth:.1f} MB")
+
+        latency = get_growth([sample["latency"] for sample in samples])
+        if latency is not None and latency[0] > 0:
+            factor = latency[1] / latency[0]
+            self.stdout.write(
+                f"Median sync latency changed by a factor of {factor:.2f}"
+            )
+            if factor > options["max_latency_growth"]:
+                problems.append(f"sync latency grew by a factor of {factor:.2f}")
+
+        sockets = get_growth([sample["sockets"] for sample in samples])
+        if sockets is not None and sockets[1] > sockets[0]:
+            problems.append(f"open sockets grew from {sockets[0]} to {sockets[1]}")
+
+        # Logs pile up by design, but each day should add about as much.
+        for key, description in (("rows", "rows"), ("database", "database bytes")):
+            rate = get_growth_rate(samples, key)
+            if rate is None or rate[0] <= 0:
+                continue
+            factor = rate[1] / rate[0]
+            self.stdout.write(
+                f"{description.capitalize()} added per day changed by a factor "
+                f"of {factor:.2f}"
+            )
+            if factor > options["max_storage_growth"]:
+                problems.append(
+                    f"{description} added per day grew by a factor of {factor:.2f}"
+                )
+
+        if problems:
+            raise CommandError("; ".join(problems))
+        self.stdout.write(self.style.SUCCESS("No upward trends"))
@@ -1,48 +1,66 @@
 import logging
+from datetime import timedelta
+from functools import partial
 from pprint import pprint
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 
-from pushover import Client
-from pyfritzhome import Fritzhome
-from thermostats.thermostats.models import Thermostat, ThermostatLog, WeekDay
+from thermostats.thermostats import eventlog, events, health
+from thermostats.thermostats.db import lock_thermostat
+from thermostats.thermostats.intervals import ExceptionCalendar
+from thermostats.thermostats.models import (
+    DeviceCommand,
+    ManualOverride,
+    Thermostat,
+    ThermostatLog,
+    WeekDay,
+)
+from thermostats.thermostats.outbox import (
+    enqueue_command,
+    expire_unconfirmed_commands,
+    has_sent_commands,
+    process_due_commands,
+    send_command,
+    supersede_stale_commands,
+    verify_sent_commands,
+)
+from thermostats.thermostats.rulecache import winners
+from thermostats.thermostats.ruleset import rulesets
+from thermostats.thermostats.schedule import get_current_setpoints, refresh_schedule
+from thermostats.thermostats.shards import get_shard
+from thermostats.thermostats.status import build_thermostat_status, store_status
+from thermostats.thermostats.temperatures import (
+    describe_temperature,
+    temperatures_equal,
+)
+from thermostats.thermostats.writes import WriteCoalescer
 
 TIME_FORMAT = settings.TIME_INPUT_FORMATS[0]
 
 logger = logging.getLogger("thermostats.sync")
 
 
-def describe_temperature(temperature):
-    """Return a string description of the given temperature."""
-    if temperature == settings.TEMPERATURE_OFF:
-        return "off"
-    return f"{temperature} °C"
-
-
-def temperatures_equal(t1, t2):
-    """Handle 'off' reported as 126.5, but must be set as 0."""
-    if t1 == settings.TEMPERATURE_OFF:
-        t1 = 0
-    if t2 == settings.TEMPERATURE_OFF:
-        t2 = 0
-    return t1 == t2
-
-
 def get_fritzbox_connection(
     host=settings.FRITZBOX_HOST,
     user=settings.FRITZBOX_USER,
     password=settings.FRITZBOX_PASSWORD,
 ):
+    # Imported here, since it is costly and not needed on every run.
+    from pyfritzhome import Fritzhome
+
     fritzbox = Fritzhome(host, user, password)
-    fritzbox.login()
+    with health.measure(health.LOGIN):
+        fritzbox.login()
     return fritzbox
 
 
 def get_fritzbox_thermostat_devices():
     fritzbox = get_fritzbox_connection()
-    return [device for device in fritzbox.get_devices() if device.has_thermostat]
+    with health.measure(health.DEVICES):
+        devices = fritzbox.get_devices()
+    return [device for device in devices if device.has_thermostat]
 
 
 def send_push_notification(message, title=None):
@@ -50,31 +68,96 @@ def send_push_notification(message, title=None):
         if title:
             logger.info(title)
         logger.info(message)
+        eventlog.emit(eventlog.NOTIFICATION_SENT, title=title, channel="log")
         return
-    client = Client(settings.PUSHOVER_USER_KEY, api_token=settings.PUSHOVER_API_TOKEN)
-    client.send_message(message, title=title)
+
+    from pushover import Client
+
+    with eventlog.timed(eventlog.NOTIFICATION_SENT, title=title, channel="pushover"):
+        client = Client(
+            settings.PUSHOVER_USER_KEY, api_token=settings.PUSHOVER_API_TOKEN
+        )
+        client.send_message(message, title=title)
 
 
 def change_thermostat_target_temperature(
-    thermostat, new_target_temperature, rule=None, notify=True
+    thermostat,
+    new_target_temperature,
+    rule=None,
+    notify=True,
+    actual_temperature=None,
+    exception=None,
 ):
-    ThermostatLog.objects.create(
-        thermostat=thermostat,
+    """Queue and send the change, return whether it has been sent."""
+    command = record_thermostat_change(
+        thermostat,
+        new_target_temperature,
         rule=rule,
+        actual_temperature=actual_temperature,
+        exception=exception,
+    )
+    return send_thermostat_change(
+        thermostat, command, rule=rule, exception=exception, notify=notify
+    )
+
+
+def record_thermostat_change(
+    thermostat,
+    new_target_temperature,
+    rule=None,
+    actual_temperature=None,
+    exception=None,
+):
+    """Log the change and queue its DeviceCommand, return the command."""
+    log = ThermostatLog.objects.create(
+        thermostat=thermostat,
+        rule_id=rule.id if rule else None,
+        exception=exception,
         start_time=rule.start_time if rule else None,
         end_time=rule.end_time if rule else None,
         temperature=new_target_temperature,
+        actual_temperature=actual_temperature,
+        applied=False,
     )
+    return enqueue_command(log)
 
-    fritzbox = get_fritzbox_connection()
-    fritzbox.set_target_temperature(thermostat.ain, new_target_temperature)
+
+def send_thermostat_change(thermostat, command, rule=None, exception=None, notify=True):
+    """Send a queued change and notify about it, return whether it was sent."""
+    new_target_temperature = command.temperature
+    with eventlog.timed(
+        eventlog.CHANGE_APPLIED,
+        thermostat=thermostat.id,
+        temperature=new_target_temperature,
+        rule=rule.id if rule else None,
+        exception=exception.id if exception else None,
+    ) as fields:
+        fritzbox = get_fritzbox_connection()
+        sent = send_command(command, fritzbox)
+        if not sent:
+            fields["event"] = eventlog.CHANGE_FAILED
+            fields["error"] = command.last_error
+    if not sent:
+        return False
+
+    events.publish(
+        events.CHANGE_APPLIED,
+        {
+            "thermostat": thermostat.id,
+            "name": thermostat.name,
+            "temperature": new_target_temperature,
+            "rule": rule.id if rule else None,
+        },
+    )
 
     message = (
         f"{thermostat.name} is now set to "
         f"{describe_temperature(new_target_temperature)}"
     )
     if rule:
-        message += f" by applying {rule}"
+        message += f" by applying {rule.description}"
+    elif exception:
+        message += f" by applying {exception}"
     else:
         message += f" by using the fallback"
     logger.warn(message)
@@ -87,18 +170,290 @@ def change_thermostat_target_temperature(
                 f"{describe_temperature(new_target_temperature)}"
             ),
         )
+    return True
+
+
+def apply_thermostat_change(thermostat, new_target_temperature, started_at, **kwargs):
+    """Change the target temperature, unless another run did since started_at.
+
+    Deciding, logging and queueing happens while holding a lock on the
+    thermostat, so concurrent sync runs can't apply the same change twice.
+    The Fritz!Box is only contacted after the lock has been released.
+
+    """
+    notify = kwargs.pop("notify", True)
+    with lock_thermostat(thermostat):
+        if thermostat.logs.filter(created_at__gte=started_at).exists():
+            logger.info(f"{thermostat.name} has been changed by another sync run")
+            return False
+        command = record_thermostat_change(thermostat, new_target_temperature, **kwargs)
+    return send_thermostat_change(
+        thermostat,
+        command,
+        rule=kwargs.get("rule"),
+        exception=kwargs.get("exception"),
+        notify=notify,
+    )
+
+
+def learn_warmup_rate(thermostat, device):
+    """Record a heat-up rate sample once the last change reached its target.
+
+    Only one sample is taken per change, so this is cheap to call on every
+    run: the running statistics on the thermostat are updated in place.
+
+    """
+    last_log = thermostat.logs.last()
+    if (
+        last_log is None
+        or last_log.warmup_reached_at is not None
+        or last_log.actual_temperature is None
+        or device.actual_temperature is None
+        or last_log.temperature == settings.TEMPERATURE_OFF
+        or last_log.temperature <= last_log.actual_temperature
+        or device.actual_temperature < last_log.temperature
+    ):
+        return
+
+    now = timezone.now()
+    minutes = (now - last_log.created_at).total_seconds() / 60
+    if minutes <= 0:
+        return
+
+    rate = (last_log.temperature - last_log.actual_temperature) / minutes * 60
+    thermostat.record_warmup_rate(rate)
+    thermostat.save()
+
+    last_log.warmup_reached_at = now
+    last_log.save()
+    logger.info(f"  learned heat-up rate of {rate:.1f} °C/h")
+
+
+def get_prestart_rule(thermostat, device, current_temperature, rules):
+    """Return an upcoming Rule that needs heating to start now, or None.
+
+    A Rule is started early if reaching its temperature from the current
+    room temperature takes longer than the time left until it starts. Once
+    started early, it is kept until it starts, even if the room heats up
+    faster than expected.
+
+    """
+    if settings.PRESTART_MAX_MINUTES <= 0:
+        return None
+
+    now = timezone.now()
+    for rule in rules:
+        next_start = rule.get_next_start(now)
+        if next_start is None:
+            continue
+        prestarted_since = next_start - timedelta(minutes=settings.PRESTART_MAX_MINUTES)
+        if (
+            prestarted_since <= now
+            and thermostat.logs.filter(
+                rule_id=rule.id, created_at__gte=prestarted_since
+            )
+            .exclude(command__state=DeviceCommand.FAILED)
+            .exists()
+        ):
+            return rule
+
+    prestart_rule = None
+    prestart_at = None
+    for rule in rules:
+        if rule.temperature == settings.TEMPERATURE_OFF:
+            continue
+        if rule.temperature <= current_temperature:
+            continue
+        next_start = rule.get_next_start(now)
+        if next_start is None:
+            continue
+        minutes_left = (next_start - now).total_seconds() / 60
+        if minutes_left > settings.PRESTART_MAX_MINUTES:
+            continue
+        warmup_minutes = thermostat.get_warmup_minutes(
+            device.actual_temperature, rule.temperature
+        )
+        if warmup_minutes is None or minutes_left > warmup_minutes:
+            continue
+        if prestart_at is None or next_start < prestart_at:
+            prestart_rule = rule
+            prestart_at = next_start
+    return prestart_rule
+
+
+def has_been_prestarted(thermostat, rule):
+    """Whether the pre-start of the Rule has been confirmed by the device.
+
+    Like Rule.has_been_triggered_within_timeframe_already(), only if nothing
+    else has been applied to the thermostat since.
+
+    """
+    next_start = rule.get_next_start()
+    if next_start is None:
+        return False
+    latest = (
+        thermostat.logs.exclude(command__state=DeviceCommand.FAILED)
+        .order_by("created_at", "id")
+        .last()
+    )
+    return (
+        latest is not None
+        and latest.rule_id == rule.id
+        and latest.applied
+        and latest.created_at
+        >= next_start - timedelta(minutes=settings.PRESTART_MAX_MINUTES)
+    )
+
+
+def get_next_rule_start(rules):
+    """Return when the next of the given Rules starts, or None."""
+    now = timezone.now()
+    starts = [rule.get_next_start(now) for rule in rules]
+    starts = [start for start in starts if start is not None]
+    return min(starts, default=None)
+
+
+def register_manual_override(thermostat, device, rule, expires_at=None):
+    """Remember a manual change, so the thermostat is left alone until rule end."""
+    override = ManualOverride.objects.create(
+        thermostat=thermostat,
+        rule_id=rule.id,
+        temperature=device.target_temperature,
+        expires_at=expires_at or rule.get_current_end(),
+    )
+    events.publish(
+        events.MANUAL_OVERRIDE,
+        {
+            "thermostat": thermostat.id,
+            "name": thermostat.name,
+            "temperature": override.temperature,
+            "expires_at": override.expires_at.isoformat(),
+        },
+    )
+    eventlog.emit(
+        eventlog.OVERRIDE_DETECTED,
+        thermostat=thermostat.id,
+        rule=rule.id,
+        temperature=override.temperature,
+        expires_at=override.expires_at,
+    )
+    until = timezone.localtime(override.expires_at).strftime(TIME_FORMAT)
+    send_push_notification(
+        (
+            f"{thermostat} should be at "
+            f"{describe_temperature(rule.temperature)}, "
+            f"but instead is at "
+            f"{describe_temperature(device.target_temperature)}, "
+            f"leaving it alone until {until}"
+        ),
+        title=(
+            f"{thermostat.name}: Manual intervention detected "
+            f"{describe_temperature(device.target_temperature)}"
+        ),
+    )
+    return override
+
+
+def parse_shards(value):
+    return {int(shard) for shard in value.split(",") if shard.strip()}
 
 
 class Command(BaseCommand):
     help = "Get and set thermostat temperatures based on rules"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--record",
+            metavar="CASSETTE",
+            help=(
+                "Record all Fritz!Box and Pushover traffic of this run plus a "
+                "snapshot of the rules into the given file, see replay_sync"
+            ),
+        )
+        parser.add_argument(
+            "--shards",
+            type=parse_shards,
+            help=(
+                "Only sync the thermostats in these shards (comma separated), "
+                "see run_scheduler --worker"
+            ),
+        )
+
     def handle(self, *args, **options):
+        try:
+            if options["record"]:
+                self.record(options["record"])
+            else:
+                self.sync(shards=options["shards"])
+        finally:
+            # Also (and especially) when the Fritz!Box could not be reached.
+            health.check_health(notify=send_push_notification)
+            if eventlog.log.run_id is not None:
+                eventlog.finish_run(failed=True)
+            eventlog.flush()
+
+    def record(self, path):
+        from thermostats.thermostats.cassettes import (
+            Recorder,
+            save_cassette,
+            take_snapshot,
+        )
+
+        snapshot = take_snapshot()
+        with Recorder() as recorder:
+            self.sync()
+        save_cassette(path, recorder, snapshot)
+        logger.info(f"Recorded {len(recorder.interactions)} exchange(s) to {path}")
+
+    def sync(self, shards=None):
         now = timezone.localtime()
         weekday = WeekDay.objects.get(order=now.weekday())
         logger.info(f"{weekday} {now.time().strftime(TIME_FORMAT)}")
         logger.info("")
 
-        for device in get_fritzbox_thermostat_devices():
+        thermostats = Thermostat.objects.all()
+        if shards is not None:
+            logger.info(f"Syncing shard(s) {', '.join(map(str, sorted(shards)))}")
+            thermostats = thermostats.filter(
+                id__in=[
+                    thermostat_id
+                    for thermostat_id, ain in thermostats.values_list("id", "ain")
+                    if get_shard(ain) in shards
+                ]
+            )
+        thermostat_ids = None if shards is None else thermostats.values("id")
+        eventlog.start_run(shards=sorted(shards) if shards is not None else None)
+
+        # Changes sent by earlier runs are verified with one device list.
+        devices = None
+        if has_sent_commands(thermostat_ids):
+            devices = get_fritzbox_thermostat_devices()
+            verify_sent_commands(devices, thermostat_ids=thermostat_ids)
+        expire_unconfirmed_commands(thermostat_ids=thermostat_ids)
+        supersede_stale_commands(thermostat_ids=thermostat_ids)
+        process_due_commands(
+            connect=get_fritzbox_connection, thermostat_ids=thermostat_ids
+        )
+        refresh_schedule(now, thermostat_ids=thermostat_ids)
+
+        overrides = {
+            override.thermostat_id: override
+            for override in ManualOverride.objects.active().order_by("expires_at")
+        }
+        if overrides and not thermostats.exclude(id__in=overrides).exists():
+            logger.info("All thermostats are overridden manually, doing nothing")
+            eventlog.finish_run(devices=0, changes=0)
+            return
+
+        calendar = ExceptionCalendar.load()
+        ruleset = rulesets.get()
+        writes = WriteCoalescer()
+        seen = []
+        if devices is None:
+            devices = get_fritzbox_thermostat_devices()
+        for device in devices:
+            if shards is not None and get_shard(device.ain) not in shards:
+                continue
             thermostat, created = Thermostat.objects.get_or_create(ain=device.ain)
             if created:
                 logger.info(f"Found a new device {device.name} ({device.ain})")
@@ -111,54 +466,180 @@ class Command(BaseCommand):
                 thermostat.name = device.name
                 thermostat.save()
 
-            # Check rules and and see if one applies.
-            last_matching_rule = None
+            eventlog.emit(
+                eventlog.DEVICE_SEEN,
+                thermostat=thermostat.id,
+                ain=device.ain,
+                name=device.name,
+                created=created,
+                target_temperature=device.target_temperature,
+                actual_temperature=device.actual_temperature,
+            )
+
+            override = overrides.get(thermostat.id)
+            if override is not None:
+                eventlog.emit(
+                    eventlog.DEVICE_SKIPPED,
+                    thermostat=thermostat.id,
+                    reason="override",
+                    until=override.expires_at,
+                )
+                expires_at = timezone.localtime(override.expires_at)
+                logger.info(
+                    f"{device.name} manual override active until "
+                    f"{expires_at.strftime(TIME_FORMAT)}, skipping"
+                )
+                logger.info("")
+                seen.append((thermostat, device, {"override": override}))
+                continue
+
+            if thermostat.commands.filter(state__in=DeviceCommand.OPEN_STATES).exists():
+                eventlog.emit(
+                    eventlog.DEVICE_SKIPPED,
+                    thermostat=thermostat.id,
+                    reason="unconfirmed",
+                )
+                logger.info(f"{device.name} waiting for a change to be confirmed")
+                logger.info("")
+                seen.append((thermostat, device, {}))
+                continue
+
+            learn_warmup_rate(thermostat, device)
+
             logger.info(
                 f"{device.name} {describe_temperature(device.target_temperature)}"
             )
-            for rule in thermostat.enabled_rules.order_by("start_time", "end_time"):
-                if rule.is_valid_now():
-                    last_matching_rule = rule
-                    logger.info("  match: " + str(rule))
+
+            exception = calendar.get_active_exception(thermostat)
+            if exception is not None:
+                logger.info(f"  calendar exception: {exception}")
+                seen.append((thermostat, device, {"exception": exception}))
+                decision = {
+                    "thermostat": thermostat.id,
+                    "exception": exception.id,
+                    "temperature": exception.temperature,
+                }
+                if temperatures_equal(device.target_temperature, exception.temperature):
+                    logger.info(f"  temperature is fine, doing nothing")
+                    eventlog.emit(eventlog.DECISION, action="keep", **decision)
+                elif (
+                    thermostat.logs.filter(exception=exception)
+                    .exclude(command__state=DeviceCommand.FAILED)
+                    .exists()
+                ):
+                    logger.info("  ignoring it, since it has been applied before")
+                    eventlog.emit(eventlog.DECISION, action="ignore", **decision)
                 else:
-                    logger.info("  skip: " + str(rule))
+                    eventlog.emit(eventlog.DECISION, action="change", **decision)
+                    writes.request(
+                        thermostat,
+                        exception.temperature,
+                        superseded_at=exception.end,
+                        exception=exception,
+                        actual_temperature=device.actual_temperature,
+                    )
+                logger.info("")
+                continue
+
+            # Check rules and see which one applies.
+            rules = ruleset.get(thermostat.id)
+            last_matching_rule = winners.get_matching_rule(
+                ruleset, thermostat.id, timezone.now()
+            )
+            for rule in rules:
+                if rule is last_matching_rule:
+                    logger.info("  match: " + rule.description)
+                    eventlog.emit(
+                        eventlog.RULE_MATCHED, thermostat=thermostat.id, rule=rule.id
+                    )
+                else:
+                    logger.info("  skip: " + rule.description)
+                    eventlog.emit(
+                        eventlog.RULE_SKIPPED, thermostat=thermostat.id, rule=rule.id
+                    )
+
+            current_temperature = settings.TEMPERATURE_FALLBACK
+            if last_matching_rule is not None:
+                current_temperature = last_matching_rule.temperature
+            prestart_rule = get_prestart_rule(
+                thermostat, device, current_temperature, rules
+            )
+            if prestart_rule is not None:
+                logger.info("  pre-start: " + prestart_rule.description)
+                eventlog.emit(
+                    eventlog.RULE_MATCHED,
+                    thermostat=thermostat.id,
+                    rule=prestart_rule.id,
+                    prestart=True,
+                )
+                last_matching_rule = prestart_rule
+
+            is_prestart = last_matching_rule is prestart_rule
+            seen.append((thermostat, device, {"rule": last_matching_rule}))
 
             # Check if we need to do something about the target temperature.
             if last_matching_rule is None:
                 logger.info("  no rule matched")
-                if not temperatures_equal(
+                decision = {
+                    "thermostat": thermostat.id,
+                    "rule": None,
+                    "temperature": settings.TEMPERATURE_FALLBACK,
+                }
+                if temperatures_equal(
                     device.target_temperature, settings.TEMPERATURE_FALLBACK
                 ):
-                    change_thermostat_target_temperature(
-                        thermostat, settings.TEMPERATURE_FALLBACK
+                    eventlog.emit(eventlog.DECISION, action="keep", **decision)
+                else:
+                    eventlog.emit(eventlog.DECISION, action="change", **decision)
+                    writes.request(
+                        thermostat,
+                        settings.TEMPERATURE_FALLBACK,
+                        superseded_at=get_next_rule_start(rules),
+                        actual_temperature=device.actual_temperature,
                     )
             else:
-                logger.info(f"  rule matched: {last_matching_rule}")
+                logger.info(f"  rule matched: {last_matching_rule.description}")
+                decision = {
+                    "thermostat": thermostat.id,
+                    "rule": last_matching_rule.id,
+                    "temperature": last_matching_rule.temperature,
+                }
                 if temperatures_equal(
                     device.target_temperature, last_matching_rule.temperature
                 ):
                     logger.info(f"  temperature is fine, doing nothing")
+                    eventlog.emit(eventlog.DECISION, action="keep", **decision)
                     continue
 
-                if last_matching_rule.has_been_triggered_within_timeframe_already():
-                    logger.info("  ignoring it, since it has been triggered before")
-                    send_push_notification(
-                        (
-                            f"{thermostat} should be at "
-                            f"{describe_temperature(last_matching_rule.temperature)}, "
-                            f"but instead is at "
-                            f"{describe_temperature(device.target_temperature)}"
-                        ),
-                        title=(
-                            f"{thermostats.name}: Manual intervention detected "
-                            f"{describe_temperature(device.target_temperature)}"
+                if is_prestart and has_been_prestarted(thermostat, last_matching_rule):
+                    logger.info("  ignoring it, since it has been pre-started before")
+                    eventlog.emit(eventlog.DECISION, action="override", **decision)
+                    # Left alone until the end of the upcoming timeframe.
+                    register_manual_override(
+                        thermostat,
+                        device,
+                        last_matching_rule,
+                        expires_at=last_matching_rule.get_current_end(
+                            last_matching_rule.get_next_start()
                         ),
                     )
+                elif last_matching_rule.has_been_triggered_within_timeframe_already(
+                    thermostat
+                ):
+                    logger.info("  ignoring it, since it has been triggered before")
+                    eventlog.emit(eventlog.DECISION, action="override", **decision)
+                    register_manual_override(thermostat, device, last_matching_rule)
                 else:
-                    change_thermostat_target_temperature(
+                    eventlog.emit(eventlog.DECISION, action="change", **decision)
+                    superseded_at = None
+                    if not is_prestart:
+                        superseded_at = last_matching_rule.get_current_end()
+                    writes.request(
                         thermostat,
                         last_matching_rule.temperature,
+                        superseded_at=superseded_at,
                         rule=last_matching_rule,
+                        actual_temperature=device.actual_temperature,
                     )
 
             logger.info("")
@@ -170,7 +651,32 @@ class Command(BaseCommand):
             #   rule has been added/changed/removed that affects it right
             #   now
 
-            # TODO take a look at battery efficieny, communicate with
-            #   thermostats only when needed
+        writes.flush(partial(apply_thermostat_change, started_at=now))
+        logger.info(writes.describe())
+
+        scheduled = get_current_setpoints(now, thermostat_ids=thermostat_ids)
+        status_entries = []
+        for thermostat, device, reason in seen:
+            if thermostat.id in writes.applied:
+                device.target_temperature = writes.applied[thermostat.id]
+            status_entries.append(
+                build_thermostat_status(
+                    thermostat, device, scheduled=scheduled.get(thermostat.id), **reason
+                )
+            )
+        store_status(status_entries, shards=shards)
+        eventlog.finish_run(devices=len(seen), changes=len(writes.applied))
+        if status_entries:
+            events.publish(
+                events.READINGS,
+                [
+                    {
+                        "thermostat": entry["id"],
+                        "target_temperature": entry["target_temperature"],
+                        "actual_temperature": entry["actual_temperature"],
+                    }
+                    for entry in status_entries
+                ],
+            )
 
         # self.stdout.write(self.style.SUCCESS('Successfully closed poll "%s"' % poll_id))
@@ -0,0 +1,63 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from thermostats.thermostats.health import check_health, get_health_report
+from thermostats.thermostats.management.commands.sync_thermostats import (
+    send_push_notification,
+)
+from thermostats.thermostats.outbox import get_confirmation_latencies
+
+
+def format_milliseconds(value):
+    return "-" if value is None else f"{value:.0f} ms"
+
+
+class Command(BaseCommand):
+    help = "Report latencies and error rates of the recent Fritz!Box calls"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--notify",
+            action="store_true",
+            help="Send a push notification if the health changed since the last one",
+        )
+        parser.add_argument(
+            "--strict", action="store_true", help="Exit with an error if unhealthy"
+        )
+
+    def handle(self, *args, **options):
+        if options["notify"]:
+            report = check_health(notify=send_push_notification)
+        else:
+            report = get_health_report()
+
+        self.stdout.write(f"Last {report['window_seconds'] // 60} minutes")
+        for operation, stats in report["operations"].items():
+            error_rate = stats["error_rate"]
+            self.stdout.write(
+                f"{operation:<10} {stats['calls']:>5} call(s) "
+                f"{'-' if error_rate is None else f'{error_rate:.0%}':>5} errors  "
+                f"p50 {format_milliseconds(stats['p50_ms']):>8}  "
+                f"p95 {format_milliseconds(stats['p95_ms']):>8}"
+            )
+
+        since = timezone.now() - timedelta(days=1)
+        latencies = get_confirmation_latencies(since)
+        if latencies:
+            self.stdout.write("Changes confirmed by the devices in the last day")
+        for entry in latencies.values():
+            self.stdout.write(
+                f"{entry['name']:<20} {entry['confirmed']:>5} change(s)  "
+                f"median {entry['median_seconds']:>5.0f} s  "
+                f"max {entry['max_seconds']:>5.0f} s"
+            )
+
+        for problem in report["problems"]:
+            self.stdout.write(self.style.WARNING(problem))
+        if report["healthy"]:
+            self.stdout.write(self.style.SUCCESS("Healthy"))
+
+        if options["strict"] and not report["healthy"]:
+            raise CommandError(f"{len(report['problems'])} problem(s)")
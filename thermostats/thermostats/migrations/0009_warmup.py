@@ -0,0 +1,38 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thermostats', '0008_rule_enabled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thermostat',
+            name='warmup_rate',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='thermostat',
+            name='warmup_rate_m2',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thermostat',
+            name='warmup_samples',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thermostatlog',
+            name='actual_temperature',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='thermostatlog',
+            name='warmup_reached_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
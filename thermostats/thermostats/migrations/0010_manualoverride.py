@@ -0,0 +1,29 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thermostats', '0009_warmup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManualOverride',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('temperature', models.FloatField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('rule', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='overrides', to='thermostats.rule')),
+                ('thermostat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='overrides', to='thermostats.thermostat')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
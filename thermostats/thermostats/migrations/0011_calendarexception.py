@@ -0,0 +1,36 @@
+# Generated by Django 3.1.14 on 2026-10-19 14:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thermostats', '0010_manualoverride'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalendarException',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('name', models.CharField(default='', max_length=128)),
+                ('start', models.DateTimeField(db_index=True)),
+                ('end', models.DateTimeField(db_index=True)),
+                ('temperature', models.FloatField()),
+                ('enabled', models.BooleanField(default=True)),
+                ('thermostats', models.ManyToManyField(blank=True, related_name='exceptions', to='thermostats.Thermostat')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='thermostatlog',
+            name='exception',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='logs', to='thermostats.calendarexception'),
+        ),
+    ]
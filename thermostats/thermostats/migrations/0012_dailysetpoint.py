@@ -0,0 +1,32 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thermostats', '0011_calendarexception'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySetpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('temperature', models.FloatField()),
+                ('minutes', models.FloatField(default=0)),
+                ('thermostat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_setpoints', to='thermostats.thermostat')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dailysetpoint',
+            index=models.Index(fields=['date'], name='thermostats_date_a7df43_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailysetpoint',
+            unique_together={('thermostat', 'date', 'temperature')},
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thermostats', '0012_dailysetpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thermostatlog',
+            name='applied',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.CreateModel(
+            name='DeviceCommand',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('temperature', models.FloatField()),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('confirmed', 'Confirmed'), ('failed', 'Failed')], default='pending', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('confirmed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('log', models.OneToOneField(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='command', to='thermostats.thermostatlog')),
+                ('thermostat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='commands', to='thermostats.thermostat')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='devicecommand',
+            index=models.Index(fields=['state', 'next_attempt_at'], name='thermostats_state_19ea01_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.1.14 on 2026-10-19 15:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thermostats', '0014_shardlease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledSetpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('at', models.DateTimeField()),
+                ('until', models.DateTimeField()),
+                ('temperature', models.FloatField()),
+                ('next_temperature', models.FloatField(blank=True, null=True)),
+                ('fingerprint', models.CharField(max_length=40)),
+                ('exception', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='scheduled_setpoints', to='thermostats.calendarexception')),
+                ('rule', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='scheduled_setpoints', to='thermostats.rule')),
+                ('thermostat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scheduled_setpoints', to='thermostats.thermostat')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='scheduledsetpoint',
+            index=models.Index(fields=['at', 'until'], name='thermostats_at_044b6a_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='scheduledsetpoint',
+            unique_together={('thermostat', 'at')},
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.14 on 2026-10-19 16:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thermostats', '0015_scheduledsetpoint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='thermostatlog',
+            index=models.Index(fields=['thermostat', 'applied', 'created_at'], name='thermostats_thermos_025c07_idx'),
+        ),
+    ]
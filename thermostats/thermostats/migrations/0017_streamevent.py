@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-19 16:16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thermostats', '0016_auto_20261019_1608'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=32)),
+                ('at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('data', models.TextField()),
+            ],
+        ),
+    ]
@@ -3,11 +3,33 @@ from datetime import datetime, time, timedelta
 import pytz
 from django.conf import settings
 from django.db import models
+from django.db.models import F
 from django.utils import timezone
 
 START_OF_DAY = time(0, 0)
 END_OF_DAY = time(23, 59, 59, 999)
 
+# The order of Rules by precedence, the last one matching wins. Databases
+# disagree on where NULLs go, so a missing end_time explicitly sorts first.
+RULE_PRECEDENCE = ("start_time", F("end_time").asc(nulls_first=True), "id")
+
+
+def localize(date, value):
+    """Return the datetime at the given date and time of day in TIME_ZONE.
+
+    Rules are meant in local time, so all of them are evaluated in the
+    current timezone, no matter the timezone of the moment passed in.
+
+    """
+    return timezone.make_aware(datetime.combine(date, value), is_dst=False)
+
+
+def describe_rule(name, weekdays, start_time, end_time, temperature):
+    timing = f"{start_time.strftime('%H:%M')}"
+    if end_time is not None:
+        timing += f" - {end_time.strftime('%H:%M')}"
+    return f"{name}, ({weekdays}), {timing}: {int(temperature)} °C"
+
 
 class BaseModel(models.Model):
     class Meta:
@@ -41,12 +63,12 @@ class Rule(BaseModel):
         return ", ".join([day.abbreviation for day in self.weekdays.all()])
 
     def __str__(self):
-        timing = f"{self.start_time.strftime('%H:%M')}"
-        if self.end_time is not None:
-            timing += f" - {self.end_time.strftime('%H:%M')}"
-        return (
-            f"{self.name}, ({self.weekdays_short_description}), "
-            f"{timing}: {int(self.temperature)} °C"
+        return describe_rule(
+            self.name,
+            self.weekdays_short_description,
+            self.start_time,
+            self.end_time,
+            self.temperature,
         )
 
     def _get_valid_timeframes(self):
@@ -68,7 +90,11 @@ class Rule(BaseModel):
         specified, the implicit end_time is midnight.
 
         """
-        now = timezone.now()
+        return self.is_valid_at(timezone.now())
+
+    def is_valid_at(self, now):
+        """Whether this Rule is in effect at the given datetime."""
+        now = timezone.localtime(now)
         now_time = now.time()
 
         if not now.weekday() in self.weekdays.values_list("order", flat=True):
@@ -82,8 +108,30 @@ class Rule(BaseModel):
                 return True
         return False
 
-    def has_been_triggered_within_timeframe_already(self):
-        last_log = self.logs.last()
+    def has_been_triggered_within_timeframe_already(self, thermostat=None):
+        """Whether this Rule has been applied in its current timeframe.
+
+        With a thermostat, only if nothing else (e.g. a CalendarException)
+        has been applied to it since, as then the Rule has to be applied
+        again.
+
+        Only uses the fields of the Rule itself, so a RuleSnapshot shares
+        this method.
+
+        """
+        logs = ThermostatLog.objects.filter(rule_id=self.id).exclude(
+            command__state=DeviceCommand.FAILED
+        )
+        if thermostat is not None:
+            latest = (
+                thermostat.logs.exclude(command__state=DeviceCommand.FAILED)
+                .order_by("created_at", "id")
+                .last()
+            )
+            if latest is None or latest.rule_id != self.id:
+                return False
+            logs = logs.filter(thermostat=thermostat)
+        last_log = logs.last()
         if last_log is None:
             return False
 
@@ -95,20 +143,19 @@ class Rule(BaseModel):
         if rule_has_changed:
             return False
 
-        now = timezone.now()
-        now_time = now.time()
-
+        now = timezone.localtime()
         today = now.date()
         yesterday = today - timedelta(days=1)
 
-        last_log_time = last_log.created_at.time()
+        last_log_at = timezone.localtime(last_log.created_at)
+        last_log_time = last_log_at.time()
         timeframes = self._get_valid_timeframes()
 
         if len(timeframes) == 1:
             timeframe_today = timeframes[0]
             today_left, today_right = timeframe_today
             if today_left <= last_log_time and today_right >= last_log_time:
-                if last_log.created_at.date() == today:
+                if last_log_at.date() == today:
                     return True
 
         elif len(timeframes) == 2:
@@ -116,26 +163,135 @@ class Rule(BaseModel):
 
             yesterday_left, yesterday_right = timeframe_yesterday
             if yesterday_left <= last_log_time and yesterday_right >= last_log_time:
-                if last_log.created_at.date() == yesterday:
+                if last_log_at.date() == yesterday:
                     return True
 
             today_left, today_right = timeframe_today
             if today_left <= last_log_time and today_right >= last_log_time:
-                if last_log.created_at.date() == today:
+                if last_log_at.date() == today:
                     return True
 
         return False
 
+    def get_current_end(self, now=None):
+        """Return the datetime at which the current timeframe of this Rule ends.
+
+        Without an end_time the Rule implicitly ends at midnight.
+
+        """
+        now = timezone.localtime(now)
+        today = now.date()
+        if self.end_time is None:
+            end_date = today + timedelta(days=1)
+            return localize(end_date, START_OF_DAY)
+
+        end_date = today
+        if self.end_time < self.start_time and now.time() >= self.start_time:
+            end_date = today + timedelta(days=1)
+        return localize(end_date, self.end_time)
+
+    def get_next_start(self, now=None):
+        """Return the next datetime at which this Rule starts, or None.
+
+        The current start is not included, e.g. for a Rule that started a
+        minute ago this will return its start on the next assigned weekday.
+
+        """
+        now = timezone.localtime(now)
+        orders = set(self.weekdays.values_list("order", flat=True))
+        for offset in range(8):
+            date = now.date() + timedelta(days=offset)
+            if date.weekday() not in orders:
+                continue
+            start = localize(date, self.start_time)
+            if start > now:
+                return start
+        return None
+
 
 class Thermostat(BaseModel):
     ain = models.CharField(max_length=64)
     name = models.CharField(max_length=128)
     rules = models.ManyToManyField("thermostats.Rule", blank=True)
 
+    # Running statistics of the observed heat-up rate in °C per hour,
+    # updated incrementally (Welford) whenever a target has been reached.
+    warmup_samples = models.IntegerField(default=0)
+    warmup_rate = models.FloatField(null=True, blank=True)
+    warmup_rate_m2 = models.FloatField(default=0)
+
     @property
     def enabled_rules(self):
         return self.rules.filter(enabled=True)
 
+    def get_matching_rule(self, moment=None, ruleset=None):
+        """Return a snapshot of the enabled Rule in effect, or None.
+
+        If several Rules match, the last by RULE_PRECEDENCE wins. Results
+        are cached until the Rules change, see rulecache.py. Pass the
+        ruleset when looking up several moments.
+
+        """
+        from thermostats.thermostats.rulecache import winners
+        from thermostats.thermostats.ruleset import rulesets
+
+        moment = moment or timezone.now()
+        ruleset = ruleset or rulesets.get()
+        return winners.get_matching_rule(ruleset, self.id, moment)
+
+    def get_next_transition(self, now=None):
+        """Return (datetime, temperature) of the next setpoint change, or None."""
+        from thermostats.thermostats.ruleset import rulesets
+
+        now = now or timezone.now()
+        ruleset = rulesets.get()
+        current_rule = self.get_matching_rule(now, ruleset=ruleset)
+        moments = [rule.get_next_start(now) for rule in ruleset.get(self.id)]
+        if current_rule is not None:
+            moments.append(current_rule.get_current_end(now))
+        moments = sorted(moment for moment in moments if moment is not None)
+
+        current_temperature = (
+            current_rule.temperature if current_rule else settings.TEMPERATURE_FALLBACK
+        )
+        for moment in moments:
+            # Rules are valid including their end, so look right after it.
+            rule = self.get_matching_rule(
+                moment + timedelta(seconds=1), ruleset=ruleset
+            )
+            temperature = rule.temperature if rule else settings.TEMPERATURE_FALLBACK
+            if temperature != current_temperature:
+                return moment, temperature
+        return None
+
+    @property
+    def warmup_rate_variance(self):
+        if self.warmup_samples < 2:
+            return None
+        return self.warmup_rate_m2 / (self.warmup_samples - 1)
+
+    def record_warmup_rate(self, rate):
+        """Add a heat-up rate sample (°C per hour) to the running statistics."""
+        self.warmup_samples += 1
+        mean = self.warmup_rate or 0.0
+        delta = rate - mean
+        mean += delta / self.warmup_samples
+        self.warmup_rate_m2 += delta * (rate - mean)
+        self.warmup_rate = mean
+
+    def get_warmup_minutes(self, actual_temperature, target_temperature):
+        """Return the minutes needed to heat up to the target, or None.
+
+        None means we don't know (yet), e.g. no samples have been recorded.
+
+        """
+        if not self.warmup_rate or self.warmup_rate <= 0:
+            return None
+        if actual_temperature is None or actual_temperature >= target_temperature:
+            return 0
+        difference = target_temperature - actual_temperature
+        return difference / self.warmup_rate * 60
+
     def __str__(self):
         return f"{self.name} (AIN: '{self.ain}')"
 
@@ -151,6 +307,27 @@ class ThermostatLog(BaseModel):
     end_time = models.TimeField(blank=True, null=True)
     temperature = models.FloatField()
 
+    exception = models.ForeignKey(
+        "thermostats.CalendarException",
+        null=True,
+        blank=True,
+        related_name="logs",
+        on_delete=models.SET_NULL,
+    )
+
+    # Whether the device has been read back with this temperature. Changes are
+    # sent through a DeviceCommand, see outbox.py.
+    applied = models.BooleanField(default=True)
+
+    # Room temperature when the change was applied and when the new target
+    # was reached, used to learn the heat-up rate of the thermostat.
+    actual_temperature = models.FloatField(blank=True, null=True)
+    warmup_reached_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        # For the latest applied log per thermostat, see reports.py.
+        indexes = [models.Index(fields=["thermostat", "applied", "created_at"])]
+
     def __str__(self):
         return f"{self.thermostat}: {self.rule}"
 
@@ -163,3 +340,215 @@ class ThermostatLog(BaseModel):
             and self.end_time is None
             and self.temperature == settings.TEMPERATURE_FALLBACK
         )
+
+
+class ManualOverrideQuerySet(models.QuerySet):
+    def active(self, now=None):
+        return self.filter(expires_at__gt=now or timezone.now())
+
+
+class ManualOverride(BaseModel):
+    """A target temperature set by hand, respected until the Rule ends.
+
+    created_at is when the override has been detected.
+
+    """
+
+    thermostat = models.ForeignKey(
+        "thermostats.Thermostat", related_name="overrides", on_delete=models.CASCADE
+    )
+    rule = models.ForeignKey(
+        "thermostats.Rule",
+        null=True,
+        related_name="overrides",
+        on_delete=models.SET_NULL,
+    )
+    temperature = models.FloatField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = ManualOverrideQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.thermostat}: {self.temperature} until {self.expires_at}"
+
+
+class CalendarException(BaseModel):
+    """A dated period (holiday, vacation, ...) that overrides all Rules.
+
+    Applies to the given thermostats, or to all of them if none are given.
+
+    """
+
+    name = models.CharField(default="", max_length=128)
+    start = models.DateTimeField(db_index=True)
+    end = models.DateTimeField(db_index=True)
+    temperature = models.FloatField()
+    thermostats = models.ManyToManyField(
+        "thermostats.Thermostat", blank=True, related_name="exceptions"
+    )
+    enabled = models.BooleanField(default=True)
+
+    def __str__(self):
+        start = timezone.localtime(self.start).strftime("%Y-%m-%d %H:%M")
+        end = timezone.localtime(self.end).strftime("%Y-%m-%d %H:%M")
+        return f"{self.name}, {start} - {end}: {int(self.temperature)} °C"
+
+
+class DailySetpoint(models.Model):
+    """Minutes a thermostat spent at a setpoint on a (local) day.
+
+    Maintained incrementally from consecutive ThermostatLogs, see reports.py.
+
+    """
+
+    thermostat = models.ForeignKey(
+        "thermostats.Thermostat",
+        related_name="daily_setpoints",
+        on_delete=models.CASCADE,
+    )
+    date = models.DateField()
+    temperature = models.FloatField()
+    minutes = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ("thermostat", "date", "temperature")
+        indexes = [models.Index(fields=["date"])]
+
+    def __str__(self):
+        return f"{self.thermostat} {self.date}: {self.minutes:.0f} min at {self.temperature}"
+
+
+class DeviceCommand(BaseModel):
+    """A target temperature write to a device, retried until read back.
+
+    created_at is when the command has been queued.
+
+    """
+
+    PENDING = "pending"
+    SENT = "sent"
+    CONFIRMED = "confirmed"
+    FAILED = "failed"
+    STATES = (
+        (PENDING, "Pending"),
+        (SENT, "Sent"),
+        (CONFIRMED, "Confirmed"),
+        (FAILED, "Failed"),
+    )
+    OPEN_STATES = (PENDING, SENT)
+
+    key = models.CharField(max_length=64, unique=True)
+    thermostat = models.ForeignKey(
+        "thermostats.Thermostat", related_name="commands", on_delete=models.CASCADE
+    )
+    log = models.OneToOneField(
+        "thermostats.ThermostatLog",
+        null=True,
+        related_name="command",
+        on_delete=models.SET_NULL,
+    )
+    temperature = models.FloatField()
+    state = models.CharField(max_length=16, choices=STATES, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(blank=True, null=True)
+    confirmed_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, default="")
+
+    class Meta:
+        indexes = [models.Index(fields=["state", "next_attempt_at"])]
+
+    def __str__(self):
+        return f"{self.thermostat}: {self.temperature} ({self.state})"
+
+    @property
+    def confirmation_latency(self):
+        """Time from the last send until the device reported the setpoint."""
+        if self.confirmed_at is None or self.sent_at is None:
+            return None
+        return self.confirmed_at - self.sent_at
+
+
+class SyncWorker(models.Model):
+    """A run_scheduler --worker process, alive while it keeps checking in."""
+
+    name = models.CharField(max_length=128, unique=True)
+    last_seen_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ShardLease(models.Model):
+    """Ownership of a shard of thermostats by a SyncWorker, until expires_at.
+
+    See shards.py.
+
+    """
+
+    shard = models.IntegerField(unique=True)
+    owner = models.CharField(max_length=128, blank=True, default="")
+    expires_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Shard {self.shard}: {self.owner or 'free'}"
+
+
+class ScheduledSetpoint(models.Model):
+    """The setpoint a thermostat is scheduled to have from at until until.
+
+    Precomputed from the Rules and CalendarExceptions for the next
+    SCHEDULE_DAYS and kept up to date by the sync, see schedule.py.
+    Consecutive rows of a thermostat always differ in temperature.
+
+    """
+
+    thermostat = models.ForeignKey(
+        "thermostats.Thermostat",
+        related_name="scheduled_setpoints",
+        on_delete=models.CASCADE,
+    )
+    at = models.DateTimeField()
+    until = models.DateTimeField()
+    temperature = models.FloatField()
+    next_temperature = models.FloatField(blank=True, null=True)
+    rule = models.ForeignKey(
+        "thermostats.Rule",
+        null=True,
+        blank=True,
+        related_name="scheduled_setpoints",
+        on_delete=models.SET_NULL,
+    )
+    exception = models.ForeignKey(
+        "thermostats.CalendarException",
+        null=True,
+        blank=True,
+        related_name="scheduled_setpoints",
+        on_delete=models.SET_NULL,
+    )
+    # Of the inputs the rows have been generated from.
+    fingerprint = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = ("thermostat", "at")
+        indexes = [models.Index(fields=["at", "until"])]
+
+    def __str__(self):
+        return f"{self.thermostat} {self.at}: {self.temperature}"
+
+
+class StreamEvent(models.Model):
+    """An event of the server-sent events stream, see events.py.
+
+    Only the last EVENTS_BACKLOG are kept. The ids are handed out by the
+    database, so concurrent publishers never share or skip one.
+
+    """
+
+    kind = models.CharField(max_length=32)
+    at = models.DateTimeField(default=timezone.now)
+    # JSON encoded.
+    data = models.TextField()
+
+    def __str__(self):
+        return f"{self.id}: {self.kind}"
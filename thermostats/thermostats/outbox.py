@@ -0,0 +1,248 @@
+"""A durable queue of target temperature writes.
+
+Every change is stored as a DeviceCommand before it is sent. A command is
+confirmed (and its ThermostatLog marked applied) only once the device
+reports the new target temperature. DECT thermostats pick up a new setpoint
+on their next wake-up, which can take minutes, so instead of reading back
+every device right after the write, all sent commands are verified against
+the single device list fetched by the next sync. Failed sends, and sent
+commands that didn't converge within COMMAND_CONFIRM_SECONDS, are retried
+with an exponential backoff on later sync runs, until COMMAND_MAX_ATTEMPTS.
+Unsent commands whose Rule or exception is no longer in effect are given
+up, so the sync decides on the current setpoint instead.
+
+"""
+import logging
+from datetime import timedelta
+from statistics import median
+
+from django.conf import settings
+from django.utils import timezone
+
+from thermostats.thermostats import health
+from thermostats.thermostats.intervals import ExceptionCalendar
+from thermostats.thermostats.models import DeviceCommand
+from thermostats.thermostats.ruleset import rulesets
+from thermostats.thermostats.temperatures import temperatures_equal
+
+logger = logging.getLogger("thermostats.outbox")
+
+
+def get_backoff(attempts):
+    """Return the time to wait before the next attempt."""
+    seconds = settings.COMMAND_RETRY_SECONDS * 2 ** max(attempts - 1, 0)
+    return timedelta(seconds=min(seconds, settings.COMMAND_RETRY_MAX_SECONDS))
+
+
+def enqueue_command(log):
+    """Queue the change of the given ThermostatLog, superseding older ones.
+
+    Keyed by the log, so queueing the same change twice is harmless.
+
+    """
+    DeviceCommand.objects.filter(
+        thermostat_id=log.thermostat_id, state__in=DeviceCommand.OPEN_STATES
+    ).exclude(log=log).update(state=DeviceCommand.FAILED, last_error="Superseded")
+    command, _ = DeviceCommand.objects.get_or_create(
+        key=f"{log.thermostat_id}:{log.id}",
+        defaults={
+            "thermostat_id": log.thermostat_id,
+            "log": log,
+            "temperature": log.temperature,
+        },
+    )
+    return command
+
+
+def confirm_command(command, now=None):
+    now = now or timezone.now()
+    command.state = DeviceCommand.CONFIRMED
+    command.confirmed_at = now
+    command.save()
+    if command.log_id is not None and not command.log.applied:
+        command.log.applied = True
+        command.log.save(update_fields=["applied"])
+
+
+def fail_attempt(command, error, now=None):
+    """Schedule a retry, or give up after COMMAND_MAX_ATTEMPTS."""
+    now = now or timezone.now()
+    command.last_error = error
+    if command.attempts >= settings.COMMAND_MAX_ATTEMPTS:
+        command.state = DeviceCommand.FAILED
+        logger.error(f"Giving up on {command} after {command.attempts} attempt(s)")
+    else:
+        command.state = DeviceCommand.PENDING
+        command.next_attempt_at = now + get_backoff(command.attempts)
+        logger.warning(
+            f"{command} failed ({error}), retrying at "
+            f"{timezone.localtime(command.next_attempt_at):%H:%M:%S}"
+        )
+    command.save()
+
+
+def send_command(command, fritzbox):
+    """Send the command, return whether it was sent.
+
+    It is confirmed later by verify_sent_commands().
+
+    """
+    now = timezone.now()
+    command.attempts += 1
+    try:
+        with health.measure(health.SET):
+            fritzbox.set_target_temperature(command.thermostat.ain, command.temperature)
+    except Exception as e:
+        fail_attempt(command, repr(e), now)
+        return False
+
+    command.state = DeviceCommand.SENT
+    command.sent_at = now
+    command.save()
+    return True
+
+
+def verify_sent_commands(devices, now=None, thermostat_ids=None):
+    """Confirm the sent commands the devices agree with, return those.
+
+    devices is the device list of the Fritz!Box, so verifying any number
+    of commands takes a single request.
+
+    """
+    now = now or timezone.now()
+    devices_by_ain = {device.ain: device for device in devices}
+    confirmed = []
+    for command in (
+        get_commands(thermostat_ids)
+        .filter(state=DeviceCommand.SENT)
+        .select_related("thermostat", "log")
+    ):
+        device = devices_by_ain.get(command.thermostat.ain)
+        if device is None:
+            continue
+        if temperatures_equal(device.target_temperature, command.temperature):
+            confirm_command(command, now)
+            logger.info(
+                f"{command.thermostat.name} confirmed {command.temperature} after "
+                f"{command.confirmation_latency.total_seconds():.0f}s"
+            )
+            confirmed.append(command)
+    return confirmed
+
+
+def get_confirmation_latencies(since):
+    """Return the median and maximum seconds to confirm per thermostat."""
+    latencies = {}
+    for thermostat_id, name, sent_at, confirmed_at in (
+        DeviceCommand.objects.filter(
+            state=DeviceCommand.CONFIRMED, confirmed_at__gte=since
+        )
+        .order_by("thermostat__name")
+        .values_list("thermostat_id", "thermostat__name", "sent_at", "confirmed_at")
+    ):
+        entry = latencies.setdefault(thermostat_id, {"name": name, "seconds": []})
+        entry["seconds"].append((confirmed_at - sent_at).total_seconds())
+    return {
+        thermostat_id: {
+            "name": entry["name"],
+            "confirmed": len(entry["seconds"]),
+            "median_seconds": median(entry["seconds"]),
+            "max_seconds": max(entry["seconds"]),
+        }
+        for thermostat_id, entry in latencies.items()
+    }
+
+
+def has_sent_commands(thermostat_ids=None):
+    return get_commands(thermostat_ids).filter(state=DeviceCommand.SENT).exists()
+
+
+def get_commands(thermostat_ids=None):
+    commands = DeviceCommand.objects.all()
+    if thermostat_ids is not None:
+        commands = commands.filter(thermostat_id__in=thermostat_ids)
+    return commands
+
+
+def expire_unconfirmed_commands(now=None, thermostat_ids=None):
+    """Retry sent commands that haven't been confirmed in time."""
+    now = now or timezone.now()
+    deadline = now - timedelta(seconds=settings.COMMAND_CONFIRM_SECONDS)
+    for command in get_commands(thermostat_ids).filter(
+        state=DeviceCommand.SENT, sent_at__lt=deadline
+    ):
+        fail_attempt(command, "Not confirmed by the device in time", now)
+
+
+def is_current(command, calendar, now, ruleset=None):
+    """Whether the command still sets what the thermostat should have now."""
+    log = command.log
+    if log is None:
+        return True
+    exception = calendar.get_active_exception(command.thermostat, now)
+    if exception is not None:
+        return (
+            log.exception_id == exception.id
+            and log.temperature == exception.temperature
+        )
+    if log.exception_id is not None:
+        return False
+
+    ruleset = ruleset or rulesets.get()
+    rule = command.thermostat.get_matching_rule(now, ruleset=ruleset)
+    if log.rule_id is None:
+        return rule is None
+    if rule is not None and rule.id == log.rule_id:
+        return log.temperature == rule.temperature
+    # Pre-started ahead of a Rule that hasn't begun yet.
+    upcoming = ruleset.get_rule(log.rule_id)
+    if upcoming is None or rule is not None:
+        return False
+    next_start = upcoming.get_next_start(now)
+    return (
+        log.temperature == upcoming.temperature
+        and next_start is not None
+        and next_start - now <= timedelta(minutes=settings.PRESTART_MAX_MINUTES)
+    )
+
+
+def supersede_stale_commands(now=None, thermostat_ids=None):
+    """Give up on pending commands that are no longer current, return them."""
+    now = now or timezone.now()
+    pending = list(
+        get_commands(thermostat_ids)
+        .filter(state=DeviceCommand.PENDING)
+        .select_related("thermostat", "log")
+    )
+    if not pending:
+        return []
+    calendar = ExceptionCalendar.load(now)
+    ruleset = rulesets.get()
+    stale = [
+        command
+        for command in pending
+        if not is_current(command, calendar, now, ruleset=ruleset)
+    ]
+    for command in stale:
+        logger.info(f"Dropping {command}, it is no longer current")
+        command.state = DeviceCommand.FAILED
+        command.last_error = "Superseded, no longer current"
+        command.save()
+    return stale
+
+
+def process_due_commands(connect, now=None, thermostat_ids=None):
+    """Send all pending commands that are due, return them."""
+    now = now or timezone.now()
+    due = list(
+        get_commands(thermostat_ids)
+        .filter(state=DeviceCommand.PENDING, next_attempt_at__lte=now)
+        .select_related("thermostat", "log")
+    )
+    if not due:
+        return []
+    fritzbox = connect()
+    for command in due:
+        logger.info(f"Retrying {command} (attempt {command.attempts + 1})")
+        send_command(command, fritzbox)
+    return due
@@ -0,0 +1,125 @@
+"""Decide when the next sync should run, instead of polling at a fixed rate.
+
+Polls are scheduled right after the next scheduled setpoint change (or
+override end), more often ahead of Rules that may be pre-started and in
+hours of the week in which manual changes have been observed before, and
+rarely otherwise. POLL_MAX_SECONDS bounds how late a manual change can be
+detected.
+
+"""
+import logging
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.utils import timezone
+
+from thermostats.thermostats.models import DeviceCommand, ManualOverride
+from thermostats.thermostats.schedule import (
+    get_upcoming_setpoints,
+    refresh_schedule,
+)
+
+logger = logging.getLogger("thermostats.polling")
+
+HOURS_PER_WEEK = 7 * 24
+
+
+def get_hour_of_week(moment):
+    moment = timezone.localtime(moment)
+    return moment.weekday() * 24 + moment.hour
+
+
+def get_manual_activity(now, weeks=None):
+    """Return a Counter of manual overrides detected per hour of the week."""
+    weeks = weeks or settings.POLL_ACTIVITY_WEEKS
+    detected = ManualOverride.objects.filter(
+        created_at__gte=now - timedelta(weeks=weeks), created_at__lte=now
+    ).values_list("created_at", flat=True)
+    return Counter(get_hour_of_week(moment) for moment in detected)
+
+
+def get_next_boundaries(now):
+    """Return the upcoming (moment, is_rule_start) at which setpoints may change.
+
+    Only the next day is looked at, which is well beyond POLL_MAX_SECONDS.
+
+    """
+    refresh_schedule(now)
+    boundaries = [
+        (at, rule_id is not None)
+        for at, rule_id in get_upcoming_setpoints(
+            now, now + timedelta(days=1)
+        ).values_list("at", "rule_id")
+    ]
+    for expires_at in ManualOverride.objects.active(now).values_list(
+        "expires_at", flat=True
+    ):
+        boundaries.append((expires_at, False))
+    return sorted(boundary for boundary in boundaries if boundary[0] > now)
+
+
+def get_poll_interval(now=None):
+    """Return the number of seconds to wait until the next sync."""
+    now = now or timezone.now()
+    interval = settings.POLL_MAX_SECONDS
+
+    boundaries = get_next_boundaries(now)
+    if boundaries:
+        until_boundary = (boundaries[0][0] - now).total_seconds()
+        interval = min(interval, until_boundary + settings.POLL_BOUNDARY_DELAY_SECONDS)
+
+    # Rules may be started early, so look closer before they start.
+    starts = [moment for moment, is_rule_start in boundaries if is_rule_start]
+    if starts:
+        until_start = (starts[0] - now).total_seconds()
+        if until_start <= settings.PRESTART_MAX_MINUTES * 60:
+            interval = min(interval, settings.POLL_PRESTART_SECONDS)
+
+    # Verify sent changes soon, they are retried if not confirmed in time.
+    if DeviceCommand.objects.filter(state=DeviceCommand.SENT).exists():
+        interval = min(interval, settings.COMMAND_VERIFY_SECONDS)
+
+    activity = get_manual_activity(now)[get_hour_of_week(now)]
+    if activity:
+        interval = min(interval, settings.POLL_MAX_SECONDS / (1 + activity))
+
+    return max(settings.POLL_MIN_SECONDS, interval)
+
+
+class Scheduler:
+    """Run the sync over and over, waiting adaptively in between.
+
+    clock, sleep and sync can be replaced, e.g. to run at an accelerated
+    simulated time. max_interval caps the wait, e.g. to renew shard leases.
+
+    """
+
+    def __init__(
+        self, clock=timezone.now, sleep=time.sleep, sync=None, max_interval=None
+    ):
+        self.clock = clock
+        self.sleep = sleep
+        self.sync = sync or (lambda: call_command("sync_thermostats"))
+        self.max_interval = max_interval
+        self.cycles = 0
+
+    def run_once(self):
+        """Run a single sync and return the seconds until the next one."""
+        try:
+            self.sync()
+        except Exception:
+            logger.exception("Sync failed")
+        self.cycles += 1
+        interval = get_poll_interval(self.clock())
+        if self.max_interval is not None:
+            interval = min(interval, self.max_interval)
+        return interval
+
+    def run(self, cycles=None):
+        while cycles is None or self.cycles < cycles:
+            interval = self.run_once()
+            logger.info(f"Next sync in {interval:.0f}s")
+            self.sleep(interval)
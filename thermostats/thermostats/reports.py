@@ -0,0 +1,142 @@
+"""Heating reports read from incrementally maintained DailySetpoint rows.
+
+Only applied ThermostatLogs count, i.e. the ones the device has confirmed
+(see outbox.py). Each of them ends the setpoint of the previous applied log
+of the same thermostat, so whenever a log is applied the time between the
+two is added to the per day totals. The setpoint still in effect is added
+up to now by the reports, which otherwise never look at the logs.
+
+"""
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.utils import timezone
+
+from thermostats.thermostats.models import DailySetpoint, Thermostat, ThermostatLog
+
+
+def split_by_day(start, end):
+    """Yield (date, minutes) for the interval [start, end) in local time."""
+    start = timezone.localtime(start)
+    end = timezone.localtime(end)
+    while start < end:
+        next_midnight = timezone.make_aware(
+            datetime.combine(start.date() + timedelta(days=1), time(0, 0))
+        )
+        chunk_end = min(end, next_midnight)
+        yield start.date(), (chunk_end - start).total_seconds() / 60
+        start = chunk_end
+
+
+def add_setpoint_interval(thermostat_id, temperature, start, end):
+    for date, minutes in split_by_day(start, end):
+        daily, created = DailySetpoint.objects.get_or_create(
+            thermostat_id=thermostat_id,
+            date=date,
+            temperature=temperature,
+            defaults={"minutes": minutes},
+        )
+        if not created:
+            DailySetpoint.objects.filter(pk=daily.pk).update(
+                minutes=F("minutes") + minutes
+            )
+
+
+def aggregate_new_log(
+    sender, instance, created, raw=False, update_fields=None, **kwargs
+):
+    """post_save handler for ThermostatLog: close the previous setpoint.
+
+    Runs once a log is applied, either created so or confirmed later on.
+
+    """
+    if raw or not instance.applied:
+        return
+    if not created and "applied" not in (update_fields or ()):
+        return
+    previous = (
+        ThermostatLog.objects.filter(
+            thermostat_id=instance.thermostat_id,
+            applied=True,
+            created_at__lt=instance.created_at,
+        )
+        .order_by("-created_at", "-id")
+        .values_list("temperature", "created_at")
+        .first()
+    )
+    if previous is None:
+        return
+    temperature, started_at = previous
+    with transaction.atomic():
+        add_setpoint_interval(
+            instance.thermostat_id, temperature, started_at, instance.created_at
+        )
+
+
+@transaction.atomic
+def rebuild_daily_setpoints():
+    """Recompute all DailySetpoints from scratch, e.g. after importing logs."""
+    DailySetpoint.objects.all().delete()
+    previous = None
+    logs = ThermostatLog.objects.filter(applied=True).order_by(
+        "thermostat_id", "created_at", "id"
+    )
+    for log in logs.values("thermostat_id", "temperature", "created_at").iterator():
+        if previous is not None and previous["thermostat_id"] == log["thermostat_id"]:
+            add_setpoint_interval(
+                log["thermostat_id"],
+                previous["temperature"],
+                previous["created_at"],
+                log["created_at"],
+            )
+        previous = log
+
+
+def get_current_setpoints():
+    """Return the temperature and start of the latest applied log per thermostat.
+
+    One index lookup per thermostat, see the ThermostatLog indexes.
+
+    """
+    latest = ThermostatLog.objects.filter(
+        thermostat_id=OuterRef("id"), applied=True
+    ).order_by("-created_at", "-id")[:1]
+    return (
+        Thermostat.objects.annotate(
+            temperature=Subquery(latest.values("temperature")),
+            started_at=Subquery(latest.values("created_at")),
+        )
+        .filter(started_at__isnull=False)
+        .values("id", "name", "temperature", "started_at")
+    )
+
+
+def get_heating_report(start_date, end_date, now=None):
+    """Return hours per thermostat and setpoint between the dates (inclusive)."""
+    now = now or timezone.now()
+    minutes = {}
+    for row in (
+        DailySetpoint.objects.filter(date__gte=start_date, date__lte=end_date)
+        .values("thermostat_id", "thermostat__name", "temperature")
+        .annotate(minutes=Sum("minutes"))
+    ):
+        key = (row["thermostat__name"], row["temperature"], row["thermostat_id"])
+        minutes[key] = row["minutes"]
+
+    # The setpoints in effect haven't been added to the DailySetpoints yet.
+    for row in get_current_setpoints():
+        key = (row["name"], row["temperature"], row["id"])
+        for date, open_minutes in split_by_day(row["started_at"], now):
+            if start_date <= date <= end_date:
+                minutes[key] = minutes.get(key, 0) + open_minutes
+
+    return [
+        {
+            "thermostat": thermostat_id,
+            "name": name,
+            "temperature": temperature,
+            "hours": round(minutes[name, temperature, thermostat_id] / 60, 2),
+        }
+        for name, temperature, thermostat_id in sorted(minutes)
+    ]
@@ -0,0 +1,154 @@
+"""Remember which Rule wins for a thermostat at a given minute of the week.
+
+Between edits the winner only depends on the Rules and the local weekly
+time, so
+it is cached by (rules version, thermostat, minute of the week). The rules
+version lives in Django's cache and is bumped by signal handlers whenever
+Rules, their weekdays or the Rules of a thermostat change, which makes all
+older entries unreachable in every process at once.
+
+Winners are evaluated on and returned from a RuleSet (see ruleset.py),
+which carries the rules version it was loaded at. So the version is read
+once per RuleSet handed out, and a cache hit needs no query at all.
+
+Entries are kept in a bounded in-process LRU and, if RULE_CACHE_ALIAS names
+one of the CACHES, additionally in that shared cache, so the sync, the
+status views and the admin can reuse each other's results.
+
+"""
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.utils import timezone
+
+from thermostats.thermostats.models import END_OF_DAY
+
+RULES_VERSION_KEY = "thermostats:rules_version"
+MINUTES_PER_DAY = 24 * 60
+
+# Marks a cache miss, as None is a valid cached winner.
+MISSING = object()
+
+
+def get_rules_version():
+    # Start from the current time, so a cleared cache can't bring back a
+    # version that is still referenced by stale in-process entries.
+    cache.add(RULES_VERSION_KEY, time.time_ns(), timeout=None)
+    return cache.get(RULES_VERSION_KEY)
+
+
+def bump_rules_version(**kwargs):
+    """Signal handler invalidating all cached winners."""
+    try:
+        cache.incr(RULES_VERSION_KEY)
+    except ValueError:
+        cache.set(RULES_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def get_time_bucket(moment):
+    """Return the part of the moment the winner depends on.
+
+    Rules start and end on full minutes and their bounds are inclusive, so
+    the exact start of a minute is a bucket of its own. So is the very end
+    of the day, which lies after END_OF_DAY.
+
+    """
+    moment_time = moment.time()
+    if moment_time > END_OF_DAY:
+        return moment.weekday(), "end"
+    minute = moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+    return minute, moment_time.second == 0 and moment_time.microsecond == 0
+
+
+def is_whole_minute(value):
+    return value is None or (value.second == 0 and value.microsecond == 0)
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class WinnerCache:
+    def __init__(self, maxsize=None, alias=None):
+        self.local = LRUCache(maxsize or settings.RULE_CACHE_SIZE)
+        self.alias = alias
+
+    @property
+    def shared(self):
+        alias = settings.RULE_CACHE_ALIAS if self.alias is None else self.alias
+        return caches[alias] if alias else None
+
+    def get_key(self, version, thermostat_id, moment):
+        minute, edge = get_time_bucket(moment)
+        return f"thermostats:winner:{version}:{thermostat_id}:{minute}:{edge}"
+
+    def get(self, key):
+        rule_id = self.local.get(key)
+        shared = self.shared
+        if rule_id is MISSING and shared is not None:
+            rule_id = shared.get(key, MISSING)
+            if rule_id is not MISSING:
+                self.local.set(key, rule_id)
+        return rule_id
+
+    def set(self, key, rule_id):
+        self.local.set(key, rule_id)
+        shared = self.shared
+        if shared is not None:
+            shared.set(key, rule_id, timeout=settings.RULE_CACHE_TIMEOUT)
+
+    def get_matching_rule(self, ruleset, thermostat_id, moment):
+        """Return the RuleSnapshot in effect at the given moment, or None."""
+        moment = timezone.localtime(moment)
+        key = self.get_key(ruleset.version, thermostat_id, moment)
+        rule_id = self.get(key)
+        if rule_id is None:
+            return None
+        if rule_id is not MISSING:
+            rule = ruleset.get_rule(rule_id)
+            if rule is not None:
+                return rule
+
+        rules = ruleset.get(thermostat_id)
+        last_matching_rule = None
+        for rule in rules:
+            if rule.is_valid_at(moment):
+                last_matching_rule = rule
+        # Rules with seconds don't fit the buckets, just don't cache them.
+        if all(
+            is_whole_minute(rule.start_time) and is_whole_minute(rule.end_time)
+            for rule in rules
+        ):
+            self.set(key, last_matching_rule.id if last_matching_rule else None)
+        return last_matching_rule
+
+
+winners = WinnerCache()
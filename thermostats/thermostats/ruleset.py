@@ -0,0 +1,164 @@
+"""Compact, immutable copies of the enabled Rules for the sync loop.
+
+Model instances carry their ORM state and query their weekdays whenever
+they are checked or printed. A RuleSnapshot is a plain tuple holding just
+what evaluating and logging needs: times, a weekday bitmask, the
+temperature and the precomputed description. The RuleSet of all
+thermostats is loaded with three queries and reused until the rules
+version (see rulecache.py) changes, so a long running scheduler keeps a
+single copy around. Which of them wins is looked up through the winners
+cache, see Thermostat.get_matching_rule().
+
+"""
+from collections import defaultdict, namedtuple
+from datetime import timedelta
+
+from django.utils import timezone
+
+from thermostats.thermostats.models import (
+    END_OF_DAY,
+    START_OF_DAY,
+    Rule,
+    Thermostat,
+    describe_rule,
+    localize,
+)
+from thermostats.thermostats.rulecache import get_rules_version
+
+
+class RuleSnapshot(
+    namedtuple(
+        "RuleSnapshot",
+        ("id", "start_time", "end_time", "weekday_mask", "temperature", "description"),
+    )
+):
+    """The same semantics as the Rule methods of the same names."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return self.description
+
+    _get_valid_timeframes = Rule._get_valid_timeframes
+    has_been_triggered_within_timeframe_already = (
+        Rule.has_been_triggered_within_timeframe_already
+    )
+
+    def applies_on(self, weekday):
+        return self.weekday_mask >> weekday & 1 == 1
+
+    def is_valid_at(self, now):
+        now = timezone.localtime(now)
+        if not self.applies_on(now.weekday()):
+            return False
+        now_time = now.time()
+        left = self.start_time
+        right = self.end_time if self.end_time else END_OF_DAY
+        if right < left:
+            return left <= now_time <= END_OF_DAY or START_OF_DAY <= now_time <= right
+        return left <= now_time <= right
+
+    def get_current_end(self, now=None):
+        now = timezone.localtime(now)
+        if self.end_time is None:
+            return localize(now.date() + timedelta(days=1), START_OF_DAY)
+        end_date = now.date()
+        if self.end_time < self.start_time and now.time() >= self.start_time:
+            end_date += timedelta(days=1)
+        return localize(end_date, self.end_time)
+
+    def get_next_start(self, now=None):
+        now = timezone.localtime(now)
+        for offset in range(8):
+            date = now.date() + timedelta(days=offset)
+            if not self.applies_on(date.weekday()):
+                continue
+            start = localize(date, self.start_time)
+            if start > now:
+                return start
+        return None
+
+
+class RuleSet:
+    def __init__(self, rules_by_thermostat, version=None):
+        self.rules_by_thermostat = rules_by_thermostat
+        self.rules = {
+            rule.id: rule for rules in rules_by_thermostat.values() for rule in rules
+        }
+        self.version = version
+
+    def get(self, thermostat_id):
+        """Return the thermostat's enabled Rules by RULE_PRECEDENCE."""
+        return self.rules_by_thermostat.get(thermostat_id, ())
+
+    def get_rule(self, rule_id):
+        return self.rules.get(rule_id)
+
+    @classmethod
+    def load(cls, version=None):
+        masks = defaultdict(int)
+        abbreviations = defaultdict(list)
+        for rule_id, order, name in (
+            Rule.weekdays.through.objects.filter(rule__enabled=True)
+            .order_by("weekday__order")
+            .values_list("rule_id", "weekday__order", "weekday__name")
+        ):
+            masks[rule_id] |= 1 << order
+            abbreviations[rule_id].append(name[:2])
+
+        snapshots = {}
+        for rule_id, name, start_time, end_time, temperature in Rule.objects.filter(
+            enabled=True
+        ).values_list("id", "name", "start_time", "end_time", "temperature"):
+            weekdays = ", ".join(abbreviations[rule_id])
+            snapshots[rule_id] = RuleSnapshot(
+                rule_id,
+                start_time,
+                end_time,
+                masks[rule_id],
+                temperature,
+                describe_rule(name, weekdays, start_time, end_time, temperature),
+            )
+
+        rules_by_thermostat = defaultdict(list)
+        for thermostat_id, rule_id in Thermostat.rules.through.objects.filter(
+            rule_id__in=snapshots
+        ).values_list("thermostat_id", "rule_id"):
+            rules_by_thermostat[thermostat_id].append(snapshots[rule_id])
+
+        return cls(
+            {
+                thermostat_id: tuple(
+                    sorted(
+                        rules,
+                        # Like order_by(*RULE_PRECEDENCE).
+                        key=lambda rule: (
+                            rule.start_time,
+                            rule.end_time is not None,
+                            rule.end_time or START_OF_DAY,
+                            rule.id,
+                        ),
+                    )
+                )
+                for thermostat_id, rules in rules_by_thermostat.items()
+            },
+            version=version,
+        )
+
+
+class RuleSetCache:
+    """Hands out the same RuleSet until the Rules change."""
+
+    def __init__(self):
+        self.version = None
+        self.ruleset = None
+
+    def get(self):
+        version = get_rules_version()
+        if self.ruleset is None or version != self.version:
+            self.ruleset = RuleSet.load(version)
+            self.version = version
+        return self.ruleset
+
+
+rulesets = RuleSetCache()
@@ -0,0 +1,210 @@
+"""Materialize the setpoints of the next SCHEDULE_DAYS into ScheduledSetpoints.
+
+Which temperature a thermostat should have only changes at Rule and
+CalendarException boundaries, so they are evaluated once up front and
+stored as one row per transition. Reading the current and next setpoint
+of every thermostat then is a single indexed range query.
+
+refresh_schedule() is cheap to call on every sync: each thermostat's rows
+carry a fingerprint of the inputs they were generated from, and only
+thermostats whose Rules or exceptions changed, or whose rows have been
+generated about a day ago, are regenerated. Like Thermostat.get_next_transition(), a Rule's
+inclusive end is treated as the moment its setpoint ends. Rule times are
+local times in TIME_ZONE, which is part of the fingerprint as well.
+
+"""
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from thermostats.thermostats.db import lock_thermostat
+from thermostats.thermostats.models import (
+    CalendarException,
+    START_OF_DAY,
+    ScheduledSetpoint,
+    Thermostat,
+    localize,
+)
+from thermostats.thermostats.ruleset import rulesets
+
+# Regenerate a thermostat once its rows end this much short of SCHEDULE_DAYS.
+EXTEND_AHEAD = timedelta(days=1)
+
+# Setpoints are evaluated right after each boundary, see the module docstring.
+AFTER_BOUNDARY = timedelta(seconds=1)
+
+
+def get_exceptions(thermostat_id, exceptions):
+    return [
+        exception
+        for exception, thermostat_ids in exceptions
+        if not thermostat_ids or thermostat_id in thermostat_ids
+    ]
+
+
+def get_fingerprint(rules, exceptions):
+    inputs = (
+        [
+            (
+                rule.id,
+                rule.start_time,
+                rule.end_time,
+                rule.weekday_mask,
+                rule.temperature,
+            )
+            for rule in rules
+        ],
+        [
+            (exception.id, exception.start, exception.end, exception.temperature)
+            for exception in exceptions
+        ],
+        settings.TEMPERATURE_FALLBACK,
+        settings.SCHEDULE_DAYS,
+        settings.TIME_ZONE,
+    )
+    return hashlib.sha1(repr(inputs).encode("utf-8")).hexdigest()
+
+
+def get_setpoint_at(moment, rules, exceptions):
+    """Return (temperature, rule_id, exception_id) in effect at moment."""
+    active = [
+        exception
+        for exception in exceptions
+        if exception.start <= moment < exception.end
+    ]
+    if active:
+        # Like ExceptionCalendar, the one that started last wins.
+        exception = max(active, key=lambda exception: exception.start)
+        return exception.temperature, None, exception.id
+
+    winner = None
+    for rule in rules:
+        if rule.is_valid_at(moment):
+            winner = rule
+    if winner is not None:
+        return winner.temperature, winner.id, None
+    return settings.TEMPERATURE_FALLBACK, None, None
+
+
+def get_boundaries(start, end, rules, exceptions):
+    """Return the sorted moments within [start, end) the setpoint may change at."""
+    start = timezone.localtime(start)
+    end = timezone.localtime(end)
+    boundaries = {start}
+    date = start.date() - timedelta(days=1)
+    while date <= end.date():
+        boundaries.add(localize(date, START_OF_DAY))
+        for rule in rules:
+            if not rule.applies_on(date.weekday()):
+                continue
+            boundaries.add(localize(date, rule.start_time))
+            if rule.end_time is not None:
+                boundaries.add(localize(date, rule.end_time))
+        date += timedelta(days=1)
+    for exception in exceptions:
+        boundaries.update((exception.start, exception.end))
+    return sorted(moment for moment in boundaries if start <= moment < end)
+
+
+def build_schedule(thermostat_id, start, end, rules, exceptions, fingerprint=""):
+    """Return the unsaved ScheduledSetpoints of a thermostat in [start, end)."""
+    setpoints = []
+    for moment in get_boundaries(start, end, rules, exceptions):
+        temperature, rule_id, exception_id = get_setpoint_at(
+            moment + AFTER_BOUNDARY, rules, exceptions
+        )
+        if setpoints and setpoints[-1].temperature == temperature:
+            continue
+        if setpoints:
+            setpoints[-1].until = moment
+            setpoints[-1].next_temperature = temperature
+        setpoints.append(
+            ScheduledSetpoint(
+                thermostat_id=thermostat_id,
+                at=moment,
+                until=end,
+                temperature=temperature,
+                rule_id=rule_id,
+                exception_id=exception_id,
+                fingerprint=fingerprint,
+            )
+        )
+    return setpoints
+
+
+def load_exceptions(now):
+    """Return (exception, thermostat ids) of the ones not ended by now."""
+    through = CalendarException.thermostats.through
+    thermostat_ids = {}
+    for exception_id, thermostat_id in through.objects.filter(
+        calendarexception__enabled=True, calendarexception__end__gt=now
+    ).values_list("calendarexception_id", "thermostat_id"):
+        thermostat_ids.setdefault(exception_id, set()).add(thermostat_id)
+    return [
+        (exception, thermostat_ids.get(exception.id, set()))
+        for exception in CalendarException.objects.filter(enabled=True, end__gt=now)
+    ]
+
+
+def refresh_schedule(now=None, thermostat_ids=None):
+    """Regenerate the rows of thermostats that are outdated, return their ids."""
+    now = now or timezone.now()
+    end = now + timedelta(days=settings.SCHEDULE_DAYS)
+    ruleset = rulesets.get()
+    exceptions = load_exceptions(now)
+
+    thermostats = Thermostat.objects.all()
+    setpoints = ScheduledSetpoint.objects.all()
+    if thermostat_ids is not None:
+        thermostats = thermostats.filter(id__in=thermostat_ids)
+        setpoints = setpoints.filter(thermostat_id__in=thermostat_ids)
+    windows = {}
+    for thermostat_id, fingerprint, first, last in (
+        setpoints.values("thermostat_id", "fingerprint")
+        .annotate(first=Min("at"), last=Max("until"))
+        .values_list("thermostat_id", "fingerprint", "first", "last")
+    ):
+        # Several fingerprints would be a bug, just regenerate then.
+        windows[thermostat_id] = (
+            None if thermostat_id in windows else (fingerprint, first, last)
+        )
+
+    refreshed = []
+    for thermostat in thermostats:
+        rules = ruleset.get(thermostat.id)
+        thermostat_exceptions = get_exceptions(thermostat.id, exceptions)
+        fingerprint = get_fingerprint(rules, thermostat_exceptions)
+        window = windows.get(thermostat.id)
+        if (
+            window is not None
+            and window[0] == fingerprint
+            and window[1] <= now
+            and window[2] >= now + timedelta(days=settings.SCHEDULE_DAYS) - EXTEND_AHEAD
+        ):
+            continue
+        with lock_thermostat(thermostat):
+            ScheduledSetpoint.objects.filter(thermostat=thermostat).delete()
+            ScheduledSetpoint.objects.bulk_create(
+                build_schedule(
+                    thermostat.id, now, end, rules, thermostat_exceptions, fingerprint
+                )
+            )
+        refreshed.append(thermostat.id)
+    return refreshed
+
+
+def get_current_setpoints(now=None, thermostat_ids=None):
+    """Return the ScheduledSetpoint in effect at now by thermostat id."""
+    now = now or timezone.now()
+    setpoints = ScheduledSetpoint.objects.filter(at__lte=now, until__gt=now)
+    if thermostat_ids is not None:
+        setpoints = setpoints.filter(thermostat_id__in=thermostat_ids)
+    return {setpoint.thermostat_id: setpoint for setpoint in setpoints}
+
+
+def get_upcoming_setpoints(start, end):
+    """Return the ScheduledSetpoints starting within (start, end] by time."""
+    return ScheduledSetpoint.objects.filter(at__gt=start, at__lte=end).order_by("at")
@@ -0,0 +1,131 @@
+"""Split the thermostats between several sync workers.
+
+Every thermostat belongs to a shard, derived from a hash of its AIN so it
+stays stable across processes and machines. Workers check in as SyncWorker
+on every cycle and hold a ShardLease per shard they sync. The live workers
+(sorted by name) agree on how many shards each of them should hold, hand
+back the ones above their quota and claim expired ones with a conditional
+UPDATE, so a shard never has two owners. When a worker dies its leases
+expire and are taken over by the others.
+
+"""
+import logging
+import os
+import socket
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from thermostats.thermostats.models import ShardLease, SyncWorker
+
+logger = logging.getLogger("thermostats.shards")
+
+
+def get_default_worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def get_shard(ain, shards=None):
+    shards = shards or settings.SYNC_SHARDS
+    return zlib.crc32(ain.encode("utf-8")) % shards
+
+
+def get_quota(name, workers, shards):
+    """Return how many shards the named worker should hold."""
+    rank = sorted(workers).index(name)
+    quota, remainder = divmod(shards, len(workers))
+    return quota + (1 if rank < remainder else 0)
+
+
+def claim_shards(name, now=None, shards=None, lease_seconds=None):
+    """Check in, renew and rebalance leases, return the shards held by name."""
+    now = now or timezone.now()
+    shards = shards or settings.SYNC_SHARDS
+    lease = timedelta(seconds=lease_seconds or settings.SHARD_LEASE_SECONDS)
+    expires_at = now + lease
+
+    with transaction.atomic():
+        SyncWorker.objects.update_or_create(name=name, defaults={"last_seen_at": now})
+        existing = set(ShardLease.objects.values_list("shard", flat=True))
+        ShardLease.objects.bulk_create(
+            [
+                ShardLease(shard=shard, expires_at=now)
+                for shard in range(shards)
+                if shard not in existing
+            ],
+            ignore_conflicts=True,
+        )
+        ShardLease.objects.filter(owner=name).update(expires_at=expires_at)
+
+    workers = set(
+        SyncWorker.objects.filter(last_seen_at__gt=now - lease).values_list(
+            "name", flat=True
+        )
+    )
+    workers.add(name)
+    quota = get_quota(name, workers, shards)
+
+    held = list(
+        ShardLease.objects.filter(owner=name, shard__lt=shards)
+        .order_by("shard")
+        .values_list("shard", flat=True)
+    )
+    if len(held) > quota:
+        released = held[quota:]
+        ShardLease.objects.filter(owner=name, shard__in=released).update(
+            owner="", expires_at=now
+        )
+        logger.info(f"{name} handed back shard(s) {released}")
+        held = held[:quota]
+
+    free = ShardLease.objects.filter(shard__lt=shards).filter(
+        Q(owner="") | Q(expires_at__lte=now)
+    )
+    for lease_row in free.order_by("shard"):
+        if len(held) >= quota:
+            break
+        claimed = ShardLease.objects.filter(
+            pk=lease_row.pk, owner=lease_row.owner, expires_at=lease_row.expires_at
+        ).update(owner=name, expires_at=expires_at)
+        if claimed:
+            logger.info(f"{name} took over shard {lease_row.shard}")
+            held.append(lease_row.shard)
+
+    return sorted(held)
+
+
+def release_shards(name):
+    """Hand back all leases of the worker, e.g. when shutting down."""
+    ShardLease.objects.filter(owner=name).update(owner="", expires_at=timezone.now())
+    SyncWorker.objects.filter(name=name).delete()
+
+
+class ShardWorker:
+    """The sync of a Scheduler, limited to the shards this worker holds."""
+
+    def __init__(self, name=None, sync=None):
+        self.name = name or get_default_worker_name()
+        self.sync_shards = sync or self.call_sync
+        self.shards = []
+
+    @staticmethod
+    def call_sync(shards):
+        from django.core.management import call_command
+
+        call_command("sync_thermostats", f"--shards={','.join(map(str, shards))}")
+
+    def __call__(self):
+        self.shards = claim_shards(self.name)
+        if not self.shards:
+            logger.info(f"{self.name} holds no shards, not syncing")
+            return
+        self.sync_shards(self.shards)
+
+    @property
+    def max_interval(self):
+        """Check in often enough for the leases not to expire."""
+        return settings.SHARD_LEASE_SECONDS / 3
@@ -0,0 +1,241 @@
+"""Building blocks of the soak_test command.
+
+A FakeFritzbox simulates heating rooms, manual changes and flaky calls, so
+the scheduler can run through weeks of Rules in minutes. The probes read
+the resource usage of the current process, which is what a leak shows up
+in first on small hardware.
+
+"""
+import calendar
+import os
+import random
+from datetime import time, timedelta
+from statistics import median
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from thermostats.thermostats.models import (
+    DailySetpoint,
+    DeviceCommand,
+    ManualOverride,
+    Rule,
+    ScheduledSetpoint,
+    Thermostat,
+    ThermostatLog,
+    WeekDay,
+)
+
+# °C per hour while heating and while cooling down towards the outside.
+HEATING_RATE = 2.0
+COOLING_RATE = 0.5
+OUTSIDE_TEMPERATURE = 12.0
+
+# (weekday orders, start, end, temperature) of the Rules of every room.
+WEEKLY_RULES = (
+    ((0, 1, 2, 3, 4), time(6, 0), time(8, 0), 21.0),
+    ((0, 1, 2, 3, 4), time(17, 0), time(22, 30), 21.5),
+    ((5, 6), time(8, 0), time(23, 0), 22.0),
+    ((0, 1, 2, 3, 4, 5, 6), time(23, 0), time(5, 30), 17.0),
+)
+
+
+class FakeDevice:
+    def __init__(self, ain, name, target_temperature, actual_temperature):
+        self.ain = ain
+        self.name = name
+        self.target_temperature = target_temperature
+        self.actual_temperature = actual_temperature
+        self.has_thermostat = True
+
+
+class FakeFritzbox:
+    """Stands in for pyfritzhome's Fritzhome, with simulated rooms.
+
+    manual_change_rate and failure_rate are probabilities per device list
+    and per write. Like DECT thermostats, devices only take over a new
+    setpoint on their next wake-up, up to wakeup_minutes later.
+
+    """
+
+    def __init__(
+        self,
+        devices,
+        seed=0,
+        manual_change_rate=0.0,
+        failure_rate=0.0,
+        wakeup_minutes=0,
+    ):
+        self.devices = {device.ain: device for device in devices}
+        self.random = random.Random(seed)
+        self.manual_change_rate = manual_change_rate
+        self.failure_rate = failure_rate
+        self.wakeup_minutes = wakeup_minutes
+        # ain: (wake-up, setpoint) of writes not taken over yet.
+        self.pending = {}
+        self.updated_at = timezone.now()
+        self.calls = 0
+
+    def login(self):
+        self.calls += 1
+
+    def simulate(self):
+        now = timezone.now()
+        hours = (now - self.updated_at).total_seconds() / 3600
+        self.updated_at = now
+        for ain, (wakeup_at, temperature) in list(self.pending.items()):
+            if wakeup_at <= now:
+                self.devices[ain].target_temperature = temperature
+                del self.pending[ain]
+        for device in self.devices.values():
+            target = device.target_temperature
+            if (
+                target == settings.TEMPERATURE_OFF
+                or target <= device.actual_temperature
+            ):
+                device.actual_temperature = max(
+                    OUTSIDE_TEMPERATURE,
+                    device.actual_temperature - COOLING_RATE * hours,
+                )
+            else:
+                device.actual_temperature = min(
+                    target, device.actual_temperature + HEATING_RATE * hours
+                )
+            if self.random.random() < self.manual_change_rate:
+                device.target_temperature = float(self.random.randint(16, 24))
+
+    def get_devices(self):
+        self.calls += 1
+        self.simulate()
+        return list(self.devices.values())
+
+    def set_target_temperature(self, ain, temperature):
+        self.calls += 1
+        if self.random.random() < self.failure_rate:
+            raise ConnectionError("Simulated Fritz!Box failure")
+        delay = timedelta(minutes=self.random.uniform(0, self.wakeup_minutes))
+        self.pending[ain] = (timezone.now() + delay, temperature)
+        if not delay:
+            self.simulate()
+
+
+def create_rooms(count, prefix="SOAK"):
+    """Create thermostats with WEEKLY_RULES, return their FakeDevices."""
+    weekdays = {
+        order: WeekDay.objects.get_or_create(
+            order=order, defaults={"name": calendar.day_name[order]}
+        )[0]
+        for order in range(7)
+    }
+    devices = []
+    for index in range(count):
+        thermostat = Thermostat.objects.create(
+            ain=f"{prefix} {index:06d}", name=f"Room {index + 1}"
+        )
+        for orders, start_time, end_time, temperature in WEEKLY_RULES:
+            rule = Rule.objects.create(
+                name=f"Room {index + 1}",
+                start_time=start_time,
+                end_time=end_time,
+                temperature=temperature,
+            )
+            rule.weekdays.set([weekdays[order] for order in orders])
+            thermostat.rules.add(rule)
+        devices.append(
+            FakeDevice(thermostat.ain, thermostat.name, 17.0, OUTSIDE_TEMPERATURE)
+        )
+    return devices
+
+
+def get_rss_bytes():
+    """Resident memory of this process, or None where unsupported."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak instead of current usage, but still growing with a leak.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def count_open_sockets():
+    """Open sockets of this process (Linux only), or None."""
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    sockets = 0
+    for fd in fds:
+        try:
+            if os.readlink(f"/proc/self/fd/{fd}").startswith("socket:"):
+                sockets += 1
+        except OSError:
+            continue
+    return sockets
+
+
+def get_database_size():
+    """Size of the database in bytes on SQLite, otherwise None."""
+    if connection.vendor != "sqlite":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA page_count")
+        page_count = cursor.fetchone()[0]
+        cursor.execute("PRAGMA page_size")
+        return page_count * cursor.fetchone()[0]
+
+
+def count_rows():
+    return sum(
+        model.objects.count()
+        for model in (
+            ThermostatLog,
+            DeviceCommand,
+            DailySetpoint,
+            ManualOverride,
+            ScheduledSetpoint,
+        )
+    )
+
+
+def get_growth_rate(samples, key, warmup=0.1):
+    """Compare the growth per day of samples[key] in the first and last quarter.
+
+    Like get_growth(), returns (first, last), or None if there are too few
+    values.
+
+    """
+    samples = [sample for sample in samples if sample[key] is not None]
+    samples = samples[int(len(samples) * warmup) :]
+    quarter = len(samples) // 4
+    if quarter < 2:
+        return None
+    rates = []
+    for first, last in (
+        (samples[0], samples[quarter - 1]),
+        (samples[-quarter], samples[-1]),
+    ):
+        days = (last["at"] - first["at"]).total_seconds() / 86400
+        if days <= 0:
+            return None
+        rates.append((last[key] - first[key]) / days)
+    return tuple(rates)
+
+
+def get_growth(values, warmup=0.1):
+    """Compare the medians of the last and first quarter, after the warm-up.
+
+    Returns (first, last), or None if there are too few values.
+
+    """
+    values = [value for value in values if value is not None]
+    values = values[int(len(values) * warmup) :]
+    quarter = len(values) // 4
+    if quarter < 2:
+        return None
+    return median(values[:quarter]), median(values[-quarter:])
@@ -0,0 +1,107 @@
+"""A server-sent events stream of thermostat events, as a plain ASGI app."""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+
+from thermostats.thermostats.access import get_scope_token, is_valid_token
+from thermostats.thermostats.events import broker, get_events_since
+
+KEEPALIVE_SECONDS = 15
+
+
+def format_event(event):
+    data = json.dumps(event, sort_keys=True)
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {data}\n\n".encode()
+
+
+def get_last_event_id(scope):
+    for name, value in scope.get("headers", []):
+        if name == b"last-event-id":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def events_application(scope, receive, send, event_broker=broker):
+    # There are no sessions outside of Django, so only the token counts.
+    if not is_valid_token(get_scope_token(scope)):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 401,
+                "headers": [
+                    (b"content-type", b"text/plain"),
+                    (b"www-authenticate", b"Bearer"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": b"Authentication required"})
+        return
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+            ],
+        }
+    )
+
+    queue = event_broker.subscribe()
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        # Let reconnecting clients catch up on what they missed.
+        last_id = get_last_event_id(scope)
+        if last_id is not None:
+            for event in await sync_to_async(get_events_since)(last_id):
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": format_event(event),
+                        "more_body": True,
+                    }
+                )
+                last_id = event["id"]
+
+        while not disconnected.done():
+            next_event = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {next_event, disconnected},
+                timeout=KEEPALIVE_SECONDS,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if next_event not in done:
+                next_event.cancel()
+                if not disconnected.done():
+                    body = b": keepalive\n\n"
+                    await send(
+                        {"type": "http.response.body", "body": body, "more_body": True}
+                    )
+                continue
+
+            event = next_event.result()
+            if last_id is not None and event["id"] <= last_id:
+                continue
+            last_id = event["id"]
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": format_event(event),
+                    "more_body": True,
+                }
+            )
+    finally:
+        event_broker.unsubscribe(queue)
+        disconnected.cancel()
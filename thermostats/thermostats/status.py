@@ -0,0 +1,131 @@
+"""A snapshot of all thermostats, written by the sync and read by the views.
+
+The snapshot lives in Django's cache, so serving it needs neither a
+Fritz!Box connection nor database queries. Each shard (see shards.py) has
+a key of its own, written only by the worker syncing it, and the views
+merge them.
+
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from thermostats.thermostats.shards import get_shard
+
+STATUS_CACHE_KEY = "thermostats:status"
+
+
+def describe_rule(rule):
+    if rule is None:
+        return None
+    return {
+        "id": rule.id,
+        "description": rule.description,
+        "temperature": rule.temperature,
+    }
+
+
+def build_thermostat_status(
+    thermostat, device, rule=None, override=None, exception=None, scheduled=None
+):
+    """Return the status entry of a single thermostat as a dict.
+
+    scheduled is its current ScheduledSetpoint, if any, which saves
+    evaluating the Rules for the next transition.
+
+    """
+    next_transition = None
+    if exception is not None:
+        next_transition = {"at": exception.end.isoformat(), "temperature": None}
+    elif override is None and scheduled is not None:
+        if scheduled.next_temperature is not None:
+            next_transition = {
+                "at": scheduled.until.isoformat(),
+                "temperature": scheduled.next_temperature,
+            }
+    elif override is None:
+        transition = thermostat.get_next_transition()
+        if transition is not None:
+            at, temperature = transition
+            next_transition = {"at": at.isoformat(), "temperature": temperature}
+
+    return {
+        "id": thermostat.id,
+        "ain": thermostat.ain,
+        "name": thermostat.name,
+        "target_temperature": device.target_temperature,
+        "actual_temperature": device.actual_temperature,
+        "rule": describe_rule(rule),
+        "override": (
+            {
+                "temperature": override.temperature,
+                "detected_at": override.created_at.isoformat(),
+                "expires_at": override.expires_at.isoformat(),
+            }
+            if override is not None
+            else None
+        ),
+        "exception": (
+            {
+                "name": exception.name,
+                "temperature": exception.temperature,
+                "end": exception.end.isoformat(),
+            }
+            if exception is not None
+            else None
+        ),
+        "next_transition": next_transition,
+    }
+
+
+def get_status_key(shard):
+    return f"{STATUS_CACHE_KEY}:{shard}"
+
+
+def store_status(entries, shards=None):
+    """Put the given entries into the cache, replacing those of the shards.
+
+    Without shards, all of them are replaced.
+
+    """
+    if shards is None:
+        shards = range(settings.SYNC_SHARDS)
+    entries_by_shard = {shard: [] for shard in shards}
+    for entry in entries:
+        entries_by_shard[get_shard(entry["ain"])].append(entry)
+    generated_at = timezone.now().isoformat()
+    cache.set_many(
+        {
+            get_status_key(shard): {
+                "generated_at": generated_at,
+                "thermostats": shard_entries,
+            }
+            for shard, shard_entries in entries_by_shard.items()
+        },
+        timeout=None,
+    )
+
+
+def get_status():
+    """Return the {'etag': ..., 'body': ...} snapshot of all shards, or None."""
+    parts = cache.get_many(
+        [get_status_key(shard) for shard in range(settings.SYNC_SHARDS)]
+    )
+    if not parts:
+        return None
+    entries = sorted(
+        (entry for part in parts.values() for entry in part["thermostats"]),
+        key=lambda entry: (entry["name"], entry["id"]),
+    )
+    body = json.dumps(
+        {
+            "generated_at": max(part["generated_at"] for part in parts.values()),
+            "thermostats": entries,
+        },
+        sort_keys=True,
+    )
+    etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+    return {"etag": etag, "body": body}
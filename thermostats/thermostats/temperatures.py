@@ -0,0 +1,17 @@
+from django.conf import settings
+
+
+def describe_temperature(temperature):
+    """Return a string description of the given temperature."""
+    if temperature == settings.TEMPERATURE_OFF:
+        return "off"
+    return f"{temperature} °C"
+
+
+def temperatures_equal(t1, t2):
+    """Handle 'off' reported as 126.5, but must be set as 0."""
+    if t1 == settings.TEMPERATURE_OFF:
+        t1 = 0
+    if t2 == settings.TEMPERATURE_OFF:
+        t2 = 0
+    return t1 == t2
@@ -1,15 +1,64 @@
+import asyncio
+import csv
+import io
+import json
 import logging
 import os
-from datetime import datetime, time, timedelta
+import random
+import subprocess
+import sys
+from datetime import date, datetime, time, timedelta
 
 import pytest
+import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.management import call_command
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
 from django.utils import timezone
 
 from freezegun import freeze_time
 from model_bakery import baker
-from thermostats.thermostats.models import Thermostat, WeekDay
+from thermostats.thermostats import eventlog, events
+from thermostats.thermostats.analysis import analyze_thermostat
+from thermostats.thermostats.cassettes import (
+    Player,
+    Recorder,
+    load_cassette,
+    load_snapshot,
+    save_cassette,
+    take_snapshot,
+)
+from thermostats.thermostats.engine import RuleEngine
+from thermostats.thermostats.health import (
+    check_health,
+    get_health_report,
+    measure,
+    record_call,
+)
+from thermostats.thermostats.intervals import ExceptionCalendar, IntervalIndex
+from thermostats.thermostats.models import (
+    RULE_PRECEDENCE,
+    DeviceCommand,
+    ManualOverride,
+    Rule,
+    Thermostat,
+    WeekDay,
+)
+from thermostats.thermostats.outbox import (
+    confirm_command,
+    enqueue_command,
+    get_confirmation_latencies,
+)
+from thermostats.thermostats.polling import Scheduler, get_poll_interval
+from thermostats.thermostats.reports import get_heating_report, rebuild_daily_setpoints
+from thermostats.thermostats.rulecache import MISSING, LRUCache, WinnerCache, winners
+from thermostats.thermostats.ruleset import RuleSet, rulesets
+from thermostats.thermostats.schedule import get_current_setpoints, refresh_schedule
+from thermostats.thermostats.shards import ShardWorker, claim_shards, get_shard
+from thermostats.thermostats.status import get_status, store_status
+from thermostats.thermostats.sse import events_application
+from thermostats.thermostats.writes import WriteCoalescer
 
 logger = logging.getLogger("thermostats.tests")
 
@@ -19,6 +68,14 @@ def utc_timezone(monkeypatch):
     monkeypatch.setattr("django.conf.settings.TIME_ZONE", "UTC")
 
 
+@pytest.fixture(autouse=True)
+def locmem_cache(settings):
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    cache.clear()
+
+
 @pytest.fixture(autouse=True)
 def default_weekdays(db):
     for name, order in (
@@ -108,6 +165,34 @@ class TestRuleIsValidNow:
         assert not rule.is_valid_now()
 
 
+class TestRuleGetCurrentEnd:
+    @freeze_time("2020-03-02 19:30")
+    def test_normal_range(self, all_weekdays):
+        rule = baker.make(
+            "thermostats.Rule", start_time=time(16, 0), end_time=time(22, 0)
+        )
+        assert rule.get_current_end() == datetime(
+            2020, 3, 2, 22, 0, tzinfo=timezone.utc
+        )
+
+    @freeze_time("2020-03-02 19:30")
+    def test_no_end(self, all_weekdays):
+        rule = baker.make("thermostats.Rule", start_time=time(16, 0))
+        assert rule.get_current_end() == datetime(2020, 3, 3, 0, 0, tzinfo=timezone.utc)
+
+    @pytest.mark.parametrize(
+        "now, expected_day", (("2020-03-02 23:30", 3), ("2020-03-02 05:30", 2))
+    )
+    def test_wrapping_range(self, all_weekdays, now, expected_day):
+        rule = baker.make(
+            "thermostats.Rule", start_time=time(22, 0), end_time=time(6, 0)
+        )
+        with freeze_time(now):
+            assert rule.get_current_end() == datetime(
+                2020, 3, expected_day, 6, 0, tzinfo=timezone.utc
+            )
+
+
 class TestRuleHasBeenTriggeredWithinTimeframeAlready:
     @freeze_time("16:30")
     def test_in_between_timeframe(self, all_weekdays):
@@ -224,18 +309,58 @@ class MockedFritzbox:
 
 
 class MockedDevice:
-    def __init__(self, ain, name, target_temperature):
+    def __init__(self, ain, name, target_temperature, actual_temperature=None):
         self.ain = ain
         self.name = name
         self.target_temperature = target_temperature
+        self.actual_temperature = actual_temperature
         self.has_thermostat = True
 
 
+class RecordingFritzbox(MockedFritzbox):
+    def __init__(self):
+        self.devices = []
+        self.set_calls = []
+        self.failures = 0
+
+    def set_target_temperature(self, ain, temperature):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Fritz!Box not reachable")
+        self.set_calls.append((ain, temperature))
+        for device in self.devices:
+            if device.ain == ain:
+                device.target_temperature = temperature
+
+
 def mocked_send_push_notification(message, title=None):
     logger.debug(title)
     logger.debug(message)
 
 
+@pytest.fixture
+def api_client(client, settings):
+    """A client sending the API_TOKEN, see access.py."""
+    settings.API_TOKEN = "secret"
+    client.defaults["HTTP_AUTHORIZATION"] = "Bearer secret"
+    return client
+
+
+@pytest.fixture
+def fritzbox(db, monkeypatch):
+    """Patch the sync command to talk to a RecordingFritzbox instead."""
+    fritzbox = RecordingFritzbox()
+    module = "thermostats.thermostats.management.commands.sync_thermostats"
+    monkeypatch.setattr(
+        f"{module}.send_push_notification", mocked_send_push_notification
+    )
+    monkeypatch.setattr(f"{module}.get_fritzbox_connection", lambda: fritzbox)
+    monkeypatch.setattr(
+        f"{module}.get_fritzbox_thermostat_devices", lambda: fritzbox.devices
+    )
+    return fritzbox
+
+
 def test_names_synced_and_new_device_created_automatically(db, monkeypatch):
     # Setup
     device_livingroom = MockedDevice("11962 0785015", "Living Room", 21)
@@ -288,3 +413,1725 @@ def test_names_synced_and_new_device_created_automatically(db, monkeypatch):
     thermostat_kitchen = Thermostat.objects.last()
     assert thermostat_kitchen.ain == device_kitchen.ain
     assert thermostat_kitchen.name == device_kitchen.name
+
+
+def test_thermostat_record_warmup_rate(db):
+    thermostat = baker.make("thermostats.Thermostat")
+    assert thermostat.get_warmup_minutes(18, 21) is None
+
+    for rate in (2, 4, 6):
+        thermostat.record_warmup_rate(rate)
+
+    assert thermostat.warmup_samples == 3
+    assert thermostat.warmup_rate == pytest.approx(4)
+    assert thermostat.warmup_rate_variance == pytest.approx(4)
+    assert thermostat.get_warmup_minutes(18, 21) == pytest.approx(45)
+    assert thermostat.get_warmup_minutes(22, 21) == 0
+
+
+@freeze_time("2020-03-02 19:30")  # Monday
+def test_rule_get_next_start(db):
+    tuesday = WeekDay.objects.get(order=1)
+    rule = baker.make("thermostats.Rule", weekdays=[tuesday], start_time=time(6, 0))
+    assert rule.get_next_start() == datetime(2020, 3, 3, 6, 0, tzinfo=timezone.utc)
+
+    rule.weekdays.set(WeekDay.objects.all())
+    rule.start_time = time(19, 0)
+    assert rule.get_next_start() == datetime(2020, 3, 3, 19, 0, tzinfo=timezone.utc)
+
+
+class TestPrestart:
+    @pytest.fixture
+    def thermostat(self, all_weekdays, fritzbox):
+        rule = baker.make(
+            "thermostats.Rule",
+            weekdays=all_weekdays,
+            start_time=time(8, 0),
+            end_time=time(10, 0),
+            temperature=22,
+        )
+        thermostat = baker.make(
+            "thermostats.Thermostat",
+            ain="11962 0785015",
+            name="Living Room",
+            rules=[rule],
+            warmup_samples=1,
+            warmup_rate=2,
+        )
+        fritzbox.devices.append(
+            MockedDevice(thermostat.ain, thermostat.name, 0, actual_temperature=20)
+        )
+        return thermostat
+
+    @freeze_time("2020-03-02 06:30")
+    def test_too_early_to_prestart(self, thermostat, fritzbox):
+        call_command("sync_thermostats")
+        assert fritzbox.set_calls == []
+
+    @freeze_time("2020-03-02 07:30")
+    def test_prestart_when_warmup_takes_longer(self, thermostat, fritzbox):
+        call_command("sync_thermostats")
+        assert fritzbox.set_calls == [(thermostat.ain, 22)]
+        assert thermostat.logs.get().actual_temperature == 20
+
+    def test_prestart_kept_until_rule_starts(self, thermostat, fritzbox):
+        with freeze_time("2020-03-02 07:00"):
+            call_command("sync_thermostats")
+        assert fritzbox.set_calls == [(thermostat.ain, 22)]
+
+        # Heating up faster than learned doesn't end the pre-start.
+        fritzbox.devices[0].actual_temperature = 21.5
+        for moment in ("07:02", "07:10", "07:40", "08:05"):
+            with freeze_time(f"2020-03-02 {moment}"):
+                call_command("sync_thermostats")
+        assert fritzbox.set_calls == [(thermostat.ain, 22)]
+
+    def test_manual_change_during_prestart(self, thermostat, fritzbox):
+        with freeze_time("2020-03-02 07:00"):
+            call_command("sync_thermostats")
+        with freeze_time("2020-03-02 07:05"):
+            call_command("sync_thermostats")
+        assert thermostat.logs.get().applied
+
+        # Someone turned it down by hand before the Rule started.
+        fritzbox.devices[0].target_temperature = 18
+        for moment in ("07:20", "07:40", "08:05"):
+            with freeze_time(f"2020-03-02 {moment}"):
+                call_command("sync_thermostats")
+        assert fritzbox.set_calls == [(thermostat.ain, 22)]
+
+        override = ManualOverride.objects.get()
+        assert override.temperature == 18
+        assert override.expires_at == datetime(2020, 3, 2, 10, 0, tzinfo=timezone.utc)
+
+    def test_warmup_rate_learned_when_target_reached(self, thermostat, fritzbox):
+        with freeze_time("2020-03-02 07:30"):
+            call_command("sync_thermostats")
+
+        device = fritzbox.devices[0]
+        device.target_temperature = 22
+        device.actual_temperature = 22
+        with freeze_time("2020-03-02 08:30"):
+            call_command("sync_thermostats")
+
+        thermostat.refresh_from_db()
+        assert thermostat.warmup_samples == 2
+        assert thermostat.warmup_rate == pytest.approx(2)
+        assert thermostat.logs.get().warmup_reached_at is not None
+
+
+class TestManualOverride:
+    @pytest.fixture
+    def thermostat(self, all_weekdays, fritzbox):
+        rule = baker.make(
+            "thermostats.Rule",
+            weekdays=all_weekdays,
+            start_time=time(16, 0),
+            end_time=time(22, 0),
+            temperature=22,
+        )
+        thermostat = baker.make(
+            "thermostats.Thermostat",
+            ain="11962 0785015",
+            name="Living Room",
+            rules=[rule],
+        )
+        fritzbox.devices.append(MockedDevice(thermostat.ain, thermostat.name, 0))
+        return thermostat
+
+    def test_override_detected_once_and_respected(self, thermostat, fritzbox):
+        with freeze_time("2020-03-02 16:10"):
+            call_command("sync_thermostats")
+        assert fritzbox.set_calls == [(thermostat.ain, 22)]
+        with freeze_time("2020-03-02 16:12"):
+            call_command("sync_thermostats")
+
+        # Someone turned it down by hand.
+        fritzbox.devices[0].target_temperature = 18
+        with freeze_time("2020-03-02 16:30"):
+            call_command("sync_thermostats")
+            call_command("sync_thermostats")
+
+        override = ManualOverride.objects.get()
+        assert override.thermostat == thermostat
+        assert override.temperature == 18
+        assert override.expires_at == datetime(2020, 3, 2, 22, 0, tzinfo=timezone.utc)
+        assert len(fritzbox.set_calls) == 1
+
+        with freeze_time("2020-03-02 21:59"):
+            assert ManualOverride.objects.active().exists()
+        with freeze_time("2020-03-02 22:00"):
+            assert not ManualOverride.objects.active().exists()
+
+    @freeze_time("2020-03-02 16:30")
+    def test_no_fritzbox_calls_when_all_overridden(self, thermostat, monkeypatch):
+        baker.make(
+            "thermostats.ManualOverride",
+            thermostat=thermostat,
+            temperature=18,
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+
+        def fail():
+            raise AssertionError("Fritz!Box should not be contacted")
+
+        monkeypatch.setattr(
+            (
+                "thermostats.thermostats.management.commands."
+                "sync_thermostats.get_fritzbox_thermostat_devices"
+            ),
+            fail,
+        )
+        call_command("sync_thermostats")
+
+
+def get_winning_rule_id(thermostat):
+    """The reference implementation on the Rule model instances."""
+    last_matching_rule = None
+    for rule in thermostat.enabled_rules.order_by(*RULE_PRECEDENCE):
+        if rule.is_valid_now():
+            last_matching_rule = rule
+    return last_matching_rule.id if last_matching_rule else None
+
+
+def test_rule_engine_parity_with_orm(all_weekdays):
+    rng = random.Random(42)
+    weekdays = list(all_weekdays)
+    rules = []
+    # Distinct start times, since the order of ties is up to the database.
+    for start in rng.sample(range(24 * 60), 60):
+        end = rng.randrange(24 * 60)
+        rules.append(
+            baker.make(
+                "thermostats.Rule",
+                weekdays=rng.sample(weekdays, rng.randint(0, 7)),
+                start_time=time(start // 60, start % 60),
+                end_time=time(end // 60, end % 60) if rng.random() < 0.8 else None,
+                temperature=rng.randint(16, 24),
+                enabled=rng.random() < 0.9,
+            )
+        )
+    thermostats = [
+        baker.make("thermostats.Thermostat", rules=rng.sample(rules, rng.randint(0, 8)))
+        for _ in range(15)
+    ]
+
+    engine = RuleEngine.from_db()
+    ruleset = RuleSet.load(version=1)
+    moments = ["2020-03-02 00:00", "2020-03-04 06:30", "2020-03-07 23:59:59"]
+    moments += [
+        f"2020-03-0{rng.randint(2, 8)} {rng.randint(0, 23)}:{rng.randint(0, 59)}:{rng.randint(0, 59)}"
+        for _ in range(30)
+    ]
+    for moment in moments:
+        with freeze_time(moment):
+            winners = engine.get_winning_rule_ids()
+            temperatures = engine.get_target_temperatures()
+            for thermostat in thermostats:
+                expected = get_winning_rule_id(thermostat)
+                rule = WinnerCache().get_matching_rule(
+                    ruleset, thermostat.id, timezone.now()
+                )
+                assert (rule.id if rule else None) == expected, moment
+                assert winners[thermostat.id] == expected, moment
+                if expected is None:
+                    assert temperatures[thermostat.id] == settings.TEMPERATURE_FALLBACK
+                else:
+                    assert temperatures[thermostat.id] == rule.temperature
+
+
+def test_rule_engine_without_rules(db):
+    thermostat = baker.make("thermostats.Thermostat")
+    engine = RuleEngine.from_db()
+    assert len(engine) == 0
+    assert engine.get_winning_rule_ids() == {thermostat.id: None}
+
+
+class TestWriteCoalescer:
+    @freeze_time("2020-03-02 16:00")
+    def test_superseded_and_repeated_writes_dropped(self, db):
+        thermostat = baker.make("thermostats.Thermostat")
+        writes = WriteCoalescer(window=300, min_interval=0)
+
+        soon = timezone.now() + timedelta(minutes=2)
+        assert not writes.request(thermostat, 18, superseded_at=soon)
+        later = timezone.now() + timedelta(minutes=10)
+        assert writes.request(thermostat, 19, superseded_at=later)
+        assert writes.request(thermostat, 20)
+
+        applied = []
+        writes.flush(lambda thermostat, temperature: applied.append(temperature))
+        assert applied == [20]
+        assert (writes.written, writes.dropped, writes.deferred) == (1, 2, 0)
+
+    @freeze_time("2020-03-02 16:00")
+    def test_min_interval_defers_writes(self, db):
+        thermostat = baker.make("thermostats.Thermostat")
+        baker.make(
+            "thermostats.ThermostatLog",
+            thermostat=thermostat,
+            created_at=timezone.now() - timedelta(minutes=5),
+        )
+        writes = WriteCoalescer(window=0, min_interval=600)
+        assert not writes.request(thermostat, 20)
+        assert writes.saved == 1
+
+        writes = WriteCoalescer(window=0, min_interval=240)
+        assert writes.request(thermostat, 20)
+
+
+@freeze_time("2020-03-02 21:58")
+def test_sync_skips_setpoint_about_to_end(all_weekdays, fritzbox):
+    rule = baker.make(
+        "thermostats.Rule",
+        weekdays=all_weekdays,
+        start_time=time(16, 0),
+        end_time=time(22, 0),
+        temperature=22,
+    )
+    thermostat = baker.make("thermostats.Thermostat", rules=[rule])
+    fritzbox.devices.append(MockedDevice(thermostat.ain, thermostat.name, 0))
+
+    call_command("sync_thermostats")
+    assert fritzbox.set_calls == []
+    assert not thermostat.logs.exists()
+
+
+class TestStatus:
+    def test_not_available_before_first_sync(self, api_client):
+        assert api_client.get("/status.json").status_code == 503
+
+    @freeze_time("2020-03-02 16:30")
+    def test_served_from_cache_with_etag(
+        self, all_weekdays, fritzbox, api_client, django_assert_num_queries
+    ):
+        rule = baker.make(
+            "thermostats.Rule",
+            name="Evening",
+            weekdays=all_weekdays,
+            start_time=time(16, 0),
+            end_time=time(22, 0),
+            temperature=22,
+        )
+        thermostat = baker.make(
+            "thermostats.Thermostat", ain="1", name="Living Room", rules=[rule]
+        )
+        fritzbox.devices.append(
+            MockedDevice(thermostat.ain, thermostat.name, 0, actual_temperature=19)
+        )
+        call_command("sync_thermostats")
+
+        with django_assert_num_queries(0):
+            response = api_client.get("/status.json")
+        assert response.status_code == 200
+        entry = response.json()["thermostats"][0]
+        assert entry["name"] == "Living Room"
+        assert entry["target_temperature"] == 22
+        assert entry["actual_temperature"] == 19
+        assert entry["rule"]["id"] == rule.id
+        assert entry["next_transition"] == {
+            "at": "2020-03-02T22:00:00+00:00",
+            "temperature": settings.TEMPERATURE_FALLBACK,
+        }
+
+        etag = response["ETag"]
+        response = api_client.get("/status.json", HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+
+        response = api_client.get("/status/")
+        assert response.status_code == 200
+        assert response["ETag"] != etag
+        assert "Living Room" in response.content.decode()
+
+        kinds = [event["kind"] for event in events.get_events_since(0)]
+        assert kinds == [events.CHANGE_APPLIED, events.READINGS]
+
+
+def test_events_kept_from_concurrent_publishers(db, monkeypatch):
+    now = timezone.now
+    interleaved = []
+
+    def now_with_another_publisher():
+        # Let another worker publish while this one is half way through.
+        if not interleaved:
+            interleaved.append(True)
+            events.publish(events.READINGS, ["other"])
+        return now()
+
+    monkeypatch.setattr(events.timezone, "now", now_with_another_publisher)
+    events.publish(events.READINGS, ["this"])
+    published = events.get_events_since(0)
+    assert sorted(event["data"] for event in published) == [["other"], ["this"]]
+    assert sorted(event["id"] for event in published) == [1, 2]
+
+    for _ in range(events.EVENTS_BACKLOG):
+        events.publish(events.READINGS, [])
+    published = events.get_events_since(0)
+    assert [event["id"] for event in published] == list(range(3, 103))
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        "/status.json",
+        "/status/",
+        "/health.json",
+        "/decisions.json",
+        "/reports/heating.json?start=2020-03-01&end=2020-03-31",
+    ],
+)
+def test_endpoints_need_staff_or_token(path, client, admin_client, settings):
+    assert client.get(path).status_code == 401
+    settings.API_TOKEN = "secret"
+    assert client.get(path, HTTP_AUTHORIZATION="Bearer wrong").status_code == 401
+    assert client.get(path, HTTP_AUTHORIZATION="Bearer secret").status_code != 401
+    separator = "&" if "?" in path else "?"
+    assert client.get(f"{path}{separator}token=secret").status_code != 401
+    assert admin_client.get(path).status_code != 401
+
+
+def test_event_stream_needs_token(settings):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def stream(scope):
+        messages.clear()
+        await events_application(scope, None, send)
+        return messages[0]["status"]
+
+    scope = {"type": "http", "path": "/events", "headers": []}
+    assert asyncio.run(stream(scope)) == 401
+    settings.API_TOKEN = "secret"
+    assert asyncio.run(stream(dict(scope, query_string=b"token=wrong"))) == 401
+
+
+def test_events_streamed_to_subscribers(transactional_db, settings):
+    settings.API_TOKEN = "secret"
+    events.publish(events.READINGS, [])
+    events.publish(events.READINGS, [])
+
+    async def stream():
+        broker = events.EventBroker(poll_interval=0.01)
+        disconnected = asyncio.Event()
+        bodies = []
+
+        async def receive():
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                bodies.append(message["body"].decode())
+                if len(bodies) == 2:
+                    disconnected.set()
+
+        scope = {
+            "type": "http",
+            "path": "/events",
+            "headers": [
+                (b"last-event-id", b"1"),
+                (b"authorization", b"Bearer secret"),
+            ],
+        }
+        task = asyncio.ensure_future(
+            events_application(scope, receive, send, event_broker=broker)
+        )
+        await asyncio.sleep(0.05)
+        await sync_to_async(events.publish)(events.MANUAL_OVERRIDE, {"thermostat": 1})
+        await asyncio.wait_for(task, timeout=5)
+        assert not broker.subscribers
+        return bodies
+
+    bodies = asyncio.run(stream())
+    assert bodies[0].startswith("id: 2\nevent: readings\n")
+    assert bodies[1].startswith("id: 3\nevent: manual_override\n")
+
+
+def test_sqlite_connection_configured(db):
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA busy_timeout")
+        assert cursor.fetchone()[0] == settings.DB_TIMEOUT * 1000
+
+
+@freeze_time("2020-03-02 16:30")
+def test_change_not_applied_twice_by_concurrent_runs(fritzbox):
+    from thermostats.thermostats.management.commands.sync_thermostats import (
+        apply_thermostat_change,
+    )
+
+    from django.db import connection
+
+    thermostat = baker.make("thermostats.Thermostat")
+    started_at = timezone.now() - timedelta(minutes=1)
+
+    # The lock is released before talking to the Fritz!Box.
+    depth = len(connection.savepoint_ids)
+    set_target_temperature = fritzbox.set_target_temperature
+
+    def set_outside_of_lock(ain, temperature):
+        assert len(connection.savepoint_ids) == depth
+        set_target_temperature(ain, temperature)
+
+    fritzbox.set_target_temperature = set_outside_of_lock
+    assert apply_thermostat_change(thermostat, 21, started_at=started_at)
+    assert not apply_thermostat_change(thermostat, 21, started_at=started_at)
+    assert fritzbox.set_calls == [(thermostat.ain, 21)]
+    assert thermostat.logs.count() == 1
+
+
+def test_interval_index():
+    index = IntervalIndex([(10, 20, "a"), (0, 5, "b"), (12, 14, "c"), (30, 40, "d")])
+    assert index.at(13) == ["c", "a"]
+    assert index.at(14) == ["a"]
+    assert index.at(5) == []
+    assert index.at(30) == ["d"]
+    assert not index.any_at(25)
+    assert index.any_at(0)
+    assert index.any_overlapping(19, 30)
+    assert not index.any_overlapping(20, 30)
+    assert not IntervalIndex([]).any_at(1)
+
+
+class TestCalendarException:
+    @pytest.fixture
+    def thermostat(self, all_weekdays, fritzbox):
+        rule = baker.make(
+            "thermostats.Rule",
+            weekdays=all_weekdays,
+            start_time=time(16, 0),
+            end_time=time(22, 0),
+            temperature=22,
+        )
+        thermostat = baker.make("thermostats.Thermostat", ain="1", rules=[rule])
+        fritzbox.devices.append(MockedDevice(thermostat.ain, thermostat.name, 22))
+        return thermostat
+
+    @freeze_time("2020-03-02 16:30")
+    def test_exception_overrides_rules_once(self, thermostat, fritzbox):
+        other_thermostat = baker.make("thermostats.Thermostat")
+        vacation = baker.make(
+            "thermostats.CalendarException",
+            name="Vacation",
+            start=timezone.now() - timedelta(days=1),
+            end=timezone.now() + timedelta(days=6),
+            temperature=16,
+            thermostats=[thermostat],
+        )
+        calendar = ExceptionCalendar.load()
+        assert calendar.get_active_exception(thermostat) == vacation
+        assert calendar.get_active_exception(other_thermostat) is None
+
+        call_command("sync_thermostats")
+        assert fritzbox.set_calls == [(thermostat.ain, 16)]
+        assert thermostat.logs.get().exception == vacation
+
+        # Changed by hand afterwards, leave it alone.
+        call_command("sync_thermostats")
+        assert len(fritzbox.set_calls) == 1
+
+    def test_rule_applied_again_after_exception_ended(self, thermostat, fritzbox):
+        fritzbox.devices[0].target_temperature = 18
+        baker.make(
+            "thermostats.CalendarException",
+            start=datetime(2020, 3, 2, 17, 0, tzinfo=timezone.utc),
+            end=datetime(2020, 3, 2, 19, 0, tzinfo=timezone.utc),
+            temperature=16,
+        )
+        for moment in ("16:10", "16:12", "17:05", "17:07", "19:05"):
+            with freeze_time(f"2020-03-02 {moment}"):
+                call_command("sync_thermostats")
+        assert fritzbox.set_calls == [
+            (thermostat.ain, 22),
+            (thermostat.ain, 16),
+            (thermostat.ain, 22),
+        ]
+        assert not ManualOverride.objects.exists()
+
+    def test_exception_applied_again_after_giving_up(
+        self, thermostat, fritzbox, settings
+    ):
+        settings.COMMAND_MAX_ATTEMPTS = 1
+        fritzbox.failures = 1
+        baker.make(
+            "thermostats.CalendarException",
+            start=datetime(2020, 3, 2, 12, 0, tzinfo=timezone.utc),
+            end=datetime(2020, 3, 16, 12, 0, tzinfo=timezone.utc),
+            temperature=16,
+        )
+        for moment in ("16:30", "16:40"):
+            with freeze_time(f"2020-03-02 {moment}"):
+                call_command("sync_thermostats")
+        assert fritzbox.set_calls == [(thermostat.ain, 16)]
+        assert list(
+            DeviceCommand.objects.order_by("id").values_list("state", flat=True)
+        ) == [DeviceCommand.FAILED, DeviceCommand.SENT]
+
+    @freeze_time("2020-03-02 16:30")
+    def test_past_and_disabled_exceptions_ignored(self, thermostat, fritzbox):
+        baker.make(
+            "thermostats.CalendarException",
+            start=timezone.now() - timedelta(days=7),
+            end=timezone.now() - timedelta(days=1),
+            temperature=16,
+        )
+        baker.make(
+            "thermostats.CalendarException",
+            start=timezone.now() - timedelta(days=1),
+            end=timezone.now() + timedelta(days=1),
+            temperature=16,
+            enabled=False,
+        )
+        assert len(ExceptionCalendar.load().index) == 0
+        call_command("sync_thermostats")
+        assert fritzbox.set_calls == []
+
+
+# Cumulative import time of a sync run. Generous on purpose, this should
+# catch heavy imports creeping back in, not be flaky.
+SYNC_IMPORT_BUDGET_SECONDS = 1.5
+
+
+def test_sync_runs_through_manage_py_with_trimmed_settings(tmp_path):
+    env = dict(
+        os.environ,
+        DB_NAME=str(tmp_path / "db.sqlite3"),
+        CACHE_LOCATION=str(tmp_path / "cache"),
+        SENTRY_DSN="",
+    )
+    env.pop("DJANGO_SETTINGS_MODULE", None)
+    manage_py = os.path.join(settings.BASE_DIR, "manage.py")
+
+    def run(*args):
+        return subprocess.run(
+            [sys.executable, *args],
+            cwd=settings.BASE_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+    run(manage_py, "migrate", "--verbosity=0")
+    # Everything overridden, so the sync gets by without a Fritz!Box.
+    run(
+        manage_py,
+        "shell",
+        "-c",
+        "\n".join(
+            (
+                "from datetime import timedelta",
+                "from django.utils import timezone",
+                "from thermostats.thermostats.models import *",
+                "for order in range(7):",
+                "    WeekDay.objects.create(name=str(order), order=order)",
+                "thermostat = Thermostat.objects.create(ain='1', name='Kitchen')",
+                "ManualOverride.objects.create(",
+                "    thermostat=thermostat,",
+                "    temperature=18,",
+                "    expires_at=timezone.now() + timedelta(hours=1),",
+                ")",
+            )
+        ),
+    )
+    result = run("-X", "importtime", manage_py, "sync_thermostats")
+
+    imported = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, module = line[len("import time:") :].split("|")
+        imported[module.strip()] = int(self_us)
+    for module in (
+        "django.contrib.admin",
+        "django.contrib.sessions",
+        "numpy",
+        "pushover",
+        "pyfritzhome",
+        "sentry_sdk",
+    ):
+        assert module not in imported, f"{module} is imported on startup"
+
+    total_seconds = sum(imported.values()) / 1_000_000
+    logger.info(f"sync startup imports took {total_seconds:.3f}s")
+    assert total_seconds < SYNC_IMPORT_BUDGET_SECONDS
+    assert "All thermostats are overridden manually" in result.stderr
+
+
+class TestCassettes:
+    login_response = {
+        "method": "GET",
+        "url": "http://fritz.box/login_sid.lua",
+        "offset": 0,
+        "duration": 0.2,
+        "status": 200,
+        "headers": {"Content-Type": "text/xml"},
+        "content": "<SessionInfo><SID>ff88e4d39354992f</SID></SessionInfo>",
+    }
+
+    def test_record_and_replay(self, all_weekdays, tmp_path):
+        rule = baker.make("thermostats.Rule", start_time=time(6, 0))
+        path = tmp_path / "run.json.gz"
+
+        # Let a Player act as the Fritz!Box while recording.
+        with Player([self.login_response], speed=0):
+            with Recorder() as recorder:
+                response = requests.get(
+                    "http://fritz.box/login_sid.lua?username=admin&response=secret"
+                )
+                assert response.status_code == 200
+            save_cassette(path, recorder, take_snapshot())
+
+        cassette = load_cassette(path)
+        interaction = cassette["interactions"][0]
+        assert interaction["url"] == (
+            "http://fritz.box/login_sid.lua?username=REDACTED&response=REDACTED"
+        )
+        assert interaction["content"] == self.login_response["content"]
+
+        Rule.objects.all().delete()
+        load_snapshot(cassette["snapshot"])
+        assert Rule.objects.filter(id=rule.id).exists()
+
+        with Player(cassette["interactions"], speed=0) as player:
+            response = requests.get("http://fritz.box/login_sid.lua?sid=1234")
+            assert "ff88e4d39354992f" in response.text
+            with pytest.raises(requests.ConnectionError):
+                requests.get("http://fritz.box/login_sid.lua")
+        assert player.played == 1
+
+    def test_requests_matched_per_thermostat(self):
+        url = "http://fritz.box/webservices/homeautoswitch.lua"
+        interactions = [
+            dict(
+                self.login_response,
+                url=f"{url}?switchcmd=sethkrtsoll&sid=REDACTED&ain={ain}&param=44",
+                content=ain,
+            )
+            for ain in ("11962+0785015", "11962+0785016")
+        ]
+        with Player(interactions, speed=0):
+            for ain in ("11962 0785016", "11962 0785015"):
+                response = requests.get(
+                    url,
+                    params={"switchcmd": "sethkrtsoll", "sid": "1", "ain": ain},
+                )
+                assert response.text == ain.replace(" ", "+")
+
+    def test_snapshot_leaves_out_old_logs(self, all_weekdays):
+        thermostat = baker.make("thermostats.Thermostat")
+        with freeze_time("2020-03-01 08:00"):
+            baker.make("thermostats.ThermostatLog", thermostat=thermostat)
+        with freeze_time("2020-03-04 08:00"):
+            log = baker.make("thermostats.ThermostatLog", thermostat=thermostat)
+            snapshot = json.loads(take_snapshot())
+        logs = [
+            obj["pk"] for obj in snapshot if obj["model"] == "thermostats.thermostatlog"
+        ]
+        assert logs == [log.id]
+
+    def test_replay_sync_command(self, all_weekdays, fritzbox, tmp_path):
+        path = tmp_path / "run.json.gz"
+        call_command("sync_thermostats", record=str(path))
+
+        Thermostat.objects.all().delete()
+        baker.make("thermostats.Thermostat", ain="new")
+        call_command("replay_sync", str(path), speed=0, load_snapshot=True)
+        assert not Thermostat.objects.filter(ain="new").exists()
+
+
+class TestHeatingReport:
+    @pytest.fixture
+    def thermostat(self, db):
+        thermostat = baker.make("thermostats.Thermostat", name="Kitchen")
+        for created_at, temperature in (
+            (datetime(2020, 3, 1, 22, 0), 20),
+            (datetime(2020, 3, 2, 2, 0), 16),
+            (datetime(2020, 3, 2, 8, 0), 21),
+        ):
+            baker.make(
+                "thermostats.ThermostatLog",
+                thermostat=thermostat,
+                temperature=temperature,
+                created_at=timezone.make_aware(created_at),
+            )
+        return thermostat
+
+    def test_aggregated_incrementally(self, thermostat):
+        daily = {
+            (row.date.day, row.temperature): row.minutes
+            for row in thermostat.daily_setpoints.all()
+        }
+        assert daily == {(1, 20): 120, (2, 20): 120, (2, 16): 360}
+
+        report = get_heating_report(date(2020, 3, 1), date(2020, 3, 2))
+        assert [(row["temperature"], row["hours"]) for row in report] == [
+            (16, 6),
+            (20, 4),
+            (21, 16),
+        ]
+        assert get_heating_report(date(2020, 3, 2), date(2020, 3, 2))[1]["hours"] == 2
+
+    def test_current_setpoint_counted_up_to_now(self, thermostat):
+        now = timezone.make_aware(datetime(2020, 3, 2, 11, 30))
+        report = get_heating_report(date(2020, 3, 2), date(2020, 3, 2), now=now)
+        assert [(row["temperature"], row["hours"]) for row in report] == [
+            (16, 6),
+            (20, 2),
+            (21, 3.5),
+        ]
+
+    def test_only_applied_logs_counted(self, thermostat):
+        log = baker.make(
+            "thermostats.ThermostatLog",
+            thermostat=thermostat,
+            temperature=17,
+            applied=False,
+            created_at=timezone.make_aware(datetime(2020, 3, 2, 10, 0)),
+        )
+        command = enqueue_command(log)
+        now = timezone.make_aware(datetime(2020, 3, 2, 11, 0))
+        report = get_heating_report(date(2020, 3, 2), date(2020, 3, 2), now=now)
+        assert [(row["temperature"], row["hours"]) for row in report][-1] == (21, 3)
+
+        confirm_command(command, now=now)
+        report = get_heating_report(date(2020, 3, 2), date(2020, 3, 2), now=now)
+        assert [(row["temperature"], row["hours"]) for row in report] == [
+            (16, 6),
+            (17, 1),
+            (20, 2),
+            (21, 2),
+        ]
+        confirm_command(command, now=now)
+        assert get_heating_report(date(2020, 3, 2), date(2020, 3, 2), now=now) == report
+
+    def test_rebuild_matches_incremental(self, thermostat):
+        before = get_heating_report(date(2020, 3, 1), date(2020, 3, 31))
+        rebuild_daily_setpoints()
+        assert get_heating_report(date(2020, 3, 1), date(2020, 3, 31)) == before
+
+    def test_command_and_endpoint(self, thermostat, api_client):
+        output = io.StringIO()
+        call_command("heating_report", month="2020-03", stdout=output)
+        assert "Kitchen" in output.getvalue()
+        assert "6.00 h" in output.getvalue()
+
+        response = api_client.get(
+            "/reports/heating.json?start=2020-03-01&end=2020-03-31"
+        )
+        assert response.json()["thermostats"][0]["hours"] == 6
+        assert api_client.get("/reports/heating.json").status_code == 400
+
+
+class TestRuleAnalysis:
+    def make_rule(self, start, end, weekdays, **kwargs):
+        return baker.make(
+            "thermostats.Rule",
+            start_time=start,
+            end_time=end,
+            weekdays=weekdays,
+            **kwargs,
+        )
+
+    def test_schedule_overlaps_shadowed_and_gaps(self, all_weekdays):
+        monday = all_weekdays.filter(order=0)
+        day = self.make_rule(time(6, 0), time(22, 0), monday, name="Day")
+        noon = self.make_rule(time(11, 0), time(13, 0), monday, name="Noon")
+        shadowed = self.make_rule(time(5, 0), time(6, 30), monday, name="Early")
+        never = self.make_rule(time(5, 0), None, [], name="Nowhere")
+        night = self.make_rule(time(23, 0), time(1, 0), monday, name="Night")
+        thermostat = baker.make(
+            "thermostats.Thermostat", rules=[day, noon, shadowed, never, night]
+        )
+
+        analysis = analyze_thermostat(thermostat)
+        schedule = [
+            (start, end, rule.name if rule else None)
+            for start, end, rule in analysis.schedule
+        ]
+        assert schedule == [
+            (0, 60, "Night"),
+            (60, 300, None),
+            (300, 360, "Early"),
+            (360, 660, "Day"),
+            (660, 780, "Noon"),
+            (780, 1320, "Day"),
+            (1320, 1380, None),
+            (1380, 1440, "Night"),
+            (1440, 10080, None),
+        ]
+        assert [rule.name for rule in analysis.shadowed_rules] == ["Nowhere"]
+        overlaps = [(a.name, b.name) for a, b in analysis.overlaps]
+        assert overlaps == [("Early", "Day"), ("Day", "Noon")]
+        assert (60, 300) in analysis.gaps
+
+    def test_warnings_on_admin_change_view_only(self, all_weekdays, admin_client):
+        early = self.make_rule(time(5, 0), time(7, 0), all_weekdays, name="Early")
+        wide = self.make_rule(time(6, 0), time(8, 0), all_weekdays, name="Wide")
+        thermostat = baker.make("thermostats.Thermostat", rules=[early, wide])
+
+        response = admin_client.get("/admin/thermostats/thermostat/")
+        assert "overlap:" not in response.content.decode()
+        response = admin_client.get(
+            f"/admin/thermostats/thermostat/{thermostat.id}/change/"
+        )
+        assert "overlap:" in response.content.decode()
+        response = admin_client.get("/admin/thermostats/thermostat/add/")
+        assert response.status_code == 200
+
+    def test_fully_shadowed_rule(self, all_weekdays):
+        wide = self.make_rule(time(8, 0), time(20, 0), all_weekdays, name="Wide")
+        inner = self.make_rule(time(7, 0), time(12, 0), all_weekdays, name="Inner")
+        thermostat = baker.make("thermostats.Thermostat", rules=[wide, inner])
+        # Inner starts first, so Wide (later start) wins where both apply.
+        assert analyze_thermostat(thermostat).shadowed_rules == []
+
+        inner.start_time = time(9, 0)
+        inner.save()
+        other = self.make_rule(time(9, 0), time(10, 0), all_weekdays, name="Other")
+        thermostat.rules.add(other)
+        analysis = analyze_thermostat(thermostat)
+        assert [rule.name for rule in analysis.shadowed_rules] == ["Other"]
+
+    def test_check_rules_command(self, all_weekdays):
+        rule = self.make_rule(time(8, 0), time(20, 0), [], name="Nowhere")
+        baker.make("thermostats.Thermostat", name="Office", rules=[rule])
+        output = io.StringIO()
+        with pytest.raises(CommandError):
+            call_command("check_rules", strict=True, schedule=True, stdout=output)
+        assert "never in effect: Nowhere" in output.getvalue()
+        assert "fallback" in output.getvalue()
+
+
+class TestPolling:
+    @freeze_time("2020-03-02 03:00")
+    def test_back_off_when_nothing_scheduled(self, db):
+        assert get_poll_interval() == settings.POLL_MAX_SECONDS
+
+    @pytest.mark.parametrize(
+        "now, expected",
+        (
+            ("2020-03-02 07:57", 3 * 60 + settings.POLL_BOUNDARY_DELAY_SECONDS),
+            ("2020-03-02 07:00", settings.POLL_PRESTART_SECONDS),
+            ("2020-03-02 02:00", settings.POLL_MAX_SECONDS),
+            ("2020-03-02 08:30", settings.POLL_MAX_SECONDS),
+            ("2020-03-02 09:59:30", settings.POLL_MIN_SECONDS),
+        ),
+    )
+    def test_poll_around_rule_boundaries(self, all_weekdays, now, expected):
+        rule = baker.make(
+            "thermostats.Rule",
+            weekdays=all_weekdays,
+            start_time=time(8, 0),
+            end_time=time(10, 0),
+        )
+        baker.make("thermostats.Thermostat", rules=[rule])
+        with freeze_time(now):
+            assert get_poll_interval() == expected
+
+    @freeze_time("2020-03-02 07:10")
+    def test_poll_more_often_when_manual_changes_are_likely(self, db):
+        thermostat = baker.make("thermostats.Thermostat")
+        for weeks in (1, 2, 3):
+            baker.make(
+                "thermostats.ManualOverride",
+                thermostat=thermostat,
+                temperature=18,
+                created_at=timezone.now() - timedelta(weeks=weeks, minutes=5),
+                expires_at=timezone.now() - timedelta(weeks=weeks) + timedelta(hours=1),
+            )
+        assert get_poll_interval() == settings.POLL_MAX_SECONDS / 4
+
+        with freeze_time("2020-03-02 09:10"):
+            assert get_poll_interval() == settings.POLL_MAX_SECONDS
+
+    @freeze_time("2020-03-02 03:00")
+    def test_scheduler(self, db):
+        syncs = []
+        sleeps = []
+        scheduler = Scheduler(sleep=sleeps.append, sync=lambda: syncs.append(1))
+        scheduler.run(cycles=3)
+        assert len(syncs) == 3
+        assert sleeps == [settings.POLL_MAX_SECONDS] * 3
+
+
+class TestDeviceCommands:
+    @pytest.fixture
+    def thermostat(self, all_weekdays, fritzbox):
+        rule = baker.make(
+            "thermostats.Rule",
+            weekdays=all_weekdays,
+            start_time=time(16, 0),
+            end_time=time(22, 0),
+            temperature=22,
+        )
+        thermostat = baker.make(
+            "thermostats.Thermostat", ain="11962 0785015", name="Kitchen", rules=[rule]
+        )
+        fritzbox.devices.append(MockedDevice(thermostat.ain, thermostat.name, 18))
+        return thermostat
+
+    def test_change_confirmed_by_next_device_list(self, thermostat, fritzbox):
+        with freeze_time("2020-03-02 16:10"):
+            call_command("sync_thermostats")
+        command = DeviceCommand.objects.get()
+        assert command.state == DeviceCommand.SENT
+        assert not command.log.applied
+
+        with freeze_time("2020-03-02 16:12"):
+            call_command("sync_thermostats")
+        command.refresh_from_db()
+        assert command.state == DeviceCommand.CONFIRMED
+        assert command.attempts == 1
+        assert command.log.applied
+        assert command.confirmation_latency == timedelta(minutes=2)
+        assert get_confirmation_latencies(
+            since=datetime(2020, 3, 2, tzinfo=timezone.utc)
+        ) == {
+            thermostat.id: {
+                "name": "Kitchen",
+                "confirmed": 1,
+                "median_seconds": 120.0,
+                "max_seconds": 120.0,
+            }
+        }
+        assert fritzbox.set_calls == [(thermostat.ain, 22)]
+
+    @freeze_time("2020-03-02 16:10")
+    def test_one_device_list_per_sync(self, thermostat, fritzbox, monkeypatch):
+        call_command("sync_thermostats")
+        calls = []
+
+        def get_devices():
+            calls.append(1)
+            return fritzbox.devices
+
+        monkeypatch.setattr(
+            (
+                "thermostats.thermostats.management.commands."
+                "sync_thermostats.get_fritzbox_thermostat_devices"
+            ),
+            get_devices,
+        )
+        call_command("sync_thermostats")
+        assert len(calls) == 1
+        assert DeviceCommand.objects.get().state == DeviceCommand.CONFIRMED
+
+    def test_failed_change_retried_with_backoff(self, thermostat, fritzbox):
+        fritzbox.failures = 1
+        with freeze_time("2020-03-02 16:10"):
+            call_command("sync_thermostats")
+        command = DeviceCommand.objects.get()
+        assert command.state == DeviceCommand.PENDING
+        assert not command.log.applied
+        assert command.next_attempt_at == datetime(
+            2020, 3, 2, 16, 11, tzinfo=timezone.utc
+        )
+        assert fritzbox.set_calls == []
+
+        # Not due yet, and no second change is made while one is open.
+        with freeze_time("2020-03-02 16:10:30"):
+            call_command("sync_thermostats")
+        assert fritzbox.set_calls == []
+
+        with freeze_time("2020-03-02 16:12"):
+            call_command("sync_thermostats")
+        command.refresh_from_db()
+        assert command.state == DeviceCommand.SENT
+        assert fritzbox.set_calls == [(thermostat.ain, 22)]
+
+        with freeze_time("2020-03-02 16:14"):
+            call_command("sync_thermostats")
+        command.refresh_from_db()
+        assert command.state == DeviceCommand.CONFIRMED
+        assert command.log.applied
+        assert fritzbox.set_calls == [(thermostat.ain, 22)]
+        assert thermostat.logs.count() == 1
+
+    def test_stale_change_not_retried(self, thermostat, fritzbox):
+        fritzbox.failures = 1
+        with freeze_time("2020-03-02 21:50"):
+            call_command("sync_thermostats")
+        stale = DeviceCommand.objects.get()
+        assert stale.state == DeviceCommand.PENDING
+
+        # The Rule has ended since, so the fallback is sent right away.
+        with freeze_time("2020-03-02 22:10"):
+            call_command("sync_thermostats")
+        stale.refresh_from_db()
+        assert stale.state == DeviceCommand.FAILED
+        assert fritzbox.set_calls == [(thermostat.ain, settings.TEMPERATURE_FALLBACK)]
+
+    def test_rule_triggered_again_after_giving_up(self, thermostat, fritzbox):
+        fritzbox.failures = settings.COMMAND_MAX_ATTEMPTS
+        moment = datetime(2020, 3, 2, 15, 10, tzinfo=timezone.utc)
+        for _ in range(settings.COMMAND_MAX_ATTEMPTS):
+            moment += timedelta(seconds=settings.COMMAND_RETRY_MAX_SECONDS)
+            with freeze_time(moment):
+                call_command("sync_thermostats")
+        failed, retried = DeviceCommand.objects.order_by("id")
+        assert failed.state == DeviceCommand.FAILED
+        assert failed.attempts == settings.COMMAND_MAX_ATTEMPTS
+        assert not failed.log.applied
+
+        # Giving up frees the Rule to be applied again by the same run.
+        assert retried.state == DeviceCommand.SENT
+        assert fritzbox.set_calls == [(thermostat.ain, 22)]
+        assert not ManualOverride.objects.exists()
+
+    def test_poll_soon_while_changes_unconfirmed(self, thermostat, settings):
+        with freeze_time("2020-03-02 16:10"):
+            call_command("sync_thermostats")
+            assert get_poll_interval() == settings.COMMAND_VERIFY_SECONDS
+
+            call_command("sync_thermostats")
+            assert get_poll_interval() > settings.COMMAND_VERIFY_SECONDS
+
+    def test_unconfirmed_change_sent_again(self, thermostat, fritzbox, monkeypatch):
+        # The device accepts the write but keeps reporting the old setpoint.
+        monkeypatch.setattr(
+            fritzbox,
+            "set_target_temperature",
+            lambda *args: fritzbox.set_calls.append(args),
+        )
+        with freeze_time("2020-03-02 16:10"):
+            call_command("sync_thermostats")
+        command = DeviceCommand.objects.get()
+        assert command.state == DeviceCommand.SENT
+
+        fritzbox.devices[0].target_temperature = 18
+        with freeze_time("2020-03-02 16:20"):
+            call_command("sync_thermostats")
+        assert len(fritzbox.set_calls) == 1
+
+        fritzbox.devices[0].target_temperature = 18
+        with freeze_time("2020-03-02 16:26"):
+            call_command("sync_thermostats")
+        command.refresh_from_db()
+        assert command.state == DeviceCommand.PENDING
+        assert "confirmed" in command.last_error
+
+        with freeze_time("2020-03-02 16:28"):
+            call_command("sync_thermostats")
+        assert len(fritzbox.set_calls) == 2
+
+
+class TestEventLog:
+    @pytest.fixture
+    def ring(self, monkeypatch):
+        ring = eventlog.RingBufferSink(100)
+        monkeypatch.setattr(eventlog.log, "sinks", [ring])
+        return ring
+
+    @freeze_time("2020-03-02 16:10")
+    def test_sync_decisions_emitted(self, all_weekdays, fritzbox, ring, api_client):
+        rules = [
+            baker.make(
+                "thermostats.Rule",
+                weekdays=all_weekdays,
+                start_time=start_time,
+                end_time=end_time,
+                temperature=22,
+            )
+            for start_time, end_time in ((time(6, 0), time(8, 0)), (time(16, 0), None))
+        ]
+        thermostat = baker.make(
+            "thermostats.Thermostat", ain="11962 0785015", name="Kitchen", rules=rules
+        )
+        fritzbox.devices.append(MockedDevice(thermostat.ain, thermostat.name, 18))
+        call_command("sync_thermostats")
+
+        events = ring.get_events()
+        assert [event["event"] for event in events] == [
+            eventlog.SYNC_STARTED,
+            eventlog.DEVICE_SEEN,
+            eventlog.RULE_SKIPPED,
+            eventlog.RULE_MATCHED,
+            eventlog.DECISION,
+            eventlog.CHANGE_APPLIED,
+            eventlog.SYNC_FINISHED,
+        ]
+        assert len({event["run"] for event in events}) == 1
+        assert all(event["elapsed_ms"] >= 0 for event in events)
+        assert events[4]["action"] == "change"
+        assert events[5]["temperature"] == 22
+        assert "duration_ms" in events[5]
+        assert events[-1]["changes"] == 1
+
+        response = api_client.get(f"/decisions.json?thermostat={thermostat.id}")
+        assert [event["event"] for event in response.json()["events"]] == [
+            event["event"] for event in events if "thermostat" in event
+        ]
+
+    @freeze_time("2020-03-02 16:10")
+    def test_failed_change_emitted(self, all_weekdays, fritzbox, ring):
+        rule = baker.make(
+            "thermostats.Rule",
+            weekdays=all_weekdays,
+            start_time=time(16, 0),
+            temperature=22,
+        )
+        thermostat = baker.make(
+            "thermostats.Thermostat", ain="11962 0785015", rules=[rule]
+        )
+        fritzbox.devices.append(MockedDevice(thermostat.ain, thermostat.name, 18))
+        fritzbox.failures = 1
+        call_command("sync_thermostats")
+
+        kinds = [event["event"] for event in ring.get_events()]
+        assert eventlog.CHANGE_APPLIED not in kinds
+        failed = ring.get_events()[kinds.index(eventlog.CHANGE_FAILED)]
+        assert failed["thermostat"] == thermostat.id
+        assert "not reachable" in failed["error"]
+        assert "duration_ms" in failed
+
+    def test_ring_buffers_merged_between_processes(self):
+        first, second = eventlog.RingBufferSink(3), eventlog.RingBufferSink(3)
+        with freeze_time("2020-03-02 16:10") as frozen:
+            for ring, thermostat in ((first, 1), (second, 2), (first, 3), (second, 4)):
+                log = eventlog.EventLog(sinks=[ring])
+                log.emit(eventlog.DEVICE_SEEN, thermostat=thermostat)
+                log.flush()
+                log.flush()
+                frozen.tick()
+        events = eventlog.get_recent_events()
+        assert [event["thermostat"] for event in events] == [2, 3, 4]
+
+    def test_buffered_json_lines(self, tmp_path):
+        path = tmp_path / "events.jsonl"
+        log = eventlog.EventLog(
+            sinks=[eventlog.BufferedSink(eventlog.JSONLinesSink(path))]
+        )
+        log.start_run()
+        for index in range(50):
+            log.emit(eventlog.DEVICE_SEEN, thermostat=index)
+        log.finish_run()
+        log.flush()
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert len(lines) == 52
+        assert [line["thermostat"] for line in lines[1:-1]] == list(range(50))
+        log.close()
+
+
+class TestShards:
+    def test_leases_rebalanced_between_workers(self, db):
+        now = timezone.now()
+        assert claim_shards("a", now, shards=4) == [0, 1, 2, 3]
+        assert claim_shards("b", now, shards=4) == []
+
+        # a notices b and hands back its share, which b then takes.
+        now += timedelta(seconds=10)
+        assert claim_shards("a", now, shards=4) == [0, 1]
+        assert claim_shards("b", now, shards=4) == [2, 3]
+
+        # a dies, so b takes over once the leases of a have expired.
+        now += timedelta(seconds=settings.SHARD_LEASE_SECONDS - 5)
+        assert claim_shards("b", now, shards=4) == [2, 3]
+        now += timedelta(seconds=10)
+        assert claim_shards("b", now, shards=4) == [0, 1, 2, 3]
+
+    @freeze_time("2020-03-02 16:10")
+    def test_worker_only_syncs_its_shards(self, all_weekdays, fritzbox, settings):
+        settings.SYNC_SHARDS = 2
+        ains = ["11962 0785015", "11962 0785016", "11962 0785017", "11962 0785018"]
+        for ain in ains:
+            rule = baker.make(
+                "thermostats.Rule",
+                weekdays=all_weekdays,
+                start_time=time(16, 0),
+                end_time=time(22, 0),
+                temperature=22,
+            )
+            baker.make("thermostats.Thermostat", ain=ain, name=ain, rules=[rule])
+            fritzbox.devices.append(MockedDevice(ain, ain, 18))
+        shards = {get_shard(ain) for ain in ains}
+        assert shards == {0, 1}
+
+        worker = ShardWorker(name="a")
+        baker.make(
+            "thermostats.ShardLease",
+            shard=1,
+            owner="b",
+            expires_at=timezone.now() + timedelta(minutes=5),
+        )
+        worker()
+        assert worker.shards == [0]
+        assert sorted(ain for ain, _ in fritzbox.set_calls) == [
+            ain for ain in ains if get_shard(ain) == 0
+        ]
+
+        call_command("sync_thermostats", "--shards=1")
+        assert len(fritzbox.set_calls) == len(ains)
+        status = json.loads(get_status()["body"])
+        assert sorted(entry["ain"] for entry in status["thermostats"]) == ains
+
+    def test_status_stored_per_shard(self, settings):
+        settings.SYNC_SHARDS = 2
+        entries = {
+            get_shard(ain): {"id": index, "ain": ain, "name": ain}
+            for index, ain in enumerate(("11962 0785018", "11962 0785015"))
+        }
+        assert set(entries) == {0, 1}
+        # Workers store their shards without reading the others' entries.
+        store_status([entries[0]], shards={0})
+        store_status([entries[1]], shards={1})
+        status = json.loads(get_status()["body"])
+        assert status["thermostats"] == [entries[1], entries[0]]
+
+        store_status([], shards={0})
+        assert json.loads(get_status()["body"])["thermostats"] == [entries[1]]
+
+
+class TestRuleCache:
+    @pytest.fixture
+    def thermostat(self, all_weekdays):
+        rules = [
+            baker.make(
+                "thermostats.Rule",
+                weekdays=all_weekdays,
+                start_time=time(8, 0),
+                end_time=time(10, 0),
+                temperature=21,
+            ),
+            baker.make(
+                "thermostats.Rule",
+                weekdays=all_weekdays,
+                start_time=time(22, 0),
+                end_time=None,
+                temperature=17,
+            ),
+        ]
+        return baker.make("thermostats.Thermostat", rules=rules)
+
+    def test_lru_cache(self):
+        lru = LRUCache(2)
+        lru.set("a", 1)
+        lru.set("b", None)
+        assert lru.get("a") == 1
+        lru.set("c", 3)
+        assert lru.get("b") is MISSING
+        assert lru.get("a") == 1
+        assert len(lru) == 2
+
+    @pytest.mark.parametrize(
+        "moment",
+        (
+            "2020-03-02 07:59:59",
+            "2020-03-02 08:00:00",
+            "2020-03-02 09:30:00",
+            "2020-03-02 10:00:00",
+            "2020-03-02 10:00:01",
+            "2020-03-02 23:59:59.500",
+            "2020-03-03 00:00:00",
+        ),
+    )
+    def test_same_result_as_uncached(self, thermostat, moment):
+        moment = timezone.make_aware(datetime.fromisoformat(moment))
+        expected = None
+        for rule in thermostat.enabled_rules.order_by(*RULE_PRECEDENCE):
+            if rule.is_valid_at(moment):
+                expected = rule.id
+        ruleset = RuleSet.load(version=1)
+        cache = WinnerCache(alias="default")
+        rule = cache.get_matching_rule(ruleset, thermostat.id, moment)
+        assert (rule.id if rule else None) == expected
+        # Served from the shared cache by another process.
+        rule = WinnerCache(alias="default").get_matching_rule(
+            ruleset, thermostat.id, moment
+        )
+        assert (rule.id if rule else None) == expected
+
+    def test_invalidated_when_rules_change(self, thermostat, django_assert_num_queries):
+        moment = datetime(2020, 3, 2, 9, 30, tzinfo=timezone.utc)
+        assert thermostat.get_matching_rule(moment).temperature == 21
+        with django_assert_num_queries(0):
+            assert thermostat.get_matching_rule(moment).temperature == 21
+
+        rule = Rule.objects.get(id=thermostat.get_matching_rule(moment).id)
+        rule.enabled = False
+        rule.save()
+        assert thermostat.get_matching_rule(moment) is None
+
+        rule.enabled = True
+        rule.save()
+        thermostat.rules.remove(rule)
+        assert thermostat.get_matching_rule(moment) is None
+        assert winners.local.hits >= 1
+
+    @freeze_time("2020-03-02 09:30")
+    def test_shared_with_the_sync(self, thermostat, fritzbox):
+        thermostat.ain = "11962 0785015"
+        thermostat.save()
+        fritzbox.devices.append(MockedDevice(thermostat.ain, thermostat.name, 18))
+        call_command("sync_thermostats")
+        assert fritzbox.set_calls == [(thermostat.ain, 21)]
+
+        hits = winners.local.hits
+        assert thermostat.get_matching_rule().temperature == 21
+        assert winners.local.hits == hits + 1
+
+
+class TestLogExport:
+    @pytest.fixture
+    def logs(self, db):
+        thermostat = baker.make("thermostats.Thermostat", ain="11962 0785015")
+        rule = baker.make("thermostats.Rule", start_time=time(8, 0), end_time=None)
+        for day, temperature in ((1, 21), (2, 17.5), (3, 21)):
+            with freeze_time(datetime(2020, 3, day, 8, 0)):
+                baker.make(
+                    "thermostats.ThermostatLog",
+                    thermostat=thermostat,
+                    rule=rule if day != 2 else None,
+                    start_time=time(8, 0),
+                    temperature=temperature,
+                )
+        return thermostat.logs.all()
+
+    def test_export_filters_by_day(self, logs):
+        output = io.StringIO()
+        call_command(
+            "export_logs", "--start=2020-03-02", "--end=2020-03-02", stdout=output
+        )
+        rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+        assert len(rows) == 1
+        assert rows[0]["thermostat_ain"] == "11962 0785015"
+        assert rows[0]["temperature"] == "17.5"
+        assert rows[0]["rule_id"] == ""
+
+    def test_round_trip(self, logs, tmp_path):
+        path = str(tmp_path / "logs.csv")
+        call_command("export_logs", f"--output={path}", stdout=io.StringIO())
+        expected = list(logs.values_list("created_at", "start_time", "temperature"))
+        report = get_heating_report(date(2020, 3, 1), date(2020, 3, 3))
+        Thermostat.objects.all().delete()
+
+        call_command("import_logs", path, "--batch-size=2", stdout=io.StringIO())
+        call_command("import_logs", path, stdout=io.StringIO())
+        thermostat = Thermostat.objects.get()
+        assert thermostat.ain == "11962 0785015"
+        assert (
+            list(thermostat.logs.values_list("created_at", "start_time", "temperature"))
+            == expected
+        )
+        assert get_heating_report(date(2020, 3, 1), date(2020, 3, 3)) == [
+            {**row, "thermostat": thermostat.id} for row in report
+        ]
+
+    def test_parquet_round_trip(self, logs, tmp_path):
+        pytest.importorskip("pyarrow")
+        path = str(tmp_path / "logs.parquet")
+        call_command(
+            "export_logs",
+            "--format=parquet",
+            f"--output={path}",
+            "--chunk-size=2",
+            stdout=io.StringIO(),
+        )
+        fields = ("created_at", "rule_id", "start_time", "end_time", "temperature")
+        expected = list(logs.order_by("created_at").values_list(*fields))
+        Thermostat.objects.all().delete()
+
+        call_command("import_logs", path, stdout=io.StringIO())
+        thermostat = Thermostat.objects.get()
+        assert thermostat.ain == "11962 0785015"
+        assert list(thermostat.logs.order_by("created_at").values_list(*fields)) == [
+            (created_at, None, start_time, end_time, temperature)
+            for created_at, _, start_time, end_time, temperature in expected
+        ]
+
+
+class TestRuleSet:
+    @pytest.fixture
+    def thermostat(self, db):
+        weekdays = list(WeekDay.objects.filter(order__in=(0, 2, 6)))
+        rules = [
+            baker.make(
+                "thermostats.Rule",
+                name=f"Rule {index}",
+                weekdays=weekdays,
+                start_time=start_time,
+                end_time=end_time,
+                temperature=17 + index,
+            )
+            for index, (start_time, end_time) in enumerate(
+                (
+                    (time(6, 0), time(8, 30)),
+                    (time(6, 0), None),
+                    (time(22, 0), time(5, 0)),
+                )
+            )
+        ]
+        baker.make(
+            "thermostats.Rule", enabled=False, weekdays=weekdays, start_time=time(7, 0)
+        )
+        return baker.make("thermostats.Thermostat", rules=rules)
+
+    def test_same_semantics_as_rules(self, thermostat):
+        snapshots = RuleSet.load().get(thermostat.id)
+        rules = list(thermostat.enabled_rules.order_by(*RULE_PRECEDENCE))
+        assert [snapshot.id for snapshot in snapshots] == [rule.id for rule in rules]
+        assert [str(snapshot) for snapshot in snapshots] == [str(r) for r in rules]
+
+        moment = datetime(2020, 3, 1, 0, 0, tzinfo=timezone.utc)
+        while moment < datetime(2020, 3, 9, tzinfo=timezone.utc):
+            for snapshot, rule in zip(snapshots, rules):
+                assert snapshot.is_valid_at(moment) == rule.is_valid_at(moment)
+                assert snapshot.get_next_start(moment) == rule.get_next_start(moment)
+            moment += timedelta(minutes=30)
+
+    @freeze_time("2020-03-02 16:30")
+    def test_sync_reads_no_rules(self, thermostat, fritzbox):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        fritzbox.devices.append(MockedDevice(thermostat.ain, thermostat.name, 0))
+        rulesets.get()
+        with CaptureQueriesContext(connection) as queries:
+            call_command("sync_thermostats")
+            call_command("sync_thermostats")
+            fritzbox.devices[0].target_temperature = 21
+            call_command("sync_thermostats")
+        assert fritzbox.set_calls == [(thermostat.ain, 18)]
+        assert ManualOverride.objects.get().rule == thermostat.rules.get(
+            start_time=time(6, 0), end_time=None
+        )
+        assert not [
+            query["sql"]
+            for query in queries.captured_queries
+            if '"thermostats_rule' in query["sql"]
+        ]
+
+    def test_reused_until_rules_change(self, thermostat, django_assert_num_queries):
+        ruleset = rulesets.get()
+        with django_assert_num_queries(0):
+            assert rulesets.get() is ruleset
+        with pytest.raises(AttributeError):
+            ruleset.get(thermostat.id)[0].temperature = 30
+
+        rule = thermostat.rules.first()
+        rule.temperature = 30
+        rule.save()
+        assert rulesets.get() is not ruleset
+        assert 30 in [
+            snapshot.temperature for snapshot in rulesets.get().get(thermostat.id)
+        ]
+
+
+class TestHealth:
+    def test_report(self, settings):
+        settings.HEALTH_LATENCY_BUDGET_MS = 1000
+        for index in range(20):
+            record_call("set", 0.1 if index < 18 else 2.5)
+        record_call("devices", 0.3)
+        report = get_health_report()
+        assert report["operations"]["set"]["calls"] == 20
+        assert report["operations"]["set"]["p50_ms"] == 100
+        assert report["operations"]["set"]["p95_ms"] == 2500
+        assert report["operations"]["login"]["p95_ms"] is None
+        assert report["problems"] == ["p95 set latency 2500 ms over budget of 1000 ms"]
+        output = io.StringIO()
+        with pytest.raises(CommandError):
+            call_command("thermostat_health", "--strict", stdout=output)
+        assert "p95  2500 ms" in output.getvalue()
+
+        with freeze_time(
+            timezone.now() + timedelta(seconds=settings.HEALTH_WINDOW_SECONDS + 1)
+        ):
+            assert get_health_report()["healthy"]
+
+    def test_sid_invalidations_counted(self, settings):
+        settings.HEALTH_MAX_ERROR_RATE = 1
+        response = requests.Response()
+        response.status_code = 403
+        for _ in range(settings.HEALTH_MAX_SID_INVALIDATIONS + 1):
+            with pytest.raises(requests.HTTPError):
+                with measure("devices"):
+                    raise requests.HTTPError(response=response)
+            record_call("login", 0.1)
+        report = get_health_report()
+        assert report["sid_invalidations"] == settings.HEALTH_MAX_SID_INVALIDATIONS + 1
+        assert not report["healthy"]
+        assert not report["down"]
+
+    def test_single_alert_per_outage(self, db, api_client):
+        alerts = []
+
+        def notify(message, title=None):
+            alerts.append(title)
+
+        now = timezone.now()
+        record_call("login", 0.1, now=now)
+        for minutes in range(1, 10):
+            record_call(
+                "login",
+                0.1,
+                error=ConnectionError(),
+                now=now + timedelta(minutes=minutes),
+            )
+            check_health(notify, now=now + timedelta(minutes=minutes))
+        assert alerts == ["Fritz!Box down"]
+        with freeze_time(now + timedelta(minutes=10)):
+            assert api_client.get("/health.json").status_code == 503
+
+        later = now + timedelta(hours=2)
+        for minutes in range(5):
+            record_call("login", 0.1, now=later + timedelta(minutes=minutes))
+            check_health(notify, now=later + timedelta(minutes=minutes))
+        assert alerts == ["Fritz!Box down", "Fritz!Box recovered"]
+
+    def test_no_alert_on_few_calls(self, settings):
+        alerts = []
+        record_call("set", 0.1, error=ConnectionError())
+        record_call("set", 0.1)
+        report = check_health(lambda message, title=None: alerts.append(title))
+        assert report["operations"]["set"]["error_rate"] == 0.5
+        assert report["healthy"]
+        assert alerts == []
+
+    def test_recovery_below_lower_limits(self, settings):
+        settings.HEALTH_LATENCY_BUDGET_MS = 1000
+        alerts = []
+
+        def notify(message, title=None):
+            alerts.append(title)
+
+        now = timezone.now()
+        for index, duration in enumerate([0.1] * 18 + [1.2] * 2):
+            record_call("set", duration, now=now + timedelta(seconds=index))
+        assert not check_health(notify, now=now)["healthy"]
+
+        # Just under the budget isn't enough to recover.
+        now += timedelta(seconds=settings.HEALTH_WINDOW_SECONDS + 30)
+        for index, duration in enumerate([0.1] * 18 + [0.9] * 2):
+            record_call("set", duration, now=now + timedelta(seconds=index))
+        report = check_health(notify, now=now + timedelta(seconds=20))
+        assert report["problems"] == ["p95 set latency 900 ms over budget of 800 ms"]
+
+        now += timedelta(seconds=settings.HEALTH_WINDOW_SECONDS + 30)
+        for index in range(20):
+            record_call("set", 0.1, now=now + timedelta(seconds=index))
+        assert check_health(notify, now=now + timedelta(seconds=20))["healthy"]
+        assert alerts == ["Fritz!Box degraded", "Fritz!Box recovered"]
+
+
+class TestSchedule:
+    @pytest.fixture
+    def thermostat(self, all_weekdays):
+        weekdays = all_weekdays.filter(order__lt=5)
+        rules = [
+            baker.make(
+                "thermostats.Rule",
+                weekdays=weekdays,
+                start_time=start_time,
+                end_time=end_time,
+                temperature=temperature,
+            )
+            for start_time, end_time, temperature in (
+                (time(6, 0), time(8, 0), 21),
+                (time(7, 30), time(9, 0), 22),
+                (time(17, 0), None, 21),
+                (time(23, 0), time(5, 30), 17),
+            )
+        ]
+        return baker.make("thermostats.Thermostat", rules=rules)
+
+    def test_matches_the_rules(self, thermostat):
+        now = datetime(2020, 3, 2, 12, 10, tzinfo=timezone.utc)
+        assert refresh_schedule(now) == [thermostat.id]
+
+        moment = now
+        while moment < now + timedelta(days=settings.SCHEDULE_DAYS):
+            rule = thermostat.get_matching_rule(moment)
+            expected = rule.temperature if rule else settings.TEMPERATURE_FALLBACK
+            assert get_current_setpoints(moment)[thermostat.id].temperature == expected
+            moment += timedelta(minutes=15)
+
+        setpoint = get_current_setpoints(
+            datetime(2020, 3, 3, 7, 45, tzinfo=timezone.utc)
+        )[thermostat.id]
+        assert setpoint.temperature == 22
+        assert setpoint.until == datetime(2020, 3, 3, 9, 0, tzinfo=timezone.utc)
+        assert setpoint.next_temperature == settings.TEMPERATURE_FALLBACK
+
+    def test_matches_the_rules_in_local_time(self, thermostat, settings):
+        settings.TIME_ZONE = "Europe/Berlin"
+        # Across the switch to daylight saving time on March 29th.
+        now = datetime(2020, 3, 26, 12, 10, tzinfo=timezone.utc)
+        assert refresh_schedule(now) == [thermostat.id]
+        assert refresh_schedule(timezone.localtime(now)) == []
+
+        moment = now
+        while moment < now + timedelta(days=settings.SCHEDULE_DAYS):
+            rule = thermostat.get_matching_rule(moment)
+            expected = rule.temperature if rule else settings.TEMPERATURE_FALLBACK
+            assert get_current_setpoints(moment)[thermostat.id].temperature == expected
+            moment += timedelta(minutes=15)
+
+        # 08:45 in Berlin, still in winter time.
+        moment = datetime(2020, 3, 27, 7, 45, tzinfo=timezone.utc)
+        assert thermostat.get_matching_rule(moment).temperature == 22
+        setpoint = get_current_setpoints(moment)[thermostat.id]
+        assert setpoint.temperature == 22
+        assert setpoint.until == datetime(2020, 3, 27, 8, 0, tzinfo=timezone.utc)
+        # 08:45 in Berlin, in summer time.
+        moment = datetime(2020, 3, 30, 6, 45, tzinfo=timezone.utc)
+        setpoint = get_current_setpoints(moment)[thermostat.id]
+        assert setpoint.temperature == 22
+        assert setpoint.until == datetime(2020, 3, 30, 7, 0, tzinfo=timezone.utc)
+
+        settings.TIME_ZONE = "UTC"
+        assert refresh_schedule(now) == [thermostat.id]
+        setpoint = get_current_setpoints(moment)[thermostat.id]
+        assert setpoint.temperature == 21
+
+    def test_refreshed_incrementally(self, thermostat, all_weekdays):
+        other = baker.make("thermostats.Thermostat")
+        now = datetime(2020, 3, 2, 12, 10, tzinfo=timezone.utc)
+        assert sorted(refresh_schedule(now)) == [thermostat.id, other.id]
+        assert refresh_schedule(now + timedelta(hours=6)) == []
+
+        baker.make(
+            "thermostats.CalendarException",
+            start=datetime(2020, 3, 4, tzinfo=timezone.utc),
+            end=datetime(2020, 3, 6, tzinfo=timezone.utc),
+            temperature=16,
+            thermostats=[thermostat],
+        )
+        assert refresh_schedule(now) == [thermostat.id]
+        setpoint = get_current_setpoints(datetime(2020, 3, 4, 7, tzinfo=timezone.utc))[
+            thermostat.id
+        ]
+        assert setpoint.temperature == 16
+        assert setpoint.exception is not None
+
+        rule = thermostat.rules.get(start_time=time(17, 0))
+        rule.temperature = 20
+        rule.save()
+        assert refresh_schedule(now) == [thermostat.id]
+
+        # Extended about once a day, to keep SCHEDULE_DAYS ahead.
+        assert refresh_schedule(now + timedelta(hours=20)) == []
+        assert sorted(refresh_schedule(now + timedelta(days=1, hours=1))) == [
+            thermostat.id,
+            other.id,
+        ]
+
+
+def test_soak_test(db):
+    output = io.StringIO()
+    call_command(
+        "soak_test",
+        "--days=1",
+        "--rooms=2",
+        "--max-latency-growth=100",
+        "--max-memory-growth=100",
+        "--max-storage-growth=100",
+        stdout=output,
+    )
+    assert "No upward trends" in output.getvalue()
+    assert "Rows added per day changed" in output.getvalue()
+    # Simulated in a database of its own.
+    assert not Thermostat.objects.exists()
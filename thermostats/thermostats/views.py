@@ -1,3 +1,100 @@
-from django.shortcuts import render
+import json
+from datetime import datetime
 
-# Create your views here.
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseNotModified,
+    JsonResponse,
+)
+from django.template.loader import render_to_string
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_safe
+
+from thermostats.thermostats.access import require_access
+from thermostats.thermostats.eventlog import get_recent_events
+from thermostats.thermostats.health import get_health_report
+from thermostats.thermostats.reports import get_heating_report
+from thermostats.thermostats.status import get_status
+
+
+def etag_matches(request, etag):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    return "*" in etags or etag in etags
+
+
+def cached_status_response(request, etag_suffix, render):
+    """Serve the cached status snapshot, honoring If-None-Match."""
+    status = get_status()
+    if status is None:
+        return JsonResponse({"error": "No status available yet"}, status=503)
+
+    etag = status["etag"][:-1] + etag_suffix + '"'
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = render(status["body"])
+    response["ETag"] = etag
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+@require_safe
+@require_access
+def status_json(request):
+    return cached_status_response(
+        request,
+        "",
+        lambda body: HttpResponse(body, content_type="application/json"),
+    )
+
+
+@require_safe
+@require_access
+def status_dashboard(request):
+    return cached_status_response(
+        request,
+        "-html",
+        lambda body: HttpResponse(
+            render_to_string("thermostats/status.html", json.loads(body))
+        ),
+    )
+
+
+@require_safe
+@require_access
+def heating_report(request):
+    try:
+        start = datetime.strptime(request.GET["start"], "%Y-%m-%d").date()
+        end = datetime.strptime(request.GET["end"], "%Y-%m-%d").date()
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("start and end must be given as YYYY-MM-DD")
+    return JsonResponse(
+        {
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "thermostats": get_heating_report(start, end),
+        }
+    )
+
+
+@require_safe
+@require_access
+def health(request):
+    report = get_health_report()
+    return JsonResponse(report, status=200 if report["healthy"] else 503)
+
+
+@require_safe
+@require_access
+def recent_decisions(request):
+    events = get_recent_events()
+    thermostat = request.GET.get("thermostat")
+    if thermostat is not None:
+        events = [
+            event for event in events if str(event.get("thermostat")) == thermostat
+        ]
+    return JsonResponse({"events": events})
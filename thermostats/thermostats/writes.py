@@ -0,0 +1,86 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger("thermostats.writes")
+
+
+class WriteCoalescer:
+    """Collect target temperature writes of a sync run and apply them at once.
+
+    Every write wakes up the DECT radio of the thermostat, so writes are
+    avoided where they would be pointless anyway:
+
+    - A setpoint that is superseded within the coalescing window is dropped,
+      the next run will write the newer one instead.
+    - A thermostat that has been written to less than the minimum interval
+      ago is deferred to a later run.
+    - Multiple writes to the same thermostat within a run only apply the
+      last one.
+
+    """
+
+    def __init__(self, window=None, min_interval=None):
+        if window is None:
+            window = settings.WRITE_COALESCE_SECONDS
+        if min_interval is None:
+            min_interval = settings.WRITE_MIN_INTERVAL_SECONDS
+        self.window = timedelta(seconds=window)
+        self.min_interval = timedelta(seconds=min_interval)
+        self.pending = {}
+        self.applied = {}
+        self.written = 0
+        self.dropped = 0
+        self.deferred = 0
+
+    @property
+    def saved(self):
+        return self.dropped + self.deferred
+
+    def request(self, thermostat, temperature, superseded_at=None, **kwargs):
+        """Queue a write, return whether it will be applied on flush()."""
+        now = timezone.now()
+        if superseded_at is not None and superseded_at - now <= self.window:
+            logger.info(
+                f"  dropping write of {temperature} to {thermostat.name}, "
+                f"superseded at {timezone.localtime(superseded_at):%H:%M}"
+            )
+            self.dropped += 1
+            return False
+
+        if self.min_interval:
+            last_write_at = thermostat.logs.values_list("created_at", flat=True).last()
+            if last_write_at is not None and now - last_write_at < self.min_interval:
+                logger.info(
+                    f"  deferring write of {temperature} to {thermostat.name}, "
+                    f"last write was at {timezone.localtime(last_write_at):%H:%M}"
+                )
+                self.deferred += 1
+                return False
+
+        if thermostat.id in self.pending:
+            self.dropped += 1
+        self.pending[thermostat.id] = (thermostat, temperature, kwargs)
+        return True
+
+    def flush(self, apply):
+        """Call apply(thermostat, temperature, **kwargs) for each pending write.
+
+        apply() may return False to signal that the write has been skipped.
+
+        """
+        pending = list(self.pending.values())
+        self.pending.clear()
+        for thermostat, temperature, kwargs in pending:
+            if apply(thermostat, temperature, **kwargs) is False:
+                continue
+            self.applied[thermostat.id] = temperature
+            self.written += 1
+
+    def describe(self):
+        return (
+            f"{self.written} write(s) applied, {self.saved} saved "
+            f"({self.dropped} superseded, {self.deferred} deferred)"
+        )
@@ -16,6 +16,13 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from thermostats.thermostats import views
+
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("status/", views.status_dashboard, name="status-dashboard"),
+    path("status.json", views.status_json, name="status-json"),
+    path("reports/heating.json", views.heating_report, name="heating-report"),
+    path("health.json", views.health, name="health"),
+    path("decisions.json", views.recent_decisions, name="recent-decisions"),
 ]
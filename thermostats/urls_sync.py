@@ -0,0 +1,3 @@
+"""No URLs for sync runs, see settings_sync.py."""
+
+urlpatterns = []